@@ -24,6 +24,8 @@ class TextPayload(HashableBaseModel):
 class ImagePayload(HashableBaseModel):
     extract: str
     current: Optional[List[str]]
+    # If given, the retrieved images are also stylized in the background, in one batch, for /api/stylized-image.
+    style: Optional[str] = None
 
 
 class FormPayload(HashableBaseModel):
@@ -0,0 +1,128 @@
+"""Request coalescing for the API.
+
+Concurrent requests wait in an asyncio queue for up to max_wait seconds or max_batch_size items,
+then run as one batched call on a worker thread so the event loop is never blocked.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class MicroBatcher():
+    """
+    Micro-batching scheduler: items submitted concurrently are collected and run together by run_batch.
+    Args:
+        run_batch (Callable): called as run_batch(items, key) on the executor, for the items of a batch submitted with
+            the same key, returns one result per item.
+        max_batch_size (int): maximal number of items per batch.
+        max_wait (float): seconds the first item of a batch waits for others to join.
+        executor (Executor): where run_batch runs. Batches run one at a time, the next batch is collected while
+            run_batch runs.
+    """
+
+    def __init__(self, run_batch, max_batch_size, max_wait, executor):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._executor = executor
+        self._queue = None
+        self._worker = None
+
+    async def submit(self, item, key=None):
+        """
+        Queues one item, returns its result once its batch ran.
+        """
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done():
+            # Created lazily to bind to the running event loop.
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run(self._queue))
+        future = loop.create_future()
+        await self._queue.put((key, item, future))
+        return await future
+
+    def queued(self):
+        return 0 if self._queue is None else self._queue.qsize()
+
+    async def _collect(self, queue, batch):
+        # Waits for one item, then for more until the window closes or the batch is full.
+        loop = asyncio.get_running_loop()
+        batch.append(await queue.get())
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+    async def _run_group(self, key, requests):
+        loop = asyncio.get_running_loop()
+        requests = [(item, future) for item, future in requests if not future.cancelled()]
+        if not requests:
+            return
+        try:
+            results = await loop.run_in_executor(
+                self._executor, self.run_batch, [item for item, _ in requests], key)
+            assert len(results) == len(requests), "run_batch must return one result per item"
+        except Exception as e:
+            for _, future in requests:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (_, future), result in zip(requests, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def _run(self, queue):
+        batch = []
+        try:
+            while True:
+                batch = []
+                await self._collect(queue, batch)
+                # Only items with the same key can share a run_batch call.
+                groups = {}
+                for key, item, future in batch:
+                    groups.setdefault(key, []).append((item, future))
+                for key, requests in groups.items():
+                    await self._run_group(key, requests)
+        finally:
+            # The worker stopped, e.g. cancelled with its event loop: no request it holds or that is queued waits forever.
+            while not queue.empty():
+                batch.append(queue.get_nowait())
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError("Batching worker stopped"))
+
+
+class AutocompleteBatcher():
+    """
+    Micro-batching scheduler in front of Pipeline.autocomplete_texts.
+    Args:
+        generate_fn (Callable): called as generate_fn(extracts_list, max_length, num_return_sequences, re_ranking,
+            on_texts), returns one result per extracts. on_texts has the on_text (or None) of each request, see
+            Pipeline.autocomplete_texts.
+        max_batch_size (int): maximal number of prompts per generate call.
+        max_wait (float): seconds the first request of a batch waits for others to join.
+        executor (Executor): where generate_fn runs, defaults to a dedicated thread.
+    """
+
+    def __init__(self, generate_fn, max_batch_size=8, max_wait=0.02, executor=None):
+        self.generate_fn = generate_fn
+        self._batcher = MicroBatcher(
+            self._generate, max_batch_size, max_wait,
+            executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix="autocomplete"))
+
+    def _generate(self, requests, key):
+        return self.generate_fn([extracts for extracts, _ in requests], *key,
+                                on_texts=[on_text for _, on_text in requests])
+
+    async def submit(self, extracts, max_length, num_return_sequences, re_ranking=0, on_text=None):
+        """
+        Queues one prompt, returns its generated texts once its batch ran.
+        Only requests with the same generation arguments share a generate call, streamed (on_text) or not.
+        on_text is called from the generate_fn thread.
+        """
+        return await self._batcher.submit((extracts, on_text), key=(max_length, num_return_sequences, re_ranking))
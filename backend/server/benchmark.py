@@ -0,0 +1,293 @@
+"""
+Benchmarks of the Pipeline hot paths and the story endpoint, with fixed seeds and prompts.
+Cases: autocomplete_text with and without re-ranking and retrieve_images per prompt length, score_text per ranking
+feature, and /api/story reads (uncached, cached and revalidated with If-None-Match).
+To record a baseline, then compare a later run with it:
+    python -m server.benchmark --models stub --output benchmark.json
+    python -m server.benchmark --models stub --baseline benchmark.json --threshold 0.25
+"stub" runs tiny randomly initialised GPT2 and CLIP models, a character tokenizer and random photo features, so it
+runs offline without any checkpoint. "real" loads the checkpoints of story_generator.constants. Stub timings track
+the cost of the code around the models, real timings the end-to-end latency.
+Results are JSON, per case the p50/p95/p99 and mean latency in milliseconds and the throughput in calls per second.
+With a baseline of the same models, exits with status 1 if a case p50 is more than threshold slower or a case of
+the baseline failed or didn't run, and with an error if the baseline file does not exist.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from story_generator.image_index import PhotoIds, PhotoIndex
+from story_generator.lru_cache import SizedLRUCache
+from story_generator.pipeline import Pipeline
+from story_generator.ranking_utils import FEATURE_REGISTRY, Ranker
+
+MODELS = ["stub", "real"]
+# Story prompts of increasing length, the long one is truncated to MAX_SEQ_LEN tokens.
+PROMPTS = {
+    "short": "The Wonders of the Sun\n",
+    "medium": ("Once upon a time, in a kingdom by the sea, there lived a poor fisherman and his wife. Every morning "
+               "he rowed out past the rocks, and every evening he came home with an empty net. One day, as the sun "
+               "was setting, something heavy pulled at the line. "),
+    "long": ("Long ago, when wishing still helped, there lived a king whose daughters were all beautiful, but the "
+             "youngest was so beautiful that the sun itself was astonished whenever it shone in her face. Close by "
+             "the king's castle lay a great dark forest, and under an old lime tree in the forest was a well. When "
+             "the day was very warm, the king's child went out into the forest and sat down by the side of the cool "
+             "fountain, and when she was bored she took a golden ball, and threw it up on high and caught it, and "
+             "this ball was her favorite plaything. Now it so happened that on one occasion the princess's golden "
+             "ball did not fall into the little hand which she was holding up for it, but on to the ground beyond, "
+             "and rolled straight into the water. The king's daughter followed it with her eyes, but it vanished, "
+             "and the well was deep, so deep that the bottom could not be seen. At this she began to cry, and cried "
+             "louder and louder, and could not be comforted. And as she thus lamented someone said to her, what "
+             "ails you, king's daughter? You weep so that even a stone would show pity. She looked round to the "
+             "side from whence the voice came, and saw a frog stretching forth its big, ugly head from the water. "
+             "Ah, old water-splasher, is it you, she said, I am weeping for my golden ball, which has fallen into "
+             "the well. Be quiet, and do not weep, answered the frog, I can help you, but what will you give me if "
+             "I bring your plaything up again? "),
+}
+STORY_HTML = "<p>" + PROMPTS["long"] * 4 + "</p>"
+
+
+class StubTokenizer():
+    """
+    Character level stand-in for the GPT2 tokenizer, left-pads like the Pipeline tokenizer. Ids fit a 100 tokens
+    vocabulary, 0 is eos and padding.
+    """
+    pad_token_id = eos_token_id = 0
+    padding_side = "left"
+
+    def _encode(self, text):
+        return [1 + ord(char) % 99 for char in text]
+
+    def __call__(self, texts, padding=False, return_tensors=None):
+        if isinstance(texts, str):
+            return {'input_ids': self._encode(texts)}
+        ids = [self._encode(text) for text in texts]
+        if not padding:
+            return {'input_ids': ids}
+        max_len = max(map(len, ids))
+        input_ids = [[0] * (max_len - len(i)) + i for i in ids]
+        attention_mask = [[0] * (max_len - len(i)) + [1] * len(i) for i in ids]
+        if return_tensors == 'pt':
+            return {'input_ids': torch.tensor(input_ids), 'attention_mask': torch.tensor(attention_mask)}
+        return {'input_ids': input_ids, 'attention_mask': attention_mask}
+
+    def decode(self, ids, skip_special_tokens=True):
+        return ''.join(chr(31 + int(i)) for i in ids if int(i) != self.eos_token_id)
+
+
+def _stub_gpt2(seed):
+    from transformers import GPT2Config, GPT2LMHeadModel
+
+    torch.manual_seed(seed)
+    config = GPT2Config(n_layer=2, n_embd=64, n_head=2, vocab_size=100, n_positions=1024,
+                        bos_token_id=0, eos_token_id=0)
+    return GPT2LMHeadModel(config).eval()
+
+
+def _stub_clip(seed):
+    # Same text encoder architecture as ViT-B/32, scaled down. The vision tower is unused.
+    from clip.model import CLIP
+
+    torch.manual_seed(seed)
+    return CLIP(embed_dim=512, image_resolution=32, vision_layers=1, vision_width=64, vision_patch_size=16,
+                context_length=77, vocab_size=49408, transformer_width=64, transformer_heads=2,
+                transformer_layers=2).eval()
+
+
+def _stub_photos(seed, num_photos):
+    rng = np.random.default_rng(seed)
+    features = rng.standard_normal((num_photos, 512)).astype(np.float32)
+    features /= np.linalg.norm(features, axis=-1, keepdims=True)
+    ids = np.array([f"photo{idx:06d}".encode('ascii') for idx in range(num_photos)])
+    return PhotoIds(ids), features.astype(np.float16)
+
+
+def stub_pipeline(seed=0, num_photos=25000):
+    """
+    Pipeline with tiny randomly initialised models in place of the checkpoints, and random photo features.
+    """
+    pipeline = Pipeline(top=1)
+    photo_ids, features = _stub_photos(seed, num_photos)
+    pipeline._components.register("tokenizer", StubTokenizer)
+    pipeline._components.register("gpt2", lambda: _stub_gpt2(seed))
+    pipeline._components.register("preset_model", lambda: _stub_gpt2(seed + 1))
+    pipeline._components.register("clip", lambda: _stub_clip(seed))
+    pipeline._components.register("photo_ids", lambda: photo_ids)
+    pipeline._components.register("photo_index", lambda: PhotoIndex(features, pipeline._device))
+    pipeline.warm_up(["tokenizer", "gpt2", "preset_model", "clip", "photo_ids", "photo_index", "sentence_embedder"])
+    return pipeline
+
+
+def real_pipeline():
+    pipeline = Pipeline(top=1)
+    pipeline.warm_up(["tokenizer", "gpt2", "preset_model", "clip", "photo_ids", "photo_index", "sentence_embedder"])
+    return pipeline
+
+
+def _seed(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def measure(fn, iterations, warmup=1, setup=None):
+    """
+    Times fn() iterations times after warmup calls, setup() runs before each call and isn't timed.
+    Returns the latency percentiles and mean in milliseconds, and the throughput in calls per second.
+    """
+    latencies = []
+    for iteration in range(warmup + iterations):
+        if setup is not None:
+            setup()
+        start_time = time.perf_counter()
+        fn()
+        if iteration >= warmup:
+            latencies.append(time.perf_counter() - start_time)
+    latencies = np.array(latencies) * 1000
+    return {"iterations": iterations,
+            "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+            "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+            "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+            "mean_ms": round(float(latencies.mean()), 3),
+            "throughput": round(float(1000 / latencies.mean()), 3)}
+
+
+def _pipeline_cases(pipeline):
+    def clear_caches():
+        # Every call computes from scratch, as for a new story.
+        pipeline._text_features_cache.clear()
+        if pipeline._prefix_cache is not None:
+            pipeline._prefix_cache.clear()
+        if pipeline._sentence_embedder is not None:
+            pipeline._sentence_embedder.cache.clear()
+
+    cases = {}
+    for name, prompt in PROMPTS.items():
+        cases[f"autocomplete_text/{name}"] = (
+            lambda prompt=prompt: pipeline.autocomplete_text(prompt, max_length=25, num_return_sequences=3), clear_caches)
+        cases[f"autocomplete_text_reranked/{name}"] = (
+            lambda prompt=prompt: pipeline.autocomplete_text(prompt, max_length=25, num_return_sequences=3,
+                                                             re_ranking=10), clear_caches)
+        if name != "long":
+            # The long prompt is past the CLIP context length, the frontend retrieves for a sentence or paragraph.
+            cases[f"retrieve_images/{name}"] = (
+                lambda prompt=prompt: pipeline.retrieve_images(prompt, num_images=3, current_images_ids=[]),
+                clear_caches)
+    text = PROMPTS["medium"]
+    for feature in FEATURE_REGISTRY.values():
+        ranker = Ranker(latency_budget=None, features=[feature])
+        cases[f"score_text/{feature.name}"] = (
+            lambda ranker=ranker: ranker.score([text], pipeline._tokenizer, pipeline._preset_model, pipeline._gpt2,
+                                               sentence_embedder=pipeline._sentence_embedder), clear_caches)
+    return cases
+
+
+def _story_cases(directory):
+    # Imported here, server.main builds the app and its stores on import.
+    from fastapi.testclient import TestClient
+    import server.main as main
+    from server.story_store import FileStoryStore
+
+    main.WARM_UP = False
+    main.story_store = FileStoryStore(directory)
+    main.story_cache = SizedLRUCache(main.STORY_CACHE_BYTES)
+    story_id = "0" * 32
+    main.story_store.put(story_id, {"html": STORY_HTML, "coherence": 5, "clarity": 5, "creativity": 5,
+                                    "freeForm": ""})
+    client = TestClient(main.app)
+
+    def get(headers=None):
+        response = client.get("/api/story", params={"storyid": story_id}, headers=headers)
+        assert response.status_code in (200, 304), response.status_code
+
+    return {"story_read/uncached": (get, main.story_cache.clear),
+            "story_read/cached": (get, None),
+            "story_read/revalidated": (lambda: get({"If-None-Match": f'"{story_id}"'}), None)}
+
+
+def run(models="stub", iterations=20, warmup=2, seed=0, cases=None):
+    """
+    Runs the cases whose name starts with one of cases (all by default), returns the JSON results.
+    """
+    assert models in MODELS, f"Unknown models {models}, expected one of {MODELS}"
+    _seed(seed)
+    pipeline = stub_pipeline(seed) if models == "stub" else real_pipeline()
+    results = {"models": models, "seed": seed, "device": str(pipeline._device),
+               "torch_threads": torch.get_num_threads(), "cases": {}}
+    with tempfile.TemporaryDirectory() as directory:
+        all_cases = {**_pipeline_cases(pipeline), **_story_cases(directory)}
+        for name, (fn, setup) in all_cases.items():
+            if not _selected(name, cases):
+                continue
+            _seed(seed)
+            try:
+                results["cases"][name] = measure(fn, iterations, warmup, setup)
+            except Exception as e:
+                # E.g. NLTK data missing for the Sentiment feature, the other cases still run.
+                results["cases"][name] = {"error": f"{type(e).__name__}: {str(e).strip().splitlines()[0]}"}
+            print(name, results["cases"][name], flush=True)
+    return results
+
+
+def _selected(name, cases):
+    return not cases or any(name.startswith(prefix) for prefix in cases)
+
+
+def compare(results, baseline, threshold, cases=None):
+    """
+    Returns the regressions against baseline: the cases whose p50 is more than threshold (e.g. 0.25 for 25%) slower,
+    and the cases with a baseline p50 that failed or are missing from results, among the cases run (see run).
+    Cases without a baseline p50 are not compared.
+    """
+    assert results["models"] == baseline["models"], "Results and baseline ran different models"
+    regressions = []
+    for name, baseline_case in baseline["cases"].items():
+        if "p50_ms" not in baseline_case or not _selected(name, cases):
+            continue
+        case = results["cases"].get(name, {"error": "missing from the results"})
+        if "p50_ms" not in case:
+            regressions.append({"case": name, "baseline_p50_ms": baseline_case["p50_ms"], "error": case.get("error")})
+        elif case["p50_ms"] > baseline_case["p50_ms"] * (1 + threshold):
+            regressions.append({"case": name, "baseline_p50_ms": baseline_case["p50_ms"], "p50_ms": case["p50_ms"]})
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--models", default="stub", choices=MODELS)
+    parser.add_argument("--iterations", default=20, type=int)
+    parser.add_argument("--warmup", default=2, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--cases", nargs="*", default=None,
+                        help="Only run the cases starting with these names, e.g. score_text story_read.")
+    parser.add_argument("--output", default=None, help="Write the JSON results to this file.")
+    parser.add_argument("--baseline", default=None, help="JSON results to compare with.")
+    parser.add_argument("--threshold", default=0.25, type=float,
+                        help="Allowed p50 slowdown against the baseline, as a fraction.")
+    args = parser.parse_args()
+    if args.baseline is not None and not os.path.exists(args.baseline):
+        parser.error(f"Baseline file {args.baseline} does not exist")
+
+    results = run(args.models, args.iterations, args.warmup, args.seed, args.cases)
+    if args.output is not None:
+        with open(args.output, 'w') as outfile:
+            json.dump(results, outfile, indent=2, sort_keys=True)
+    if args.baseline is not None:
+        with open(args.baseline) as infile:
+            regressions = compare(results, json.load(infile), args.threshold, args.cases)
+        for regression in regressions:
+            if "error" in regression:
+                print(f"Regression: {regression['case']} p50 {regression['baseline_p50_ms']}ms -> {regression['error']}")
+            else:
+                print(f"Regression: {regression['case']} p50 {regression['baseline_p50_ms']}ms -> {regression['p50_ms']}ms")
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,127 @@
+"""Bounded executor for the blocking model calls of the API.
+
+Model work runs on a fixed thread pool instead of the event loop. Every endpoint has its own concurrency
+limit and queue bound, requests over the bound are shed with a 503 and a Retry-After estimate.
+"""
+
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from math import ceil
+
+import numpy as np
+import torch
+
+
+class ServiceOverloaded(Exception):
+    """
+    Raised when an endpoint queue is full, retry_after is in seconds.
+    """
+
+    def __init__(self, endpoint, retry_after):
+        super().__init__(f"{endpoint} queue is full, retry after {retry_after}s")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+class EndpointStats():
+    """
+    Queue depth and latency counters of one endpoint. Latencies are kept for the last window requests.
+    """
+
+    def __init__(self, concurrency, max_queue, window=1000):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.semaphore = None
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_times = deque(maxlen=window)
+        self.run_times = deque(maxlen=window)
+
+    def retry_after(self):
+        """
+        Returns the seconds until the current queue is expected to drain.
+        """
+        mean_run_time = np.mean(self.run_times) if self.run_times else 1.0
+        return max(1, ceil(mean_run_time * self.queued / self.concurrency))
+
+    def summary(self):
+        def percentiles(samples):
+            if not samples:
+                return {"p50": 0.0, "p99": 0.0, "max": 0.0}
+            p50, p99 = np.percentile(samples, [50, 99])
+            return {"p50": float(p50), "p99": float(p99), "max": float(max(samples))}
+
+        return {
+            "concurrency": self.concurrency,
+            "max_queue": self.max_queue,
+            "queued": self.queued,
+            "running": self.running,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "wait_time": percentiles(self.wait_times),
+            "run_time": percentiles(self.run_times),
+        }
+
+
+class InferenceExecutor():
+    """
+    Runs blocking model calls on a bounded thread pool, with per-endpoint limits.
+    Args:
+        limits (Dict<str, Tuple<int, int>>): endpoint name -> (max concurrent requests, max queued requests).
+        max_workers (int): number of inference threads.
+        num_threads (int): torch.set_num_threads value, process wide. Defaults to the torch default divided by
+            max_workers, so the workers don't oversubscribe the cores.
+    """
+
+    def __init__(self, limits, max_workers=2, num_threads=None):
+        self.num_threads = num_threads or max(1, torch.get_num_threads() // max_workers)
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="inference",
+                                       initializer=torch.set_num_threads, initargs=(self.num_threads,))
+        self.stats = {endpoint: EndpointStats(concurrency, max_queue)
+                      for endpoint, (concurrency, max_queue) in limits.items()}
+
+    @asynccontextmanager
+    async def limit(self, endpoint):
+        """
+        Waits for a free slot of the endpoint, raises ServiceOverloaded if its queue is full.
+        """
+        stats = self.stats[endpoint]
+        if stats.semaphore is None:
+            # Created lazily to bind to the running event loop.
+            stats.semaphore = asyncio.Semaphore(stats.concurrency)
+        if stats.semaphore.locked() and stats.queued >= stats.max_queue:
+            stats.rejected += 1
+            raise ServiceOverloaded(endpoint, stats.retry_after())
+
+        start_time = time.perf_counter()
+        stats.queued += 1
+        try:
+            await stats.semaphore.acquire()
+        finally:
+            stats.queued -= 1
+        stats.wait_times.append(time.perf_counter() - start_time)
+        stats.running += 1
+        run_start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats.running -= 1
+            stats.completed += 1
+            stats.run_times.append(time.perf_counter() - run_start_time)
+            stats.semaphore.release()
+
+    async def run(self, endpoint, fn, *args):
+        """
+        Returns fn(*args), run on the inference pool within the endpoint limits.
+        """
+        async with self.limit(endpoint):
+            return await asyncio.get_running_loop().run_in_executor(self.pool, fn, *args)
+
+    def metrics(self):
+        return {"num_threads": self.num_threads,
+                "endpoints": {endpoint: stats.summary() for endpoint, stats in self.stats.items()}}
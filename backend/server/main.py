@@ -1,25 +1,54 @@
 from functools import lru_cache
+from contextlib import AsyncExitStack
 import argparse
+import asyncio
 from typing import *
 import numpy as np
 # For form submission
 import json
 import os
 import uuid
+from urllib.error import URLError
 
-from fastapi import FastAPI
-from fastapi.responses import FileResponse, RedirectResponse
+from fastapi import BackgroundTasks, FastAPI, Header
+from fastapi.responses import FileResponse, JSONResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 
 import uvicorn
 import server.api as api
+from server.batching import AutocompleteBatcher
+from server.inference import InferenceExecutor, ServiceOverloaded
+from server.story_store import load_story_store
+from server.story_writer import StoryWriter
 import path_fixes as pf
 
 from story_generator.pipeline import Pipeline
+from story_generator.lru_cache import SizedLRUCache
 
 OUTPUT_PATH = os.path.join(
     os.getcwd(), 'backend/outputs/')
+# Submitted stories storage, "files" (one JSON file per story in OUTPUT_PATH) or "sqlite" (backend/outputs.sqlite3).
+# Move existing stories with `python -m server.story_store migrate`.
+STORY_STORE = "files"
+# Form submissions are written in batches by a background writer, synced to disk per "batch", per "record" or
+# left to the OS ("none").
+STORY_DURABILITY = "batch"
+# Memory budget of the shared stories HTML cache.
+STORY_CACHE_BYTES = 64 * 2**20
+# Story IDs are uuid5 of their content, so a story response never changes.
+STORY_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Text generation requests wait up to BATCH_WAIT seconds for up to MAX_BATCH_SIZE prompts to generate together.
+BATCH_WAIT, MAX_BATCH_SIZE = 0.02, 8
+# Blocking model work runs on INFERENCE_WORKERS threads, TORCH_THREADS=None splits the cores between them.
+INFERENCE_WORKERS, TORCH_THREADS = 2, None
+# Per endpoint (max concurrent requests, max queued requests), requests over the queue bound get a 503.
+ENDPOINT_LIMITS = {'text': (MAX_BATCH_SIZE, 32), 'image': (INFERENCE_WORKERS, 32)}
+# Load all models concurrently at startup, otherwise each model loads on the first request that needs it.
+WARM_UP = True
+# Pipeline components every request type needs, /api/ready waits for them after WARM_UP. The others (e.g. the style
+# models, the draft model) load on first use and are reported by /api/ready without holding it back.
+READY_COMPONENTS = ["tokenizer", "gpt2", "clip", "photo_ids", "photo_index"]
 
 parser = argparse.ArgumentParser(
     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -53,11 +82,33 @@ def _verify_form(form_payload):
 def getGenerator():
     """
     Function will run once thanks to cache.
-    Generate an instance of the framework that generates one story.
+    Generate an instance of the framework that generates one story, its models load lazily or on warm up.
     """
     return Pipeline(top=1)
 
 
+story_store = load_story_store(STORY_STORE, directory=OUTPUT_PATH)
+story_cache = SizedLRUCache(STORY_CACHE_BYTES)
+story_writer = StoryWriter(story_store, durability=STORY_DURABILITY)
+inference = InferenceExecutor(
+    ENDPOINT_LIMITS, max_workers=INFERENCE_WORKERS, num_threads=TORCH_THREADS)
+# Runs the generation on an inference thread, which also loads the models on first use.
+text_batcher = AutocompleteBatcher(lambda *args, **kwargs: getGenerator().autocomplete_texts(*args, **kwargs),
+                                   max_batch_size=MAX_BATCH_SIZE, max_wait=BATCH_WAIT, executor=inference.pool)
+
+
+@app.on_event("startup")
+async def warm_up():
+    # In the background, so the server answers /api/ready while the models load.
+    if WARM_UP:
+        asyncio.get_running_loop().run_in_executor(None, getGenerator().warm_up)
+
+
+@app.exception_handler(ServiceOverloaded)
+async def service_overloaded(request, exc: ServiceOverloaded):
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": str(exc.retry_after)})
+
+
 # Main routes
 @app.get("/")
 def index():
@@ -92,48 +143,163 @@ async def docs():
     return RedirectResponse(url="/docs")
 
 
+@app.get("/api/metrics")
+async def metrics():
+    """
+    Queue depth, wait time and run time per inference endpoint, cache and ranking counters.
+    """
+    metrics = inference.metrics()
+    metrics.update(getGenerator().metrics())
+    metrics["story_cache"] = story_cache.info()
+    metrics["story_writer"] = story_writer.metrics()
+    return metrics
+
+
+@app.get("/api/ready")
+async def ready():
+    """
+    Loading status of every model, 200 once the READY_COMPONENTS are loaded and 503 before.
+    Without WARM_UP the models load on the first requests, so the server is always ready.
+    """
+    components = getGenerator().status()
+    is_ready = not WARM_UP or all(components[name]["status"] ==
+                                  "loaded" for name in READY_COMPONENTS)
+    return JSONResponse(status_code=200 if is_ready else 503, content={"ready": is_ready, "components": components})
+
+
+def _etag_matches(if_none_match, etag):
+    if if_none_match is None:
+        return False
+    # A list of (weak) entity tags, or *.
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    tags = [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+    return "*" in tags or etag in tags
+
+
 @app.get("/api/story", response_model=str)
-async def get_story(storyid: str):
+async def get_story(storyid: str, if_none_match: Optional[str] = Header(None)):
     """
     Fetch a story HTML string if exists, otherwise returns empty string. 
+    Found stories are immutable: they are cached in memory and sent with an ETag, revalidations get a 304.
     """
-    file_path = os.path.join(OUTPUT_PATH, f'{storyid}.txt')
-    if os.path.exists(file_path):
+    html = story_cache.get(storyid)
+    if html is None:
         try:
-            with open(file_path) as infile:
-                data = json.load(infile)
+            html = await asyncio.get_running_loop().run_in_executor(None, story_store.get_html, storyid)
         except Exception as e:
             print(type(e), " Exception occurred")
             print("Exception Args:", e.args)
-        else:
-            return data['html']
-    print("Story not found")
-    return ""
+        if html is None:
+            print("Story not found")
+            # Not cached, the story might be submitted later.
+            return JSONResponse(content="", headers={"Cache-Control": "no-cache"})
+        story_cache.put(storyid, html)
+    # Only existing stories are revalidated, a story id that doesn't exist yet never gets a 304.
+    etag = f'"{storyid}"'
+    headers = {"ETag": etag, "Cache-Control": STORY_CACHE_CONTROL}
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(content=html, headers=headers)
+
+
+@app.get("/api/stylized-image")
+async def get_stylized_image(photoid: str, style: str):
+    """
+    The photo JPEG in style (none, sketch, anime or comics). Stylized once, then served from the on-disk cache.
+    Only photos of the catalog are downloaded and stylized.
+    """
+    # Off the event loop and the inference queue, the first lookup may load the photo ids.
+    if not await asyncio.get_running_loop().run_in_executor(None, getGenerator().has_photo, photoid):
+        return JSONResponse(status_code=404, content={"detail": "Unknown photo or style"})
+    try:
+        path = (await inference.run('image', lambda: getGenerator().stylize_images([photoid], style)))[0]
+    except (AssertionError, KeyError, URLError) as e:
+        print(type(e), " Exception occurred")
+        print("Exception Args:", e.args)
+        return JSONResponse(status_code=404, content={"detail": "Unknown photo or style"})
+    # A photo style is never restylized, see story_generator.style_transfer.
+    return FileResponse(path, media_type="image/jpeg", headers={"Cache-Control": STORY_CACHE_CONTROL})
 
 
 # POST to send/ create Object data, response_model converts output data to its type declaration.
 
 
+async def stylize_retrieved_images(images_ids, style):
+    # Best effort, /api/stylized-image stylizes or reports them again.
+    try:
+        await inference.run('image', lambda: getGenerator().stylize_images(images_ids, style))
+    except (AssertionError, KeyError, URLError, ServiceOverloaded) as e:
+        print(type(e), " Exception occurred")
+        print("Exception Args:", e.args)
+
+
 @app.post("/api/post-autocomplete-img", response_model=List[str])
-async def retreive_image(payload: api.ImagePayload):
+async def retreive_image(payload: api.ImagePayload, background_tasks: BackgroundTasks):
     # Returns new image id strs.
     payload = api.ImagePayload(**payload)
     current_imgs = [] if payload.current is None else payload.current
-    storyGenerator = getGenerator()
     # Extract is the last "numSenteces" sentences defined in Editor.vue
-    return storyGenerator.retrieve_images(payload.extract, num_images=3, current_images_ids=current_imgs)
+    images_ids = await inference.run('image', lambda: getGenerator().retrieve_images(
+        payload.extract, num_images=3, current_images_ids=current_imgs))
+    if payload.style is not None:
+        # After the response, so the ids don't wait for the downloads and the style model.
+        background_tasks.add_task(stylize_retrieved_images, images_ids, payload.style)
+    return images_ids
 
 
 @app.post("/api/post-autocomplete-text", response_model=List[str])
 async def autocomplete_text(payload: api.TextPayload):
     # Coerce into correct type. Not needed if no test written for this endpoint
     payload = api.TextPayload(**payload)
-    storyGenerator = getGenerator()
     # If extracts are too long, truncation will be taken care of by the tokenizer.
     re_ranking = 10 if payload.quality else 0
     # Might return less than num_return_sequences if some are empty/ just \s.
     # Returned texts are trimmed/ with one space at the beginning.
-    return storyGenerator.autocomplete_text(payload.extracts, max_length=25, num_return_sequences=3, re_ranking=re_ranking)
+    async with inference.limit('text'):
+        return await text_batcher.submit(payload.extracts, max_length=25, num_return_sequences=3, re_ranking=re_ranking)
+
+
+@app.post("/api/stream-autocomplete-text")
+async def stream_autocomplete_text(payload: api.TextPayload):
+    """
+    Server-sent events version of /api/post-autocomplete-text, batched with the other autocomplete requests.
+    Sends {"candidate": idx, "text": new_text} events while the candidates are decoded,
+    then a "done" event with the same list /api/post-autocomplete-text returns.
+    """
+    payload = api.TextPayload(**payload)
+    re_ranking = 10 if payload.quality else 0
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def on_text(candidate, text):
+        # Called from the inference thread.
+        loop.call_soon_threadsafe(events.put_nowait, {
+                                  "candidate": candidate, "text": text})
+
+    # Enter the limit before responding, so a full queue is still a 503. It's released when generation ends.
+    limit = AsyncExitStack()
+    await limit.enter_async_context(inference.limit('text'))
+    generation = asyncio.ensure_future(text_batcher.submit(
+        payload.extracts, max_length=25, num_return_sequences=3, re_ranking=re_ranking, on_text=on_text))
+    generation.add_done_callback(lambda _: events.put_nowait(None))
+    generation.add_done_callback(lambda _: loop.create_task(limit.aclose()))
+
+    async def stream():
+        while True:
+            event = await events.get()
+            if event is None:
+                break
+            yield f"data: {json.dumps(event)}\n\n"
+        try:
+            texts = generation.result()
+        except Exception as e:
+            print(type(e), " Exception occurred")
+            print("Exception Args:", e.args)
+            yield "event: error\ndata: \"\"\n\n"
+        else:
+            yield f"event: done\ndata: {json.dumps(texts)}\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
 
 
 @app.post("/api/post-form-submission", response_model=str)
@@ -147,11 +313,9 @@ async def submit_form(payload: api.FormPayload):
                 str(payload.creativity) + str(payload.coherence) + \
                 str(payload.clarity) + payload.freeForm
             filename = uuid.uuid5(uuid.NAMESPACE_X500, story_and_feedback).hex
-            file_path = os.path.join(OUTPUT_PATH, f'{filename}.txt')
-            # Write new file.
-            with open(file_path, 'w') as outfile:
-                json.dump(dict(payload), outfile, sort_keys=True, indent=4,
-                          ensure_ascii=False)
+            # Same story and feedback are stored once.
+            if filename not in story_cache:
+                await story_writer.submit(filename, dict(payload))
         except Exception as e:
             print(type(e), " Exception occurred")
             print("Excetopn Args:", e.args)
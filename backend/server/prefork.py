@@ -0,0 +1,100 @@
+"""
+Pre-fork launcher: loads the models once, then forks uvicorn workers that share them.
+uvicorn --workers N spawns fresh processes, each loading its own copy of the GPT2 models, CLIP and the photo index.
+Here the parent process loads them, moves the model weights to shared memory and forks the workers, so every worker
+maps the same weights and memory no longer grows with the number of workers.
+CPU only, CUDA doesn't support forking after initialization. To serve with 4 workers:
+    python -m server.prefork --workers 4 --port 8000
+"""
+
+import argparse
+import gc
+import os
+import signal
+
+import torch
+import uvicorn
+
+import story_generator.constants as constants
+
+
+def share_models(pipeline):
+    """
+    Moves the weights of the loaded torch models of the pipeline to shared memory.
+    Shared memory tensors are mapped by every forked worker rather than copied on write. The other components (int8
+    packed weights, ONNX Runtime sessions, numpy arrays) stay copy-on-write, they are only read after loading.
+    """
+    for component in ["gpt2", "preset_model", "clip"]:
+        model = getattr(pipeline, f"_{component}")
+        if isinstance(model, torch.nn.Module):
+            model.share_memory()
+
+
+def _fork_worker(config, sockets):
+    pid = os.fork()
+    if pid == 0:
+        # Default signal handlers, uvicorn installs its own for a graceful shutdown.
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        uvicorn.Server(config).run(sockets=sockets)
+        os._exit(0)
+    return pid
+
+
+def serve(host, port, workers):
+    """
+    Loads the models, then serves the app on host:port with workers forked processes until SIGINT/ SIGTERM.
+    Crashed workers are replaced.
+    """
+    # Split the cores between the workers before the app computes its inference threads.
+    torch.set_num_threads(max(1, torch.get_num_threads() // workers))
+    # Each worker fills its own prefix cache, split the memory budget between them before the Pipeline is created.
+    constants.PREFIX_CACHE_BYTES //= workers
+    from server.main import app, getGenerator
+
+    # Load in a single thread, so no OpenMP thread pool exists at fork time.
+    num_threads = torch.get_num_threads()
+    torch.set_num_threads(1)
+    pipeline = getGenerator()
+    assert pipeline._device.type == "cpu", "Pre-forked workers require CPU models"
+    pipeline.warm_up()
+    share_models(pipeline)
+    torch.set_num_threads(num_threads)
+    # Keep the garbage collector from writing to the pages of the loaded objects in the workers.
+    gc.collect()
+    gc.freeze()
+
+    config = uvicorn.Config(app, host=host, port=port)
+    sockets = [config.bind_socket()]
+    children = {_fork_worker(config, sockets) for _ in range(workers)}
+    print(f"Serving on {host}:{port} with workers {sorted(children)}")
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    while children:
+        pid, status = os.wait()
+        children.discard(pid)
+        if not stopping:
+            # Replace crashed workers, the models are still loaded in this process.
+            print(f"Worker {pid} exited with status {status}, restarting")
+            children.add(_fork_worker(config, sockets))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", default=8000, type=int,
+                        help="Port to run the app. ")
+    parser.add_argument("--workers", default=os.cpu_count() // 2 or 1, type=int,
+                        help="Number of worker processes sharing the models.")
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers)
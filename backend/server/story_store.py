@@ -0,0 +1,235 @@
+"""
+Storage backends for the submitted stories and their feedback.
+A story is stored under its ID (a uuid5 of its content, see main.submit_form) and is never modified after.
+Backends:
+    files: one JSON file per story, <directory>/<story_id>.txt.
+    sqlite: one SQLite database in WAL mode, with the story HTML in its own column so share-link views read it
+        without parsing the rest of the payload.
+Existing stories move between backends with the migrate command, e.g. from the files to the sqlite backend:
+    python -m server.story_store migrate --source files --destination sqlite
+"""
+
+from abc import ABC, abstractmethod
+import argparse
+import json
+import os
+import sqlite3
+import threading
+
+STORE_BACKENDS = ["files", "sqlite"]
+# When writes are flushed to disk: "none" leaves it to the OS, "batch" once per put_many call, "record" per story.
+DURABILITY_MODES = ["none", "batch", "record"]
+STORIES_DIRECTORY = os.path.join(os.getcwd(), 'backend/outputs/')
+STORIES_DB_PATH = os.path.join(os.getcwd(), 'backend/outputs.sqlite3')
+
+
+class StoryStore(ABC):
+    """
+    Interface of the story storage backends.
+    """
+
+    @abstractmethod
+    def get_html(self, story_id):
+        """
+        Returns the story HTML, None if there is no such story.
+        """
+
+    def put(self, story_id, payload, durability="none"):
+        """
+        Stores the payload (including "html") under story_id, returns False if story_id already exists.
+        """
+        return self.put_many([(story_id, payload)], durability)[0]
+
+    @abstractmethod
+    def put_many(self, stories, durability="batch"):
+        """
+        Args:
+            stories (List<Tuple<str, dict>>): (story_id, payload) pairs.
+            durability (str): one of DURABILITY_MODES.
+        Stores the stories, skipping IDs that already exist or repeat. Returns per story whether it was written.
+        """
+
+    def __contains__(self, story_id):
+        return self.get_html(story_id) is not None
+
+    @abstractmethod
+    def items(self):
+        """
+        Iterates over all (story_id, payload) pairs.
+        """
+
+
+class FileStoryStore(StoryStore):
+    """
+    One compact JSON file per story, written atomically. Indented files of earlier versions read the same.
+    Args:
+        directory (str): where the story files are.
+    """
+
+    def __init__(self, directory=STORIES_DIRECTORY):
+        self.directory = directory
+
+    def _path(self, story_id):
+        # IDs come from share links, don't let them leave the directory.
+        if not story_id or os.path.basename(story_id) != story_id or story_id.startswith('.'):
+            return None
+        return os.path.join(self.directory, f'{story_id}.txt')
+
+    def get_html(self, story_id):
+        path = self._path(story_id)
+        if path is None or not os.path.exists(path):
+            return None
+        with open(path) as infile:
+            return json.load(infile)['html']
+
+    def put_many(self, stories, durability="batch"):
+        assert durability in DURABILITY_MODES, f"Unknown durability {durability}"
+        paths = [self._path(story_id) for story_id, _ in stories]
+        for (story_id, _), path in zip(stories, paths):
+            assert path is not None, f"Invalid story id {story_id}"
+        written, renames, batch_paths = [], [], set()
+        for (story_id, payload), path in zip(stories, paths):
+            if path in batch_paths or os.path.exists(path):
+                written.append(False)
+                continue
+            # Written to a temporary file and renamed, so readers never see a partial story. The name is unique per
+            # thread and process, pre-forked workers may write the same story.
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w') as outfile:
+                json.dump(payload, outfile, sort_keys=True, separators=(',', ':'),
+                          ensure_ascii=False)
+                outfile.flush()
+                # The data is synced before the rename, or a crash could keep the rename of an empty file.
+                if durability != "none":
+                    os.fsync(outfile.fileno())
+            renames.append((tmp_path, path))
+            batch_paths.add(path)
+            written.append(True)
+            if durability == "record":
+                os.replace(tmp_path, path)
+                self._fsync_directory()
+        if durability != "record":
+            for tmp_path, path in renames:
+                os.replace(tmp_path, path)
+            # One directory sync makes all the renames of the batch durable.
+            if durability == "batch" and renames:
+                self._fsync_directory()
+        return written
+
+    def _fsync_directory(self):
+        # Makes the renames durable.
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def __contains__(self, story_id):
+        path = self._path(story_id)
+        return path is not None and os.path.exists(path)
+
+    def items(self):
+        for filename in sorted(os.listdir(self.directory)):
+            if filename.endswith('.txt'):
+                with open(os.path.join(self.directory, filename)) as infile:
+                    yield filename[:-len('.txt')], json.load(infile)
+
+
+class SQLiteStoryStore(StoryStore):
+    """
+    Stories in one SQLite database in WAL mode: concurrent readers don't block the writer.
+    Connections are per thread, as sqlite3 connections can't be shared between threads.
+    Args:
+        path (str): database file, created if missing.
+    """
+
+    def __init__(self, path=STORIES_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS stories "
+                               "(id TEXT PRIMARY KEY, html TEXT NOT NULL, payload TEXT NOT NULL) WITHOUT ROWID")
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # With WAL, commits are durable at checkpoints and never corrupt the database.
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get_html(self, story_id):
+        row = self._connection().execute(
+            "SELECT html FROM stories WHERE id = ?", (story_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def put_many(self, stories, durability="batch"):
+        assert durability in DURABILITY_MODES, f"Unknown durability {durability}"
+        connection = self._connection()
+        # FULL syncs the WAL at every commit, NORMAL only at checkpoints.
+        connection.execute(
+            f"PRAGMA synchronous={'NORMAL' if durability == 'none' else 'FULL'}")
+        written = []
+        # One transaction (and WAL sync) per batch, or per story.
+        transaction_size = 1 if durability == "record" else max(1, len(stories))
+        for start in range(0, len(stories), transaction_size):
+            with connection:
+                for story_id, payload in stories[start:start + transaction_size]:
+                    cursor = connection.execute("INSERT OR IGNORE INTO stories (id, html, payload) VALUES (?, ?, ?)",
+                                                (story_id, payload['html'],
+                                                 json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False)))
+                    written.append(cursor.rowcount == 1)
+        return written
+
+    def __contains__(self, story_id):
+        return self._connection().execute(
+            "SELECT 1 FROM stories WHERE id = ?", (story_id,)).fetchone() is not None
+
+    def items(self):
+        for story_id, payload in self._connection().execute("SELECT id, payload FROM stories ORDER BY id"):
+            yield story_id, json.loads(payload)
+
+
+def load_story_store(backend, directory=STORIES_DIRECTORY, db_path=STORIES_DB_PATH):
+    """
+    Returns the StoryStore of backend, one of STORE_BACKENDS.
+    """
+    assert backend in STORE_BACKENDS, f"Unknown story store {backend}, expected one of {STORE_BACKENDS}"
+    if backend == "sqlite":
+        return SQLiteStoryStore(db_path)
+    return FileStoryStore(directory)
+
+
+def migrate(source, destination):
+    """
+    Copies every story of source missing from destination. Returns (#copied, #already present).
+    """
+    copied, skipped = 0, 0
+    for story_id, payload in source.items():
+        if destination.put(story_id, payload):
+            copied += 1
+        else:
+            skipped += 1
+    return copied, skipped
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser(
+        "migrate", help="Copy the stories of one backend to another, skipping existing ones.")
+    migrate_parser.add_argument("--source", default="files", choices=STORE_BACKENDS)
+    migrate_parser.add_argument("--destination", default="sqlite", choices=STORE_BACKENDS)
+    migrate_parser.add_argument("--directory", default=STORIES_DIRECTORY,
+                                help="Directory of the files backend.")
+    migrate_parser.add_argument("--db-path", default=STORIES_DB_PATH,
+                                help="Database of the sqlite backend.")
+    args = parser.parse_args()
+
+    assert args.source != args.destination, "Source and destination must differ"
+    copied, skipped = migrate(load_story_store(args.source, args.directory, args.db_path),
+                              load_story_store(args.destination, args.directory, args.db_path))
+    print(f"Copied {copied} stories, {skipped} already existed")
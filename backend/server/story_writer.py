@@ -0,0 +1,53 @@
+"""Background writer for the form submissions.
+
+Submissions are queued from the request handlers and written by one writer thread, grouping the submissions of
+up to max_wait seconds into one StoryStore.put_many call, so the event loop never waits on the disk and the
+disk is synced once per batch rather than once per story.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from server.batching import MicroBatcher
+from server.story_store import DURABILITY_MODES
+
+
+class StoryWriter():
+    """
+    Batches story writes to a StoryStore.
+    Args:
+        store (StoryStore): where the stories are written.
+        max_batch_size (int): maximal number of stories per put_many call.
+        max_wait (float): seconds the first story of a batch waits for others to join.
+        durability (str): one of DURABILITY_MODES, "batch" syncs once per batch and "record" once per story.
+            submit returns once the story is written with this durability.
+    """
+
+    def __init__(self, store, max_batch_size=64, max_wait=0.01, durability="batch"):
+        assert durability in DURABILITY_MODES, f"Unknown durability {durability}, expected one of {DURABILITY_MODES}"
+        self.store = store
+        self.durability = durability
+        self.written = 0
+        self.duplicates = 0
+        self.batches = 0
+        # A single writer thread, batches are written in order.
+        self._batcher = MicroBatcher(self._write, max_batch_size, max_wait,
+                                     ThreadPoolExecutor(max_workers=1, thread_name_prefix="story-writer"))
+
+    def _write(self, stories, key):
+        written = self.store.put_many(stories, self.durability)
+        self.batches += 1
+        self.written += sum(written)
+        self.duplicates += len(written) - sum(written)
+        return written
+
+    async def submit(self, story_id, payload):
+        """
+        Queues one story, returns once it is written, False if story_id already existed.
+        """
+        # A submitted story is written even if its request is cancelled meanwhile.
+        return await asyncio.shield(self._batcher.submit((story_id, payload)))
+
+    def metrics(self):
+        return {"durability": self.durability, "written": self.written, "duplicates": self.duplicates,
+                "batches": self.batches, "queued": self._batcher.queued()}
@@ -0,0 +1,72 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+NOT_LOADED, LOADING, LOADED, FAILED = "not_loaded", "loading", "loaded", "failed"
+
+
+class LazyComponents():
+    """
+    Thread-safe registry of lazily loaded components, e.g. models.
+    Each component is loaded once, on its first get or by load_all, concurrent gets wait for the same load.
+
+    Usage:
+        components = LazyComponents()
+        components.register("tokenizer", lambda: GPT2Tokenizer.from_pretrained(path))
+        components.load_all()  # Optional warm-up, loads every component concurrently.
+        tokenizer = components.get("tokenizer")
+    """
+
+    def __init__(self):
+        self._loaders = {}
+        self._values = {}
+        self._status = {}
+        self._load_times = {}
+        self._locks = {}
+
+    def register(self, name, loader):
+        self._loaders[name] = loader
+        self._status[name] = NOT_LOADED
+        self._locks[name] = threading.Lock()
+
+    def get(self, name):
+        if self._status[name] == LOADED:
+            return self._values[name]
+        with self._locks[name]:
+            # Another thread might have loaded it while waiting for the lock.
+            if self._status[name] != LOADED:
+                self._status[name] = LOADING
+                start_time = time.time()
+                try:
+                    self._values[name] = self._loaders[name]()
+                except Exception:
+                    self._status[name] = FAILED
+                    raise
+                self._load_times[name] = round(time.time() - start_time, 2)
+                self._status[name] = LOADED
+                print(f"Loaded {name} in {self._load_times[name]}s")
+        return self._values[name]
+
+    def is_loaded(self, name):
+        return self._status[name] == LOADED
+
+    def load_all(self, names=None, max_workers=None):
+        """
+        Loads the names components (all by default) concurrently, returns once they are all loaded.
+        Components that fail are reported by status(), and loaded again on their next get.
+        """
+        names = list(self._loaders) if names is None else names
+        with ThreadPoolExecutor(max_workers=max_workers or len(names) or 1) as pool:
+            for name, future in [(name, pool.submit(self.get, name)) for name in names]:
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Loading {name}: {type(e)} Exception occurred")
+                    print("Exception Args:", e.args)
+
+    def status(self):
+        """
+        Returns name -> {"status": not_loaded/ loading/ loaded/ failed, "load_time": seconds once loaded}.
+        """
+        return {name: {"status": status, "load_time": self._load_times.get(name)}
+                for name, status in self._status.items()}
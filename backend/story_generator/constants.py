@@ -18,6 +18,45 @@ FINETUNED_GPT2_PATH = os.path.join(
     MAIN_DOWNLOADED_MODELS_DIR, "finetuned_saved_gpt2_medium_tales_no_prompts_191epochs/")
 PRESET_GPT2_PATH = os.path.join(
     MAIN_DOWNLOADED_MODELS_DIR, "saved_gpt2_medium/")
+# ONNX Runtime export of the fine-tuned model with KV-cache inputs, built by `python -m story_generator.model_optimization export-onnx`.
+ONNX_FINETUNED_GPT2_PATH = os.path.join(
+    MAIN_DOWNLOADED_MODELS_DIR, "onnx_finetuned_gpt2_medium/")
+# SentiWordNet polarity of every WordNet lemma, built by `python -m story_generator.sentiment_lexicon`.
+SENTIMENT_LEXICON_PATH = os.path.join(
+    MAIN_DOWNLOADED_MODELS_DIR, "sentiment_lexicon.npz")
+# Small draft model for speculative decoding, e.g. GPT2 small fine-tuned on the same tales (same tokenizer).
+DRAFT_GPT2_PATH = os.path.join(
+    MAIN_DOWNLOADED_MODELS_DIR, "finetuned_saved_gpt2_small_tales/")
+# GPT2 models optimization: "none" (fp32), "int8" (dynamically quantized linear layers, CPU)
+# or "onnx" (ONNX Runtime fine-tuned model, int8 preset model).
+MODEL_OPTIMIZATION = "none"
+
+# Unsplash dataset: photo ids and their CLIP ViT-B/32 image features, in the same order.
+UNSPLASH_DATASET_DIR = "backend/unsplash-dataset/"
+PHOTO_IDS_PATH = os.path.join(UNSPLASH_DATASET_DIR, "photo_ids.csv")
+# Fixed-width bytes array of the photo IDs, built by `python -m story_generator.image_index build-ids`.
+PHOTO_IDS_NPY_PATH = os.path.join(UNSPLASH_DATASET_DIR, "photo_ids.npy")
+PHOTO_FEATURES_PATH = os.path.join(UNSPLASH_DATASET_DIR, "features.npy")
+# L2 normalized float16 features, built by `python -m story_generator.image_index`.
+NORMALIZED_PHOTO_FEATURES_PATH = os.path.join(
+    UNSPLASH_DATASET_DIR, "features_normalized_f16.npy")
+# Photo search backend: "exact" brute force, "ivf" NumPy IVF-flat or "faiss" (faiss-cpu) approximate indexes.
+PHOTO_INDEX_BACKEND = "exact"
+IVF_INDEX_PATH = os.path.join(UNSPLASH_DATASET_DIR, "ivf_index.npz")
+IVF_FEATURES_PATH = os.path.join(UNSPLASH_DATASET_DIR, "ivf_features_f16.npy")
+FAISS_INDEX_PATH = os.path.join(UNSPLASH_DATASET_DIR, "faiss_ivfpq.index")
+# Number of IVF lists to scan per query, higher is more accurate and slower.
+IVF_NPROBE = 16
+
+# Memory budget of the CLIP text features cache, one entry is ~1KB.
+TEXT_FEATURES_CACHE_BYTES = 16 * 2**20
+
+# Sentence embedder of the Coherency ranking feature: "clip" (text encoder of the loaded CLIP model),
+# "lsa" (TF-IDF -> Truncated SVD, fitted by `python -m story_generator.sentence_embedder fit-lsa`) or "none".
+COHERENCY_EMBEDDER = "clip"
+LSA_EMBEDDER_PATH = os.path.join(MAIN_DOWNLOADED_MODELS_DIR, "lsa_embedder.joblib")
+# Memory budget of the sentence embeddings cache, one CLIP entry is ~2KB.
+SENTENCE_EMBEDDINGS_CACHE_BYTES = 32 * 2**20
 
 # Text Generation Constants.
 
@@ -27,8 +66,18 @@ GENERATION_MAX_LENGTH = 80
 TEMPERATURE = 1.05
 TOP_K = 70
 TOP_P = 0.95
+# Autocomplete with speculative decoding: DRAFT_GPT2_PATH proposes NUM_DRAFT_TOKENS tokens per fine-tuned model forward
+# pass, without changing the sampling distribution. See story_generator.speculative_decoding.
+SPECULATIVE_DECODING = False
+NUM_DRAFT_TOKENS = 4
+# Autocomplete texts end at their first sentence end after half of their max length, and generation stops once all
+# candidates ended, instead of always generating max length tokens.
+STOP_AT_SENTENCE_END = True
 # Max number of tokens to take into account during inference.
 MAX_SEQ_LEN = 550
+# Memory budget of the prompts past_key_values cache, GPT2 medium uses ~200KB per token (~100MB per full prompt).
+# Per server: the cache isn't shared, server.prefork splits it between its workers.
+PREFIX_CACHE_BYTES = 256 * 2**20
 
 # Image Styles.
 UNSPLASH_IMG_FOLDER = os.path.join("client/dist/", 'unsplash/')
@@ -46,8 +95,20 @@ ANIME_STYLE_MODEL = os.path.join(
 COMICS_STYLE_MODEL = os.path.join(
     MAIN_DOWNLOADED_MODELS_DIR, "style_comics.model")
 
+# Per style, the TransformerNet weights and the folder of its stylized images.
+STYLE_MODELS = {"sketch": SKETCH_STYLE_MODEL,
+                "anime": ANIME_STYLE_MODEL, "comics": COMICS_STYLE_MODEL}
+STYLE_IMAGES_PATHS = {"none": NONE_IMAGES_PATH, "sketch": SKETCH_IMAGES_PATH,
+                      "anime": ANIME_IMAGES_PATH, "comics": COMICS_IMAGES_PATH}
+
 IMAGE_WIDTH, IMAGE_HEIGHT = 512, 512
 IMAGE_QUALITY = 95
+# Style transfer resolution (width, height), its cost grows with the number of pixels.
+STYLE_IMAGE_SIZE = (IMAGE_WIDTH, IMAGE_HEIGHT)
+# Number of images per style model forward pass.
+STYLE_BATCH_SIZE = 4
+# Style models optimization, "none" or "int8" (static quantization calibrated on the original images, CPU only).
+STYLE_OPTIMIZATION = "none"
 # Pipeline/ Optimization.
 
 MAX_NUM_TEXTS_SAMPLES = 10
@@ -64,6 +125,13 @@ STOP_WORDS = set(get_stop_words('english'))
 MIN_WORDS_PER_STORY = 5
 FEATURES = ['Coherency', 'Readability', 'Sentiment',
             'Simplicity', 'Diversity', 'Tale_like']
+# Seconds to score the re-ranking candidates of one request, expensive features are approximated or skipped
+# when they would overrun it. None runs all features.
+RANKING_LATENCY_BUDGET = None
+# Number of generated tokens the approximate Tale_like feature compares, and number of last prompt tokens it
+# conditions the preset model on (the full feature encodes up to MAX_SEQ_LEN prompt tokens).
+TALE_LIKE_APPROXIMATE_TOKENS = 8
+TALE_LIKE_APPROXIMATE_CONTEXT = 32
 
 # 2100 unique, most frequent words in tales fine-tuning dataset, excludes named entities.
 SEVEN_PREC_MOST_FREQ_WORDS = {'six', 'month', 'drew', 'want', 'hands', 'staring', 'guests', 'goose', 'fitted', 'rope', 'grace', 'delightful', 'meg', 'peace', 'lovely', 'iron', 'dark', 'cloak', 'pictures', 'eaten', 'sake', 'hurt', 'soldiers', 'dragon', 'late', 'unusual', 'centre', 'shore', 'gloomy', 'burning', 'time', 'foreign', 'bride', 'show', 'disappeared', 'light', 'spirits', 'arose', 'larger', 'sunshine', 'paul', 'cries', 'nearest', 'refuse', 'cut', 'fun', 'naughty', 'ears', 'remember', 'filled', 'playing', 'ask', 'loud', 'suggested', 'husband', 'placed', 'proud', 'places', 'difficult', 'somebody', 'eat', 'fault', 'school', 'honor', 'maybe', 'faith', 'win', 'full', 'missed', 'big', 'pieces', 'asking', 'case', 'unto', 'wolf', 'jennings', 'color', 'riding', 'elder', 'torn', 'stay', 'monkeys', 'comes', 'largest', 'crew', 'receive', 'feast', 'vast', 'foot', 'office', 'cake', 'throughout', 'indians', 'trust', 'cheerful', 'building', 'star', 'apple', 'younger', 'henry', 'matters', 'surface', 'york', 'summer', 'nothing', 'mentioned', 'come', 'hope', 'certain', 'seized', 'folded', 'jack', 'absolutely', 'surrounded', 'noise', 'hardly', 'entrance', 'hold', 'pass', 'subject', 'three', 'coming', 'rolling', 'mouse', 'sense', 'alarmed', 'influence', 'day', 'beneath', 'ceased', 'minchin', 'wood', 'laughter', 'difficulty', 'merry', 'marionette', 'state', 'dangerous', 'fought', 'lesson', 'ones', 'upper', 'house', 'mighty', 'ever', 'fountain', 'path', 'loss', 'help', 'present', 'tore', 'beat', 'princes', 'company', 'knees', 'wilt', 'charles', 'finished', 'blame', 'doors', 'replied', 'wait', 'cruel', 'glass', 'chest', 'extraordinary', 'mad', 'explain', 'eldest', 'sank', 'shed', 'driven', 'fall', 'prove', 'rising', 'angry', 'pulling', 'field', 'grandmother', 'mysterious', 'tea', 'sought', 'natural', 'raised', 'learned', 'must', 'hook', 'cared', 'gained', 'monster', 'beth', 'nearly', 'gazing', 'heap', 'rabbit', 'monsieur', 'stars', 'said', 'soft', 'jolly', 'stiff', 'exceedingly', 'us', 'named', 'smoke', 'colia', 'hurried', 'discover', 'close', 'removed', 'explained', 'crept', 'cutting', 'sight', 'mere', 'leaf', 'world', 'witch', 'putting', 'awful', 'grandfather', 'daughters', 'mountain', 'amid', 'understood', 'whispered', 'anger', 'hole', 'hunting', 'pretended', 'evening', 'shouted', 'sword', 'animal', 'swam', 'instant', 'madame', 'chariot', 'fairy', 'eager', 'master', 'raise', 'hercules', 'splendid', 'good', 'pocket', 'betty', 'bowed', 'thanks', 'regular', 'sorry', 'showed', 'dish', 'actually', 'place', 'sperm', 'water', 'aglaya', 'needs', 'pink', 'tumbled', 'ancient', 'rosy', 'sadly', 'else', 'lighted', 'sort', 'wall', 'dreamed', 'warm', 'bid', 'elinor', 'ice', 'week', 'supper', 'wounded', 'sell', 'refused', 'cook', 'otherwise', 'shoulder', 'glanced', 'dropped', 'stand', 'pretend', 'friends', 'skin', 'keep', 'call', 'beard', 'drawn', 'drawing', 'lying', 'move', 'married', 'send', 'edward', 'possibly', 'horrid', 'think', 'courage', 'great', 'work', 'gently', 'formed', 'society', 'rather', 'amy', 'branches', 'hopes', 'precious', 'depths', 'names', 'anxious', 'saw', 'cow', 'blue', 'forgot', 'talking', 'road', 'lose', 'rajah', 'attack', 'follow', 'third', 'leaves', 'waves', 'hang', 'jo', 'fancied', 'treasure', 'head', 'whatever', 'devil', 'fully', 'buried', 'wet', 'gun', 'looked', 'brought', 'next', 'farther', 'decided', 'band', 'cheeks', 'steal', 'sent', 'tossed', 'hear', 'maiden', 'servant', 'ride', 'tiny', 'feared', 'wave', 'travelled', 'one', 'green', 'teach', 'fro', 'tell', 'cool', 'cunning', 'catch', 'merely', 'badger', 'stepped', 'shining', 'owner', 'observe', 'chanced', 'bottom', 'hero', 'heavy', 'land', 'grateful', 'strange', 'circumstances', 'dwarf', 'quick', 'miserable', 'note', 'ship', 'fallen', 'word', 'john', 'turned', 'inclined', 'rat', 'easy', 'legs', 'bring', 'empty', 'touching', 'drinking', 'bade', 'army', 'sure', 'fierce', 'presented', 'key', 'tender', 'nobody', 'directly', 'build', 'edge', 'hidden', 'experience', 'begun', 'attempt', 'miles', 'violent', 'running', 'firmly', 'kicked', 'lived', 'party', 'chamber', 'savage', 'usually', 'drove', 'concluded', 'arranged', 'baby', 'pick', 'fail', 'england', 'reading', 'wants', 'generally', 'red', 'working', 'creatures', 'flew', 'keen', 'person', 'toad', 'related', 'twelve', 'aunt', 'confidence', 'moved', 'took', 'horrible', 'leaning', 'confess', 'spring', 'standing', 'vessel', 'locked', 'scarecrow', 'drank', 'reckon', 'happen', 'received', 'group', 'lebedeff', 'sun', 'sons', 'welcome', 'youngest', 'solid', 'impossible', 'princess', 'sky', 'learning', 'tongue', 'silly', 'began', 'fell', 'following', 'upstairs', 'moon', 'twice', 'given', 'everywhere', 'together', 'bell', 'heat', 'rough', 'gentle', 'carefully', 'longer', 'months', 'none', 'delicate', 'rest', 'darted', 'say', 'alone', 'former', 'everyone', 'rested', 'paid', 'devoted', 'understand', 'nodded', 'winter', 'animals', 'o', 'camp', 'consider', 'demanded', 'odd', 'pull', 'read', 'sold', 'bite', 'innocent', 'waters', 'heard', 'rode', 'stretched', 'gay', 'peculiar', 'position', 'done', 'shoes', 'express', 'streets', 'believe', 'later', 'fact', 'sea', 'seemed', 'drops', 'heaven', 'sail', 'hunt', 'grant', 'hans', 'grave', 'private', 'pipe', 'clock', 'put', 'taught', 'travel', 'beginning', 'slightly', 'view', 'slowly', 'blew', 'kept', 'plenty', 'bought', 'mind', 'belong', 'slow', 'eggs', 'special', 'happily', 'yellow', 'two', 'due', 'clear', 'handsome', 'deeply', 'short', 'cast', 'belonged', 'bore', 'enter', 'spread', 'shut', 'fill', 'closely', 'excited', 'capable', 'arm', 'obtained', 'seven', 'earth', 'truly', 'silence', 'matter', 'box', 'prisoner', 'gates', 'approaching', 'situation', 'mamma', 'gathered', 'mile', 'lot', 'way', 'clouds', 'song', 'without', 'distant', 'shoulders', 'kiss', 'cottage', 'armed', 'within', 'trying', 'smile', 'got', 'gate', 'eagle', 'neither', 'stands', 'somewhat', 'walking', 'asked', 'stubb', 'agreed', 'forgive', 'charge', 'bad', 'sprang', 'quite', 'washed', 'tear', 'retired', 'river', 'except', 'scarcely', 'landed', 'object', 'attracted', 'cock', 'rid', 'row', 'weight', 'watch', 'many', 'solitary', 'table', 'deeper', 'whether', 'swear', 'nearer', 'touched', 'colin', 'pleased', 'dreadful', 'false', 'ozma', 'dig', 'dorothy', 'future', 'cost', 'possible', 'anybody', 'offered', 'thy', 'sitting', 'line', 'darkness', 'kissed', 'summoned', 'laying', 'led', 'spell', 'considered', 'uncle', 'accustomed', 'marriage', 'whenever', 'pay', 'died', 'treated', 'hate', 'join', 'amuse', 'cried', 'finest', 'walk', 'things', 'won', 'hastened', 'leaped', 'emerald', 'swimming', 'affection', 'pounds', 'guard', 'swung', 'desert', 'bright', 'cure', 'laughing', 'piece', 'faster', 'hair', 'older', 'indeed', 'remain', 'reason', 'various', 'stuff', 'waving', 'comfortable', 'rise', 'settled', 'fool', 'friend', 'earnestly', 'island', 'comfort', 'beloved', 'kind', 'stayed', 'tin', 'happiness', 'ground', 'liked', 'sometimes', 'ivan', 'personal', 'longed', 'thing', 'meeting', 'simple', 'always', 'hunter', 'roof', 'obey', 'hot', 'delighted', 'moment', 'struck', 'cause', 'chance', 'whole', 'discovered', 'roll', 'seat', 'kitchen', 'bottle', 'taking', 'dickon', 'important', 'young', 'forget', 'bearing', 'safe', 'soon', 'deep', 'turning', 'holy', 'pinocchio', 'repeated', 'lady', 'papa', 'ways', 'crown', 'right', 'thou', 'body', 'dog', 'somewhere', 'steps', 'clearly', 'wedding', 'grey', 'cloth', 'mine', 'character', 'kindly', 'fish', 'silk', 'amongst', 'apparently', 'thinks', 'horse', 'latter', 'dim', 'wear', 'found', 'hurry', 'distance', 'perceived', 'apples', 'appeared', 'creature', 'form', 'tired', 'acquaintance', 'pale', 'remained', 'corner', 'moving', 'five', 'bless', 'queen', 'reward', 'defarge', 'kingdom', 'hit', 'governor', 'rubbed', 'stream', 'danced', 'host', 'bull', 'pressed', 'picture', 'escaped', 'crow', 'hall', 'wishing', 'persuaded', 'turkey', 'mortal', 'difference', 'laughed', 'thank', 'hand', 'front', 'dost', 'study', 'fly', 'nest', 'inquired', 'hours', 'burned', 'fetch', 'city', 'just', 'mischief', 'gradually', 'hated', 'claim', 'telling', 'yonder', 'faint', 'papers', 'meet', 'quickly', 'smith', 'plain', 'thrust', 'ran', 'entire', 'unhappy', 'lay', 'boat', 'roared', 'forty', 'wise', 'excellent', 'listened', 'vanished', 'climbed', 'manner', 'unless', 'parents', 'gift', 'rocks', 'force', 'low', 'garden', 'door', 'much', 'gray', 'greatest', 'wretched', 'year', 'angel', 'returned', 'stuck', 'waited', 'little', 'held', 'interested', 'fiery', 'purpose', 'gazed', 'woke', 'especially', 'recovered', 'useful', 'terribly', 'sad', 'wherever', 'might', 'carriage', 'maid', 'around', 'left', 'partly', 'sensible', 'ashamed', 'ordered', 'hollow', 'last', 'value', 'may', 'notice', 'troubles', 'mountains', 'wondered', 'weather', 'night', 'remarkable', 'slip', 'grow', 'floor', 'man', 'divided', 'wizard', 'highly', 'marched', 'rose', 'climb', 'fox', 'lucy', 'becoming', 'rushing', 'however', 'acted', 'number', 'meaning', 'orders', 'means', 'step', 'mention', 'tie', 'flowers', 'forced', 'promise', 'hoped', 'let', 'lie', 'poor', 'god', 'bundle', 'sacred', 'meantime', 'either', 'evil', 'white', 'game', 'return', 'invited', 'examined', 'swallowed', 'brave', 'shone', 'doctor', 'pointed', 'leg', 'deal', 'excuse', 'greater', 'yard', 'knock', 'accepted', 'share', 'wearing', 'proved', 'leading', 'still', 'books', 'seek', 'dying', 'higher', 'lion', 'flock', 'cross', 'favorite', 'laugh', 'see', 'houses', 'painful', 'stronger', 'adventure', 'parts', 'sat', 'bread', 'appear', 'sudden', 'proper', 'reach', 'worked', 'turns', 'memory', 'among', 'appearance', 'men', 'give', 'listen', 'heels', 'keeping', 'tsar', 'better', 'lead', 'point', 'best', 'guess', 'live', 'lift', 'leaving', 'write', 'shape', 'lifted', 'intention', 'blowing', 'stories', 'woman', 'windows', 'needed', 'bird', 'thither', 'cover', 'tears', 'allowed', 'wound', 'singing', 'lower', 'suppose', 'rain', 'room', 'hour', 'trouble', 'threw', 'tells', 'tall', 'top', 'sweet', 'fighting', 'kill', 'already', 'jason', 'tree', 'united', 'behind', 'shown', 'almost', 'danger', 'native', 'delicious', 'basket', 'dermat', 'leave', 'utter', 'pleasant', 'everything', 'wrote', 'knight', 'becky', 'vain', 'believed', 'bill', 'peter', 'music', 'ka', 'address', 'prepared', 'stupid', 'perfectly', 'admit', 'played',
@@ -2,14 +2,18 @@ import story_generator.constants as constants
 
 # Text Generation
 from story_generator.ranking_utils import score_text, sort_scores
+from story_generator.speculative_decoding import speculative_generate
 import torch
 from math import ceil
+from functools import lru_cache
+from transformers.generation.stopping_criteria import StoppingCriteria, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
 
 # Text pre-processing
 import re
+from collections import namedtuple
 # Image retrieval
 import os
-import pandas as pd
 import numpy as np
 from PIL import Image
 # To download image from URL
@@ -18,6 +22,7 @@ from io import BytesIO
 
 # CLIP Image retrieval
 import clip
+from story_generator.image_index import load_photo_index, load_photo_ids
 
 
 def _preprocess_generated_text(sample, tokenizer, has_space):
@@ -32,7 +37,158 @@ def _preprocess_generated_text(sample, tokenizer, has_space):
     return re.sub(u'\uFFFD', '', decoded)
 
 
-def _sample_demo_sequence(model, tokenizer, prompts, max_length, num_return_sequences, device, first_idx=False):
+# A token ending a sentence: punctuation, optionally followed by closing quotes or brackets.
+SENTENCE_END_TOKEN_PATTERN = re.compile(r'[.!?]["\'\u201d\u2019)\]]*\s*$')
+
+
+@lru_cache(maxsize=4)
+def sentence_end_token_ids(tokenizer, vocab_size):
+    """
+    Returns the ids of the tokens that end a sentence, as a tensor. Decodes the whole vocabulary once per tokenizer.
+    """
+    return torch.tensor([token_id for token_id in range(vocab_size)
+                         if SENTENCE_END_TOKEN_PATTERN.search(tokenizer.decode([token_id]))], dtype=torch.long)
+
+
+class SentenceEndCriteria(StoppingCriteria):
+    """
+    generate stopping criteria that ends generation once every sequence ended a sentence: emitted a sentence end token
+    with at least min_length tokens (prompt included, as generate min_length), or eos.
+    Sequences end independently: truncate pads the tokens each sequence generated after its end.
+
+    Args:
+        end_token_ids (torch.Tensor): see sentence_end_token_ids.
+        prompt_length (int): number of (padded) prompt tokens of the generated sequences.
+    """
+
+    def __init__(self, end_token_ids, prompt_length, min_length, eos_token_id):
+        self.end_token_ids = end_token_ids
+        self.prompt_length = prompt_length
+        self.min_length = min_length
+        self.eos_token_id = eos_token_id
+
+    def _is_end(self, sequences):
+        generated = sequences[:, self.prompt_length:]
+        lengths = torch.arange(self.prompt_length + 1, sequences.shape[-1] + 1, device=sequences.device)
+        return ((torch.isin(generated, self.end_token_ids.to(sequences.device)) & (lengths >= self.min_length))
+                | (generated == self.eos_token_id))
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return bool(self._is_end(input_ids).any(dim=-1).all())
+
+    def has_ended(self, generated_ids):
+        """
+        Whether one sequence, given by its generated token ids, has ended.
+        """
+        return bool(self._is_end(torch.tensor([[0] * self.prompt_length + list(generated_ids)])).any())
+
+    def truncate(self, sequences, pad_token_id):
+        """
+        Returns sequences with the tokens after each sequence end replaced by pad_token_id.
+        """
+        is_end = self._is_end(sequences).long()
+        after_end = (is_end.cumsum(dim=-1) - is_end) > 0
+        return torch.cat([sequences[:, :self.prompt_length],
+                          sequences[:, self.prompt_length:].masked_fill(after_end, pad_token_id)], dim=-1)
+
+
+class CandidatesStreamer(BaseStreamer):
+    """
+    generate streamer that reports the text of each returned sequence as it is decoded.
+    The partial texts get the same cleanup as _preprocess_generated_text, and text ending with an incomplete
+    character (U+FFFD) is held back until the next token completes it.
+    With a SentenceEndCriteria (see stop_at), tokens after a sequence end are not reported, as they are not returned.
+
+    Args:
+        tokenizer (PyTorch): GPT2 tokenizer for generation.
+        has_space (bool): whether the prompt ends with a space.
+        on_text (Callable): called as on_text(sequence_idx, new_text) with the text added to a sequence.
+    """
+
+    def __init__(self, tokenizer, has_space, on_text):
+        self.tokenizer = tokenizer
+        self.has_space = has_space
+        self.on_text = on_text
+        self._prompt_skipped = False
+        self._tokens = None
+        self._sent = None
+        self._sentence_end = None
+
+    def stop_at(self, sentence_end):
+        self._sentence_end = sentence_end
+
+    def put(self, value):
+        # generate first puts the prompt ids, then the next token of each sequence per step.
+        if not self._prompt_skipped:
+            self._prompt_skipped = True
+            return
+        next_tokens = value.reshape(-1).tolist()
+        if self._tokens is None:
+            self._tokens = [[] for _ in next_tokens]
+            self._sent = ['' for _ in next_tokens]
+        for idx, token in enumerate(next_tokens):
+            if self._sentence_end is not None and self._sentence_end.has_ended(self._tokens[idx]):
+                continue
+            self._tokens[idx].append(token)
+            if self.tokenizer.decode(self._tokens[idx], skip_special_tokens=True).endswith(u'\uFFFD'):
+                continue
+            text = _preprocess_generated_text(
+                self._tokens[idx], self.tokenizer, self.has_space)
+            # Trailing spaces are stripped until followed by text, so the sent text only grows.
+            if len(text) > len(self._sent[idx]) and text.startswith(self._sent[idx]):
+                self.on_text(idx, text[len(self._sent[idx]):])
+                self._sent[idx] = text
+
+    def end(self):
+        pass
+
+
+class BatchStreamer(BaseStreamer):
+    """
+    generate streamer of a batched generate, passes the sequences of each prompt to the streamer of that prompt.
+
+    Args:
+        streamers (List<BaseStreamer>): one streamer (or None, not streamed) per prompt, in the prompts order.
+        num_return_sequences (int): number of sequences generated per prompt.
+    """
+
+    def __init__(self, streamers, num_return_sequences):
+        self.streamers = streamers
+        self.num_return_sequences = num_return_sequences
+        self._prompt_skipped = False
+
+    def stop_at(self, sentence_end):
+        for streamer in self.streamers:
+            if isinstance(streamer, CandidatesStreamer):
+                streamer.stop_at(sentence_end)
+
+    def put(self, value):
+        # The prompt ids come first, the prompt streamers skip them.
+        if not self._prompt_skipped:
+            self._prompt_skipped = True
+            for streamer in self.streamers:
+                if streamer is not None:
+                    streamer.put(value)
+            return
+        next_tokens = value.reshape(-1)
+        for prompt_idx, streamer in enumerate(self.streamers):
+            if streamer is not None:
+                streamer.put(next_tokens[prompt_idx * self.num_return_sequences:
+                                         (prompt_idx + 1) * self.num_return_sequences])
+
+    def end(self):
+        for streamer in self.streamers:
+            if streamer is not None:
+                streamer.end()
+
+
+# Per-step scores of a generate call, aligned with the returned (filtered) texts.
+# prompt_ids (1 x prompt_length), continuation_ids (#texts x generated_length), scores (#texts x generated_length x vocab_size).
+GenerationScores = namedtuple(
+    'GenerationScores', ['prompt_ids', 'continuation_ids', 'scores'])
+
+
+def _sample_demo_sequence(model, tokenizer, prompts, max_length, num_return_sequences, device, first_idx=False, return_scores=False):
     """
     One forward pass generation that ends at end of sentence mark. 
 
@@ -43,40 +199,169 @@ def _sample_demo_sequence(model, tokenizer, prompts, max_length, num_return_sequ
         max_length (int): How long the generated text should be. 
         num_return_sequences (int): Number of generated texts to return per prompt. 
         first_idx (bool): True if want to remove given prompt from the returned generation.
+        return_scores (bool): True to also return the GenerationScores of the returned texts.
 
     Returns:
         List of num_return_sequences generated texts, each with approximate length max_length.
+        If return_scores, a tuple of the texts and their GenerationScores. 
+        The scores are the processed (temperature, top-k, top-p) logits the model sampled each token from.
 
     Uses hugginface generate (https://huggingface.co/transformers/main_classes/model.html?highlight=generate#transformers.TFPreTrainedModel.generate)
     With tokenizer.padding size = left, otherwise generation is random (issue https://github.com/huggingface/transformers/issues/3021)
     """
     assert len(prompts) == 1, "Generate function assumes one prompt"
-    encodings_dict = tokenizer(
-        prompts)
+    return _sample_demo_sequences(model, tokenizer, prompts, max_length, num_return_sequences, device, first_idx, return_scores)[0]
+
+
+def _encode_prompt_prefix(model, prompt_ids, prefix_cache, device):
+    """
+    Returns the past_key_values (batch_size = 1) of all prompt tokens but the last one, generate feeds the last token itself.
+    Only the tokens after the longest prefix found in prefix_cache run through the model.
+    The cache is keyed on the truncated token ids, so when truncation shifts the window the prefix no longer matches and is recomputed.
+    """
+    tokens = tuple(prompt_ids[:-1])
+    prefix_length, past_key_values = prefix_cache.longest_prefix(tokens)
+    if prefix_length < len(tokens):
+        with torch.no_grad():
+            past_key_values = model(
+                torch.tensor([tokens[prefix_length:]],
+                             device=device, dtype=torch.long),
+                past_key_values=past_key_values,
+                position_ids=torch.arange(
+                    prefix_length, len(tokens), device=device).unsqueeze(0),
+                use_cache=True,
+            )[1]
+        # The extended prompt replaces its prefix, stories usually only grow.
+        if prefix_length:
+            prefix_cache.pop(tokens[:prefix_length])
+        prefix_cache.put(tokens, past_key_values)
+    return past_key_values
+
+
+def _batch_past_key_values(pasts, past_length, num_return_sequences):
+    """
+    Left-pads each prompt past_key_values with zeros to past_length, and repeats it num_return_sequences times.
+    The padded positions are masked by the attention mask.
+    """
+    if len(pasts) == 1:
+        # Views, no copy of the cached tensors.
+        return tuple(tuple(tensor.expand(num_return_sequences, -1, -1, -1) for tensor in layer)
+                     for layer in pasts[0])
+
+    def pad(tensor):
+        return torch.nn.functional.pad(tensor, (0, 0, past_length - tensor.shape[-2], 0))
+    return tuple(tuple(torch.cat([pad(past[layer_idx][tensor_idx]) for past in pasts]).repeat_interleave(num_return_sequences, dim=0)
+                       for tensor_idx in range(len(pasts[0][layer_idx])))
+                 for layer_idx in range(len(pasts[0])))
+
+
+def _sample_demo_sequences(model, tokenizer, prompts, max_length, num_return_sequences, device, first_idx=False, return_scores=False, prefix_cache=None, streamer=None,
+                           draft_model=None, speculative_stats=None, num_draft_tokens=constants.NUM_DRAFT_TOKENS,
+                           stop_at_sentence_end=constants.STOP_AT_SENTENCE_END):
+    """
+    Batched _sample_demo_sequence, generates for all prompts in one generate call.
+    Prompts are left-padded to the longest prompt, after truncation to the last MAX_SEQ_LEN tokens.
+    If given a PrefixCache, the prompts past_key_values are reused from previous calls with the same prompt prefix.
+    If given a streamer (e.g. CandidatesStreamer), it gets the generated tokens at every step, requires one prompt
+    unless it is a BatchStreamer.
+    If given a draft_model, generates with speculative_decoding.speculative_generate, updating speculative_stats.
+    If stop_at_sentence_end, each text ends at its first sentence end after min_length, and generation stops once all
+    texts ended (see SentenceEndCriteria), instead of always generating max_length tokens.
+
+    Returns:
+        List with the _sample_demo_sequence output per prompt, in the same order as prompts.
+    """
+    encodings_dict = tokenizer(prompts)
     # Truncates tokens from the end of the sequence.
-    sliced_inputs = [encodings_dict['input_ids'][0][-constants.MAX_SEQ_LEN:]]
-    prompts_ids = torch.tensor(
-        sliced_inputs, device=device, dtype=torch.long)
-    first_idx = len(prompts_ids[0]) if first_idx else 0
-
-    sample_outputs = model.generate(
-        prompts_ids,  # Long tensor of size (batch_size, max_prompt_length)
-        do_sample=True,  # activate top-k, top-p sampling
-        max_length=max_length+first_idx,
-        min_length=first_idx + max_length//2 if first_idx else 10,
-        top_k=constants.TOP_K,
-        top_p=constants.TOP_P,
-        temperature=constants.TEMPERATURE,
-        repetition_penalty=1.0,  # no penalty
-        num_return_sequences=num_return_sequences,
-        pad_token_id=tokenizer.pad_token_id,
-    )  # returns tensor of shape (len(prompts)*num_return_sequences x max_length)
-    has_space = prompts[0][-1].isspace()
-    generated = map(lambda sample: _preprocess_generated_text(
-        sample[first_idx:], tokenizer, has_space), sample_outputs)
-    generated = np.array(
-        list(filter(lambda sample: len(sample.strip()) > 2, generated)))
-    return generated
+    sliced_inputs = [input_ids[-constants.MAX_SEQ_LEN:]
+                     for input_ids in encodings_dict['input_ids']]
+    prompt_length = max(map(len, sliced_inputs))
+    # Left padding, pad_token_id = eos_token_id.
+    prompts_ids = torch.tensor([[tokenizer.pad_token_id] * (prompt_length - len(input_ids)) + input_ids
+                                for input_ids in sliced_inputs], device=device, dtype=torch.long)
+    attention_mask = torch.tensor([[0] * (prompt_length - len(input_ids)) + [1] * len(input_ids)
+                                   for input_ids in sliced_inputs], device=device, dtype=torch.long)
+    first_idx = prompt_length if first_idx else 0
+
+    min_length = first_idx + max_length//2 if first_idx else 10
+    generate_kwargs = {}
+    sentence_end = None
+    if stop_at_sentence_end:
+        sentence_end = SentenceEndCriteria(sentence_end_token_ids(tokenizer, model.config.vocab_size), prompt_length,
+                                           min_length, model.config.eos_token_id)
+        generate_kwargs['stopping_criteria'] = StoppingCriteriaList([sentence_end])
+    if streamer is not None:
+        assert len(prompts) == 1 or isinstance(streamer, BatchStreamer), "Streaming several prompts requires a BatchStreamer"
+        generate_kwargs['streamer'] = streamer
+        if sentence_end is not None and isinstance(streamer, (CandidatesStreamer, BatchStreamer)):
+            streamer.stop_at(sentence_end)
+    if prefix_cache is not None and min(map(len, sliced_inputs)) > 1:
+        pasts = [_encode_prompt_prefix(model, input_ids, prefix_cache, device)
+                 for input_ids in sliced_inputs]
+        generate_kwargs['past_key_values'] = _batch_past_key_values(
+            pasts, prompt_length - 1, num_return_sequences)
+
+    if draft_model is not None:
+        # Same sampling parameters as below.
+        sample_outputs = speculative_generate(
+            model, draft_model, prompts_ids, attention_mask,
+            max_length=max_length+first_idx,
+            min_length=min_length,
+            num_return_sequences=num_return_sequences,
+            pad_token_id=tokenizer.pad_token_id,
+            num_draft_tokens=num_draft_tokens,
+            output_scores=return_scores,
+            return_dict_in_generate=return_scores,
+            stats=speculative_stats,
+            **generate_kwargs,
+        )
+    else:
+        sample_outputs = model.generate(
+            prompts_ids,  # Long tensor of size (batch_size, max_prompt_length)
+            attention_mask=attention_mask,
+            do_sample=True,  # activate top-k, top-p sampling
+            max_length=max_length+first_idx,
+            min_length=min_length,
+            top_k=constants.TOP_K,
+            top_p=constants.TOP_P,
+            temperature=constants.TEMPERATURE,
+            repetition_penalty=1.0,  # no penalty
+            num_return_sequences=num_return_sequences,
+            pad_token_id=tokenizer.pad_token_id,
+            output_scores=return_scores,
+            return_dict_in_generate=return_scores,
+            **generate_kwargs,
+        )  # returns tensor of shape (len(prompts)*num_return_sequences x max_length)
+    sequences = sample_outputs.sequences if return_scores else sample_outputs
+    if sentence_end is not None:
+        # Padding is masked by KLDIV_error_from_scores and skipped when decoding.
+        sequences = sentence_end.truncate(sequences, tokenizer.pad_token_id)
+    if return_scores:
+        # Shape (len(prompts)*num_return_sequences x generated_length x vocab_size)
+        scores = torch.stack(sample_outputs.scores, dim=1)
+
+    outputs = []
+    for prompt_idx, prompt in enumerate(prompts):
+        rows = range(prompt_idx * num_return_sequences,
+                      (prompt_idx + 1) * num_return_sequences)
+        has_space = prompt[-1].isspace()
+        generated = list(map(lambda row: _preprocess_generated_text(
+            sequences[row][first_idx:], tokenizer, has_space), rows))
+        # Keep rows of non-empty samples, to align the scores with the returned texts.
+        kept_idx = [row for row, sample in zip(
+            rows, generated) if len(sample.strip()) > 2]
+        generated = np.array([sample for sample in generated if len(sample.strip()) > 2])
+        if not return_scores:
+            outputs.append(generated)
+            continue
+
+        num_pads = prompt_length - len(sliced_inputs[prompt_idx])
+        generation_scores = GenerationScores(
+            prompt_ids=prompts_ids[prompt_idx:prompt_idx + 1, num_pads:],
+            continuation_ids=sequences[kept_idx, prompt_length:],
+            scores=scores[kept_idx])
+        outputs.append((generated, generation_scores))
+    return outputs
 
 
 def encode_search_query(clip_model, device, search_query):
@@ -94,25 +379,21 @@ def encode_search_query(clip_model, device, search_query):
     return text_encoded.half()
 
 
-def find_best_matches(text_features, photo_features, photo_ids, num_images, prev_idx):
+def find_best_matches(text_features, photo_index, photo_ids, num_images, prev_idx):
     """
     Compares the text feature vector to the feature vectors of all images and finds the best matches. 
     Returns the IDs of the best matching photos.
     Code taken from https://github.com/haltakov/natural-language-image-search.
     """
-    # Compute the similarity between the search query and each photo using the Cosine similarity
-    similarities = (photo_features @ text_features.T).squeeze(1)
-
-    # Sort the photos by their similarity score
-    best_photo_idx = (-similarities).argsort()
-
-    # Get extra images ids to handle duplicates.
-    BUFFER_SIZE = 30
+    # Get extra images ids to handle duplicates, enough to skip every previous image.
+    prev_idx_set = set(prev_idx)
+    buffer_size = num_images + len(prev_idx_set)
 
-    retreived_img_idx = [photo_ids[i] for i in best_photo_idx[:BUFFER_SIZE]]
+    # Top photos by Cosine similarity with the search query, best first.
+    best_photo_idx = photo_index.top_k(text_features, buffer_size)
+    retreived_img_idx = photo_ids.take(best_photo_idx)
 
     # Check for duplicates.
-    prev_idx_set = set(prev_idx)
     duplicate_images = set(retreived_img_idx).intersection(prev_idx_set)
 
     # No duplicates.
@@ -122,53 +403,56 @@ def find_best_matches(text_features, photo_features, photo_ids, num_images, prev
     else:
         print(
             f'Retrieved a duplicate images: {duplicate_images}, trying others.')
-        unique_idx = []
-        for idx in retreived_img_idx:
-            if idx not in prev_idx_set:
-                unique_idx.append(idx)
-            if len(unique_idx) == num_images:
-                break
-        else:
-            print(
-                f'Not enough images to try, increase buffer size = {BUFFER_SIZE} to retrieve non-duplicate')
+        unique_idx = [
+            idx for idx in retreived_img_idx if idx not in prev_idx_set][:num_images]
 
     # Return the photo IDs of the best matches, without duplicates.
     return unique_idx
 
 
+def load_clip_model(device):
+    """
+    Returns the CLIP ViT-B/32 model.
+    """
+    clip_model, _ = clip.load("ViT-B/32", device=device)
+    return clip_model
+
+
 def load_clip(device):
     """
     Code taken from https://github.com/haltakov/natural-language-image-search.
+    Returns the CLIP model, the PhotoIds and the PhotoIndex of their features.
     """
-    clip_model, _ = clip.load("ViT-B/32", device=device)
+    clip_model = load_clip_model(device)
     # Load the photo IDs
-    photo_ids = pd.read_csv("backend/unsplash-dataset/photo_ids.csv")
-    photo_ids = list(photo_ids['photo_id'])
+    photo_ids = load_photo_ids()
 
-    # Load the features vectors
-    photo_features = np.load("backend/unsplash-dataset/features.npy")
+    # Memory-map the features vectors
+    photo_index = load_photo_index(device)
 
-    # Convert features to Tensors: Float32 on CPU and Float16 on GPU
-    if device == "cpu":
-        photo_features = torch.from_numpy(photo_features).float().to(device)
-    else:
-        photo_features = torch.from_numpy(photo_features).to(device)
-
-    return clip_model, photo_ids, photo_features
+    return clip_model, photo_ids, photo_index
 
 
-def search_unsplash(search_query, photo_features, photo_ids, clip_model, device, num_images=3, prv_ids=[]):
+def search_unsplash(search_query, photo_index, photo_ids, clip_model, device, num_images=3, prv_ids=[], text_features_cache=None):
     """
     Get num_images images from Unsplash
+    Args:
+        text_features_cache (SizedLRUCache): optional cache of normalized text features, keyed on the truncated query.
     """
     # Encode the search query
     # Slice from the end, according to CLIP max number of tokens.
     MAX_LENGTH = 300
-    text_features = encode_search_query(
-        clip_model, device, search_query[-MAX_LENGTH:])
+    search_query = search_query[-MAX_LENGTH:]
+    text_features = None if text_features_cache is None else text_features_cache.get(
+        search_query)
+    if text_features is None:
+        text_features = encode_search_query(
+            clip_model, device, search_query)
+        if text_features_cache is not None:
+            text_features_cache.put(search_query, text_features)
 
     # Find the best matches
-    return find_best_matches(text_features, photo_features, photo_ids, num_images, prv_ids)
+    return find_best_matches(text_features, photo_index, photo_ids, num_images, prv_ids)
 
 
 
@@ -6,6 +6,11 @@ import numpy as np
 import spacy
 from collections import Counter
 
+# End of sentence marks, with negative lookbehinds to prevent splitting on Mr. or Mrs.
+SENTENCE_END_PATTERN = re.compile(r'(?<!Mr)(?<!Mrs)[.!?;"]+')
+# A space followed by a word character.
+WORD_SPLIT_PATTERN = re.compile(r'[ ](?=[\w])')
+
 
 def clean_text(string, pattern, replacement):
     """
@@ -32,11 +37,13 @@ def split_to_sentences(text):
     Returns:
         List of sentences from text.
     """
-    # Multiple options Negative lookbehind to prevent splitting on Mr. or Mrs.
-    split_pattern = r'(?<!Mr)(?<!Mrs)[.!?;"]+'
+    text = text.strip()
     # Split on end of sentence, but keep the punctuation marks.
-    sentences = list(map(str.strip, re.sub(
-        split_pattern, r'\g<0>[cut]', text.strip()).split('[cut]')))
+    sentences, start = [], 0
+    for match in SENTENCE_END_PATTERN.finditer(text):
+        sentences.append(text[start:match.end()].strip())
+        start = match.end()
+    sentences.append(text[start:].strip())
     # If the last sentence is ''
     if len(sentences) > 1 and len(sentences[-1]) < 3:
         sentences.pop()
@@ -44,7 +51,7 @@ def split_to_sentences(text):
 
 
 def split_words(text):
-    return re.split(r'[ ](?=[\w])', text)
+    return WORD_SPLIT_PATTERN.split(text)
 
 
 def generate_prompt(nlp, example):
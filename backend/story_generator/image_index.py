@@ -0,0 +1,463 @@
+import story_generator.constants as constants
+
+import argparse
+import csv
+import os
+import time
+import numpy as np
+import torch
+
+# Optional approximate search backend.
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+
+class PhotoIndex():
+    """
+    Exact photo search backend.
+    A photo search backend implements __len__ and top_k(text_features, k), returning photo indices, best first.
+
+    CLIP image features of the Unsplash photos, memory-mapped from an L2 normalized float16 .npy file.
+    On CPU the file pages are shared read-only between worker processes, and similarities are computed chunk by chunk
+    so no float32 copy of the whole matrix is ever held in memory. On GPU the features are copied to the device once.
+
+    Attributes:
+        features: (#photos x feature_dim) np.memmap on CPU, torch.Tensor on GPU.
+        chunk_size: number of photos per similarity chunk on CPU.
+    """
+
+    def __init__(self, features, device, chunk_size=2**16):
+        self.device = torch.device(device)
+        self.chunk_size = chunk_size
+        if self.device.type == "cpu":
+            self.features = features
+        else:
+            self.features = torch.from_numpy(np.ascontiguousarray(
+                features, dtype=np.float16)).to(self.device)
+
+    @classmethod
+    def load(cls, path, device, **kwargs):
+        return cls(np.load(path, mmap_mode='r'), device, **kwargs)
+
+    def __len__(self):
+        return self.features.shape[0]
+
+    def similarities(self, text_features):
+        """
+        Cosine similarity between the normalized text_features (1 x feature_dim) and each photo, shape (#photos).
+        """
+        if self.device.type != "cpu":
+            return (self.features @ text_features.T.to(self.features.dtype)).squeeze(1)
+
+        query = text_features.float().cpu().T
+        similarities = torch.empty(len(self))
+        for start in range(0, len(self), self.chunk_size):
+            chunk = torch.from_numpy(np.asarray(
+                self.features[start:start + self.chunk_size], dtype=np.float32))
+            similarities[start:start + len(chunk)] = (chunk @ query).squeeze(1)
+        return similarities
+
+    def top_k(self, text_features, k):
+        """
+        Returns the indices of the k most similar photos, from most to least similar.
+        Uses a partial selection, O(#photos) instead of sorting the whole collection.
+        """
+        similarities = self.similarities(text_features)
+        return torch.topk(similarities, min(k, len(similarities))).indices.tolist()
+
+
+class PhotoIds():
+    """
+    Unsplash photo IDs, aligned with the photo features rows.
+    Stored as a fixed-width bytes .npy array (one row per photo, IDs are ASCII) that is memory-mapped,
+    instead of a Python list with one str object per photo.
+    Membership tests search a sorted copy of the IDs, sorted once at load.
+    """
+
+    def __init__(self, ids):
+        self.ids = ids
+        self._sorted_ids = np.sort(ids)
+
+    @classmethod
+    def load(cls, path):
+        return cls(np.load(path, mmap_mode='r'))
+
+    @classmethod
+    def from_csv(cls, csv_path):
+        """
+        Reads the photo_id column of the dataset CSV, without pandas.
+        """
+        with open(csv_path, newline='') as csv_file:
+            return cls(np.array([row['photo_id'].encode('ascii') for row in csv.DictReader(csv_file)]))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, idx):
+        return self.ids[idx].decode('ascii')
+
+    def __contains__(self, photo_id):
+        try:
+            photo_id = photo_id.encode('ascii')
+        except UnicodeEncodeError:
+            return False
+        if not photo_id or not len(self._sorted_ids):
+            return False
+        idx = min(int(np.searchsorted(self._sorted_ids, photo_id)), len(self._sorted_ids) - 1)
+        return bool(self._sorted_ids[idx] == photo_id)
+
+    def take(self, indices):
+        """
+        Returns the IDs of the photos at indices as a list of str, with one vectorized lookup.
+        """
+        return [photo_id.decode('ascii') for photo_id in self.ids[np.asarray(indices, dtype=np.int64)]]
+
+
+def build_photo_ids(csv_path, output_path, features_path=None):
+    """
+    Converts the photo IDs CSV to the memory-mapped PhotoIds .npy file.
+    If features_path is given, checks that there is one ID per features row, raises ValueError otherwise.
+    """
+    photo_ids = PhotoIds.from_csv(csv_path)
+    if features_path is not None and os.path.exists(features_path):
+        num_features = np.load(features_path, mmap_mode='r').shape[0]
+        if len(photo_ids) != num_features:
+            raise ValueError(f"{csv_path} has {len(photo_ids)} IDs but {features_path} has {num_features} rows")
+    np.save(output_path, photo_ids.ids)
+    return photo_ids
+
+
+def load_photo_ids():
+    """
+    Loads the PhotoIds built by `python -m story_generator.image_index build-ids`, or reads the CSV if not built.
+    """
+    if os.path.exists(constants.PHOTO_IDS_NPY_PATH):
+        return PhotoIds.load(constants.PHOTO_IDS_NPY_PATH)
+    return PhotoIds.from_csv(constants.PHOTO_IDS_PATH)
+
+
+def build_normalized_features(features_path, output_path, chunk_size=2**16):
+    """
+    Writes the L2 normalized float16 copy of the features at features_path, used by PhotoIndex.load.
+    Works chunk by chunk, so the collection never has to fit in memory.
+    """
+    features = np.load(features_path, mmap_mode='r')
+    normalized = np.lib.format.open_memmap(
+        output_path, mode='w+', dtype=np.float16, shape=features.shape)
+    for start in range(0, features.shape[0], chunk_size):
+        chunk = np.asarray(
+            features[start:start + chunk_size], dtype=np.float32)
+        norms = np.linalg.norm(chunk, axis=-1, keepdims=True)
+        normalized[start:start + len(chunk)] = chunk / \
+            np.maximum(norms, np.finfo(np.float32).tiny)
+    normalized.flush()
+
+
+class IVFPhotoIndex():
+    """
+    Approximate photo search backend, an inverted file index (IVF-flat) built offline with build_ivf_index.
+    Photos are clustered by spherical k-means, a query scans only the nprobe lists with the most similar centroids.
+
+    Attributes:
+        centroids: (#lists x feature_dim) normalized float32 centroids.
+        list_offsets: (#lists + 1) start of each list in list_features and list_ids.
+        list_ids: (#photos) photo index of each row of list_features.
+        list_features: (#photos x feature_dim) memory-mapped float16 features, reordered so each list is contiguous.
+        nprobe: number of lists to scan per query.
+    """
+
+    def __init__(self, centroids, list_offsets, list_ids, list_features, nprobe=constants.IVF_NPROBE):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.list_features = list_features
+        self.nprobe = nprobe
+
+    @classmethod
+    def load(cls, index_path, features_path, **kwargs):
+        index = np.load(index_path)
+        return cls(index['centroids'], index['list_offsets'], index['list_ids'],
+                   np.load(features_path, mmap_mode='r'), **kwargs)
+
+    def __len__(self):
+        return len(self.list_ids)
+
+    def top_k(self, text_features, k):
+        query = text_features.float().cpu().numpy().reshape(-1)
+        nprobe = min(self.nprobe, len(self.centroids))
+        probed = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        # Sorted, so the memory-mapped rows are read in file order.
+        rows = np.sort(np.concatenate([np.arange(self.list_offsets[i], self.list_offsets[i + 1])
+                                       for i in probed]))
+        if len(rows) == 0:
+            return []
+        similarities = np.asarray(
+            self.list_features[rows], dtype=np.float32) @ query
+        k = min(k, len(rows))
+        best = np.argpartition(-similarities, k - 1)[:k]
+        best = best[np.argsort(-similarities[best])]
+        return self.list_ids[rows[best]].tolist()
+
+
+class FaissPhotoIndex():
+    """
+    Approximate photo search backend using a faiss-cpu index (e.g. IVF-PQ) built with build_faiss_index.
+    """
+
+    def __init__(self, index, nprobe=constants.IVF_NPROBE):
+        self.index = index
+        self.index.nprobe = nprobe
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        assert faiss is not None, "FaissPhotoIndex requires faiss-cpu"
+        return cls(faiss.read_index(path), **kwargs)
+
+    def __len__(self):
+        return self.index.ntotal
+
+    def top_k(self, text_features, k):
+        query = text_features.float().cpu().numpy().reshape(1, -1)
+        _, indices = self.index.search(query, k)
+        return [i for i in indices[0].tolist() if i >= 0]
+
+
+def _spherical_kmeans(features, num_lists, num_iterations=20, seed=0, chunk_size=2**16):
+    """
+    Returns (#num_lists x feature_dim) normalized centroids, clusters by cosine similarity.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = features[rng.choice(
+        len(features), num_lists, replace=False)].copy()
+    for _ in range(num_iterations):
+        assignments = _assign_to_lists(features, centroids, chunk_size)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, features)
+        counts = np.bincount(assignments, minlength=num_lists)
+        # Re-seed empty lists with random features.
+        empty = counts == 0
+        sums[empty] = features[rng.choice(len(features), empty.sum())]
+        centroids = sums / \
+            np.maximum(np.linalg.norm(sums, axis=-1, keepdims=True),
+                       np.finfo(np.float32).tiny)
+    return centroids
+
+
+def _assign_to_lists(features, centroids, chunk_size=2**16):
+    return np.concatenate([np.argmax(np.asarray(features[start:start + chunk_size], dtype=np.float32) @ centroids.T, axis=-1)
+                           for start in range(0, len(features), chunk_size)])
+
+
+def build_ivf_index(features_path, index_path, list_features_path, num_lists=None, train_size=None, chunk_size=2**16):
+    """
+    Builds the IVFPhotoIndex files from normalized features.
+    Args:
+        num_lists (int): number of inverted lists, defaults to 4*sqrt(#photos).
+        train_size (int): number of photos k-means trains on, defaults to 64 photos per list.
+    """
+    features = np.load(features_path, mmap_mode='r')
+    num_lists = min(len(features), num_lists or max(
+        1, int(4 * np.sqrt(len(features)))))
+    train_size = min(len(features), train_size or 64 * num_lists)
+    rng = np.random.default_rng(0)
+    train_idx = np.sort(rng.choice(len(features), train_size, replace=False))
+    centroids = _spherical_kmeans(np.asarray(
+        features[train_idx], dtype=np.float32), num_lists, chunk_size=chunk_size)
+
+    assignments = _assign_to_lists(features, centroids, chunk_size)
+    list_ids = np.argsort(assignments, kind='stable')
+    list_offsets = np.concatenate(
+        [[0], np.cumsum(np.bincount(assignments, minlength=num_lists))])
+    list_features = np.lib.format.open_memmap(
+        list_features_path, mode='w+', dtype=np.float16, shape=features.shape)
+    for start in range(0, len(list_ids), chunk_size):
+        list_features[start:start + chunk_size] = features[list_ids[start:start + chunk_size]]
+    list_features.flush()
+    np.savez(index_path, centroids=centroids.astype(np.float32),
+             list_offsets=list_offsets, list_ids=list_ids)
+
+
+def build_faiss_index(features_path, index_path, num_lists=None, num_subquantizers=64):
+    """
+    Builds an IVF-PQ faiss index with inner product metric from normalized features.
+    """
+    assert faiss is not None, "build_faiss_index requires faiss-cpu"
+    features = np.load(features_path, mmap_mode='r')
+    num_lists = num_lists or max(1, int(4 * np.sqrt(len(features))))
+    index = faiss.index_factory(features.shape[1], f"IVF{num_lists},PQ{num_subquantizers}",
+                                faiss.METRIC_INNER_PRODUCT)
+    train_size = min(len(features), 64 * num_lists)
+    train_idx = np.sort(np.random.default_rng(0).choice(
+        len(features), train_size, replace=False))
+    index.train(np.asarray(features[train_idx], dtype=np.float32))
+    for start in range(0, len(features), 2**16):
+        index.add(np.asarray(features[start:start + 2**16], dtype=np.float32))
+    faiss.write_index(index, index_path)
+
+
+def load_photo_index(device, backend=constants.PHOTO_INDEX_BACKEND):
+    """
+    Loads the photo search backend, one of "exact", "ivf" or "faiss".
+    The exact backend loads the normalized features if built, otherwise memory-maps the original features (already normalized by CLIP retrieval scripts).
+    """
+    if backend == "ivf":
+        return IVFPhotoIndex.load(constants.IVF_INDEX_PATH, constants.IVF_FEATURES_PATH)
+    if backend == "faiss":
+        return FaissPhotoIndex.load(constants.FAISS_INDEX_PATH)
+    if os.path.exists(constants.NORMALIZED_PHOTO_FEATURES_PATH):
+        return PhotoIndex.load(constants.NORMALIZED_PHOTO_FEATURES_PATH, device)
+    return PhotoIndex.load(constants.PHOTO_FEATURES_PATH, device)
+
+
+# Story extracts used as image search queries by the benchmark, as the frontend sends them.
+BENCHMARK_PROMPTS = [
+    "Once upon a time, in a kingdom by the sea, there lived a poor fisherman and his wife.",
+    "The king called his three sons and said: go out into the world and bring me the finest carpet.",
+    "The Wonders of the Sun",
+    "Deep in the dark forest stood a little house made of bread, with a roof of cake and windows of sugar.",
+    "The princess sat by the well and played with her golden ball.",
+    "A frog stretched its big, ugly head out of the water.",
+    "The wolf knocked at the door of the grandmother's cottage.",
+    "Snow fell on the mountains, and the old woman shook out her feather beds.",
+    "The little mermaid swam up to the surface and saw the great ship with its lanterns.",
+    "Seven dwarfs came home from the mines in the evening and lit their seven candles.",
+    "The tailor killed seven flies with one blow and stitched the words on his belt.",
+    "The children followed the trail of white pebbles shining in the moonlight.",
+    "An old soldier walked along the road when he met a witch.",
+    "The swans flew over the sea until they saw the coast of a beautiful country.",
+    "In the middle of the garden stood a tree with golden apples.",
+    "The miller's daughter sat alone in a room full of straw and began to cry.",
+]
+
+
+def text_queries(prompts, device="cpu"):
+    """
+    Returns the normalized CLIP text features of the prompts (#prompts x feature_dim), as computed for image search.
+    """
+    # Imported here, generation_utils imports this module.
+    from story_generator.generation_utils import encode_search_query, load_clip_model
+
+    clip_model = load_clip_model(device)
+    # Same truncation as search_unsplash.
+    return torch.cat([encode_search_query(clip_model, device, prompt[-300:]) for prompt in prompts]).float().cpu()
+
+
+def synthetic_queries(features, num_queries=200, noise=0.5, seed=0):
+    """
+    Returns normalized random photo features with gaussian noise. They sit inside the photo cluster, unlike CLIP text
+    features, so approximate backends get a higher recall on them than on real queries.
+    """
+    rng = np.random.default_rng(seed)
+    queries = np.asarray(features[np.sort(rng.choice(len(features), num_queries, replace=False))],
+                         dtype=np.float32)
+    queries = queries + noise * rng.standard_normal(queries.shape) / np.sqrt(queries.shape[1])
+    return torch.from_numpy(
+        (queries / np.linalg.norm(queries, axis=-1, keepdims=True)).astype(np.float32))
+
+
+def benchmark(exact_index, approximate_indexes, queries, k=30):
+    """
+    Recall@k and mean latency of approximate backends against exact search.
+    Args:
+        exact_index (PhotoIndex): ground truth backend.
+        approximate_indexes (dict): name -> search backend.
+        queries (torch.Tensor): normalized query features (#queries x feature_dim), see text_queries.
+    Returns a dict of name -> {"recall@k", "latency_ms"}, including the exact backend.
+    """
+    def run(index):
+        start_time = time.perf_counter()
+        results = [index.top_k(query.unsqueeze(0), k) for query in queries]
+        return results, 1000 * (time.perf_counter() - start_time) / len(queries)
+
+    truth, exact_latency = run(exact_index)
+    report = {"exact": {f"recall@{k}": 1.0, "latency_ms": exact_latency}}
+    for name, index in approximate_indexes.items():
+        results, latency = run(index)
+        recall = np.mean([len(set(result) & set(expected)) / len(expected)
+                          for result, expected in zip(results, truth)])
+        report[name] = {f"recall@{k}": float(recall), "latency_ms": latency}
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    ids_parser = subparsers.add_parser(
+        "build-ids", help="Convert the photo IDs CSV to the memory-mapped .npy store.")
+    ids_parser.add_argument("--csv", default=constants.PHOTO_IDS_PATH)
+    ids_parser.add_argument("--features", default=constants.PHOTO_FEATURES_PATH,
+                            help="Features .npy file the IDs must be aligned with.")
+    ids_parser.add_argument("--output", default=constants.PHOTO_IDS_NPY_PATH)
+    normalize_parser = subparsers.add_parser(
+        "normalize", help="Write the normalized float16 features.")
+    normalize_parser.add_argument("--features", default=constants.PHOTO_FEATURES_PATH,
+                                  help="CLIP features .npy file, one row per photo id.")
+    normalize_parser.add_argument("--output", default=constants.NORMALIZED_PHOTO_FEATURES_PATH,
+                                  help="Where to write the normalized float16 features.")
+    ivf_parser = subparsers.add_parser(
+        "build-ivf", help="Build the NumPy IVF-flat index.")
+    faiss_parser = subparsers.add_parser(
+        "build-faiss", help="Build the faiss IVF-PQ index.")
+    for build_parser in (ivf_parser, faiss_parser):
+        build_parser.add_argument("--features", default=constants.NORMALIZED_PHOTO_FEATURES_PATH,
+                                  help="Normalized features .npy file.")
+        build_parser.add_argument("--num-lists", type=int, default=None,
+                                  help="Number of inverted lists, defaults to 4*sqrt(#photos).")
+    benchmark_parser = subparsers.add_parser(
+        "benchmark", help="Recall@k and latency of the built approximate indexes against exact search.")
+    benchmark_parser.add_argument("--features", default=constants.NORMALIZED_PHOTO_FEATURES_PATH,
+                                  help="Normalized features .npy file.")
+    benchmark_parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64],
+                                  help="nprobe values to benchmark.")
+    benchmark_parser.add_argument("--k", type=int, default=30)
+    benchmark_parser.add_argument("--prompts-file", default=None,
+                                  help="Text file of search queries, one per line, encoded with CLIP. "
+                                       "Defaults to a few tale extracts.")
+    benchmark_parser.add_argument("--synthetic", action="store_true",
+                                  help="Query with noisy photo features instead of CLIP text features, "
+                                       "no CLIP model needed but the recall is overstated.")
+    benchmark_parser.add_argument("--num-queries", type=int, default=200,
+                                  help="Number of synthetic queries.")
+    args = parser.parse_args()
+
+    if args.command == "build-ids":
+        photo_ids = build_photo_ids(args.csv, args.output, args.features)
+        print(f"Wrote {len(photo_ids)} photo IDs ({photo_ids.ids.dtype}) to {args.output}")
+    elif args.command == "normalize":
+        build_normalized_features(args.features, args.output)
+        print(f"Wrote normalized features to {args.output}")
+    elif args.command == "build-ivf":
+        build_ivf_index(args.features, constants.IVF_INDEX_PATH,
+                        constants.IVF_FEATURES_PATH, num_lists=args.num_lists)
+        print(f"Wrote IVF index to {constants.IVF_INDEX_PATH}")
+    elif args.command == "build-faiss":
+        build_faiss_index(args.features, constants.FAISS_INDEX_PATH,
+                          num_lists=args.num_lists)
+        print(f"Wrote faiss index to {constants.FAISS_INDEX_PATH}")
+    else:
+        approximate_indexes = {}
+        for nprobe in args.nprobe:
+            if os.path.exists(constants.IVF_INDEX_PATH):
+                approximate_indexes[f"ivf nprobe={nprobe}"] = IVFPhotoIndex.load(
+                    constants.IVF_INDEX_PATH, constants.IVF_FEATURES_PATH, nprobe=nprobe)
+            if faiss is not None and os.path.exists(constants.FAISS_INDEX_PATH):
+                approximate_indexes[f"faiss nprobe={nprobe}"] = FaissPhotoIndex.load(
+                    constants.FAISS_INDEX_PATH, nprobe=nprobe)
+        exact_index = PhotoIndex.load(args.features, "cpu")
+        if args.synthetic:
+            queries = synthetic_queries(exact_index.features, args.num_queries)
+            print(f"Queries: {len(queries)} synthetic (noisy photo features), recall is overstated")
+        else:
+            prompts = BENCHMARK_PROMPTS
+            if args.prompts_file is not None:
+                with open(args.prompts_file) as infile:
+                    prompts = [line.strip() for line in infile if line.strip()]
+            queries = text_queries(prompts)
+            print(f"Queries: {len(queries)} CLIP text features")
+        report = benchmark(exact_index, approximate_indexes, queries, k=args.k)
+        for name, result in report.items():
+            print(f"{name:>20}: recall@{args.k} = {result[f'recall@{args.k}']:.3f}, "
+                  f"latency = {result['latency_ms']:.2f}ms")
@@ -0,0 +1,108 @@
+from collections import OrderedDict
+import sys
+import threading
+
+import numpy as np
+import torch
+
+
+def sizeof(value):
+    """
+    Approximate memory of a cached value in bytes, counts tensors/ arrays data and nested tuples/ lists.
+    """
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(map(sizeof, value))
+    return sys.getsizeof(value)
+
+
+class SizedLRUCache():
+    """
+    Thread-safe least recently used cache, bounded by the total size of its keys and values.
+
+    Attributes:
+        max_bytes: least recently used entries are evicted once the total size exceeds max_bytes.
+        hits, misses, evictions: counters since creation.
+    """
+
+    def __init__(self, max_bytes, sizeof=sizeof):
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value):
+        size = self._sizeof(key) + self._sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            # Values larger than the whole cache are not cached.
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            value, size = self._entries.pop(key)
+            self.current_bytes -= size
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def info(self):
+        return {"entries": len(self._entries), "bytes": self.current_bytes, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+class PrefixCache(SizedLRUCache):
+    """
+    SizedLRUCache keyed on token id tuples, that finds the longest cached prefix of a token sequence.
+    Used to keep the past_key_values of the last prompts a model processed.
+    """
+
+    def longest_prefix(self, tokens):
+        """
+        Returns (prefix_length, value) of the longest cached key that is a prefix of tokens, or (0, None).
+        """
+        tokens = tuple(tokens)
+        with self._lock:
+            best_key = max((key for key in self._entries if key == tokens[:len(key)]),
+                           key=len, default=None)
+            if not best_key:
+                self.misses += 1
+                return 0, None
+            self.hits += 1
+            self._entries.move_to_end(best_key)
+            return len(best_key), self._entries[best_key][0]
@@ -0,0 +1,201 @@
+import story_generator.constants as constants
+from story_generator.ranking_utils import KLDIV_error_per_text
+
+import argparse
+import os
+import time
+import numpy as np
+import torch
+from transformers import GPT2Tokenizer, GPT2LMHeadModel
+from transformers.pytorch_utils import Conv1D
+
+# Optional ONNX Runtime backend, pip install optimum[onnxruntime].
+try:
+    from optimum.onnxruntime import ORTModelForCausalLM
+except ImportError:
+    ORTModelForCausalLM = None
+
+OPTIMIZATIONS = ["none", "int8", "onnx"]
+
+
+def _conv1d_to_linear(model):
+    """
+    GPT2 uses transformers Conv1D for its attention and MLP projections, replaces them in place by equivalent nn.Linear
+    so that dynamic quantization applies to them. Conv1D weights are (in_features x out_features).
+    """
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                in_features, out_features = child.weight.shape
+                linear = torch.nn.Linear(in_features, out_features)
+                linear.weight = torch.nn.Parameter(
+                    child.weight.data.t().contiguous())
+                linear.bias = child.bias
+                setattr(module, name, linear)
+    return model
+
+
+def quantize_gpt2(model):
+    """
+    Returns model with dynamically quantized int8 linear layers, weights are int8 and activations are quantized per batch.
+    Only runs on CPU.
+    """
+    model = _conv1d_to_linear(model.eval())
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def export_onnx(model_path, onnx_path):
+    """
+    Exports a GPT2 checkpoint to an ONNX Runtime model with past_key_values inputs/ outputs.
+    """
+    assert ORTModelForCausalLM is not None, "ONNX export requires optimum[onnxruntime]"
+    model = ORTModelForCausalLM.from_pretrained(
+        model_path, export=True, use_cache=True)
+    model.save_pretrained(onnx_path)
+
+
+def load_gpt2(model_path, device, optimization=constants.MODEL_OPTIMIZATION, onnx_path=None):
+    """
+    Loads a GPT2 LM model according to optimization, one of OPTIMIZATIONS.
+    Args:
+        onnx_path (str): exported ONNX model, for "onnx". Without one, the model is loaded as "int8".
+    Returns a model that supports forward passes and generate.
+    """
+    assert optimization in OPTIMIZATIONS, f"Unknown optimization {optimization}, expected one of {OPTIMIZATIONS}"
+    if optimization == "onnx" and onnx_path is not None:
+        assert ORTModelForCausalLM is not None, "ONNX Runtime models require optimum[onnxruntime]"
+        assert os.path.exists(
+            onnx_path), f"{onnx_path} not found, run `python -m story_generator.model_optimization export-onnx`"
+        return ORTModelForCausalLM.from_pretrained(onnx_path, use_cache=True,
+                                                   provider="CUDAExecutionProvider" if torch.device(device).type == "cuda" else "CPUExecutionProvider")
+
+    model = GPT2LMHeadModel.from_pretrained(model_path).eval()
+    if optimization == "none":
+        return model.to(device)
+    if torch.device(device).type != "cpu":
+        print(f"int8 dynamic quantization runs on CPU only, loading {model_path} in fp32")
+        return model.to(device)
+    return quantize_gpt2(model)
+
+
+def model_size_mb(model):
+    """
+    Size of the model parameters and buffers (including packed quantized weights) in MB.
+    """
+    if not isinstance(model, torch.nn.Module):
+        return float('nan')
+    state = model.state_dict()
+    num_bytes = 0
+    for value in state.values():
+        if isinstance(value, torch.Tensor):
+            num_bytes += value.element_size() * value.nelement()
+        elif isinstance(value, tuple):
+            # Packed params of quantized linear layers: (weight, bias).
+            num_bytes += sum(t.element_size() * t.nelement()
+                             for t in value if isinstance(t, torch.Tensor))
+    return num_bytes / 2**20
+
+
+def spearman_correlation(x, y):
+    """
+    Spearman rank correlation of two score arrays: the Pearson correlation of their ranks (ties are ranked in order).
+    """
+    x_ranks, y_ranks = np.argsort(np.argsort(x)), np.argsort(np.argsort(y))
+    return float(np.corrcoef(x_ranks, y_ranks)[0, 1])
+
+
+def compare(tokenizer, reference, optimized, reference_preset, optimized_preset, prompts, max_length=25, num_return_sequences=10, seed=0):
+    """
+    Compares an optimized fine-tuned/ preset model pair to the fp32 reference pair on prompts:
+        - Tale_like scores of the reference samples, with each pair: mean absolute difference and Spearman correlation,
+          1 if both pairs rank the samples the same.
+        - Mean KL divergence of the optimized next token distributions from the reference ones.
+        - Perplexity, under the reference model, of samples of each model (lower is closer to the reference quality).
+        - Generated tokens per second of each model.
+    Samples are generated without sentence-end stopping, so both models generate max_length tokens per sample and the
+    tokens per second compare the same amount of work.
+    """
+    from story_generator.generation_utils import _sample_demo_sequences
+
+    def generate(model):
+        torch.manual_seed(seed)
+        start_time = time.perf_counter()
+        texts = _sample_demo_sequences(model, tokenizer, prompts, max_length, num_return_sequences,
+                                       reference.device, first_idx=True, stop_at_sentence_end=False)
+        elapsed = time.perf_counter() - start_time
+        return [text for prompt_texts in texts for text in prompt_texts], len(prompts) * num_return_sequences * max_length / elapsed
+
+    def perplexity(texts):
+        encodings = tokenizer(list(texts), padding=True, return_tensors='pt')
+        input_ids = encodings['input_ids'].to(reference.device)
+        attention_mask = encodings['attention_mask'].to(reference.device)
+        with torch.no_grad():
+            logits = reference(input_ids, attention_mask=attention_mask,
+                               position_ids=(attention_mask.cumsum(-1) - 1).clamp(min=0))[0]
+        log_probs = torch.log_softmax(logits[:, :-1], dim=-1).gather(-1,
+                                                                     input_ids[:, 1:].unsqueeze(-1)).squeeze(-1)
+        mask = attention_mask[:, 1:]
+        return float(torch.exp(-(log_probs * mask).sum() / mask.sum()))
+
+    reference_texts, reference_speed = generate(reference)
+    optimized_texts, optimized_speed = generate(optimized)
+
+    # One text at a time, without padding, ONNX Runtime models take no position ids.
+    def next_token_logits(model, prompt):
+        input_ids = torch.tensor([tokenizer(prompt)['input_ids']], device=reference.device)
+        with torch.no_grad():
+            return model(input_ids)[0][0, -1]
+    reference_logits = torch.stack([next_token_logits(reference, prompt) for prompt in prompts])
+    optimized_logits = torch.stack([next_token_logits(optimized, prompt) for prompt in prompts])
+    next_token_kl = torch.nn.functional.kl_div(torch.log_softmax(optimized_logits, dim=-1),
+                                               torch.log_softmax(reference_logits, dim=-1), reduction='batchmean', log_target=True)
+
+    reference_tale_like = np.array([KLDIV_error_per_text(tokenizer, reference_preset, reference, text)
+                                    for text in reference_texts])
+    optimized_tale_like = np.array([KLDIV_error_per_text(tokenizer, optimized_preset, optimized, text)
+                                    for text in reference_texts])
+    return {
+        "tale_like_mean_abs_diff": float(np.mean(np.abs(reference_tale_like - optimized_tale_like))),
+        "tale_like_spearman": spearman_correlation(reference_tale_like, optimized_tale_like),
+        "next_token_kl": float(next_token_kl),
+        "reference_samples_perplexity": perplexity(reference_texts),
+        "optimized_samples_perplexity": perplexity(optimized_texts),
+        "reference_tokens_per_sec": reference_speed,
+        "optimized_tokens_per_sec": optimized_speed,
+        "reference_size_mb": model_size_mb(reference),
+        "optimized_size_mb": model_size_mb(optimized),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser(
+        "export-onnx", help="Export the fine-tuned model to ONNX Runtime with KV-cache inputs.")
+    compare_parser = subparsers.add_parser(
+        "compare", help="Compare Tale_like scores, sample quality and speed against fp32.")
+    compare_parser.add_argument("--optimization", default="int8", choices=OPTIMIZATIONS[1:])
+    compare_parser.add_argument("--prompts", nargs="+", default=[
+        "Once upon a time there was a little frog who lived by the river. ",
+        "The king called his three sons and said: ",
+        "Deep in the forest, the old witch"])
+    args = parser.parse_args()
+
+    if args.command == "export-onnx":
+        export_onnx(constants.FINETUNED_GPT2_PATH,
+                    constants.ONNX_FINETUNED_GPT2_PATH)
+        print(f"Exported to {constants.ONNX_FINETUNED_GPT2_PATH}")
+    else:
+        tokenizer = GPT2Tokenizer.from_pretrained(constants.TOKENIZER_PATH)
+        tokenizer.pad_token = tokenizer.eos_token
+        tokenizer.padding_side = "left"
+        report = compare(tokenizer,
+                         load_gpt2(constants.FINETUNED_GPT2_PATH, "cpu", "none"),
+                         load_gpt2(constants.FINETUNED_GPT2_PATH, "cpu", args.optimization,
+                                   onnx_path=constants.ONNX_FINETUNED_GPT2_PATH),
+                         load_gpt2(constants.PRESET_GPT2_PATH, "cpu", "none"),
+                         load_gpt2(constants.PRESET_GPT2_PATH, "cpu", "int8"),
+                         args.prompts)
+        for key, value in report.items():
+            print(f"{key:>30}: {value:.4f}")
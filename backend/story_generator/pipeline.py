@@ -1,19 +1,23 @@
 # Local imports
 import story_generator.constants as constants
-from story_generator.generation_utils import load_clip, search_unsplash, _sample_demo_sequence
-from story_generator.ranking_utils import score_text, sort_scores
+from story_generator.generation_utils import load_clip_model, search_unsplash, _sample_demo_sequences, CandidatesStreamer, BatchStreamer, sentence_end_token_ids
+from story_generator.ranking_utils import Ranker
+from story_generator.lru_cache import PrefixCache, SizedLRUCache
+from story_generator.model_optimization import load_gpt2
+from story_generator.sentence_embedder import load_sentence_embedder
+from story_generator.image_index import load_photo_index, load_photo_ids
+from story_generator.components import LazyComponents
+from story_generator.style_transfer import StyleTransfer, load_style_model
+from story_generator.speculative_decoding import SpeculativeStats
 
 # ML imports
 import torch
-from transformers import GPT2Tokenizer, GPT2LMHeadModel
+from transformers import GPT2Tokenizer
 
 # Ranking
 import numpy as np
 import time
 
-# Style Transfer
-import os
-
 
 class Pipeline():
     """
@@ -22,13 +26,15 @@ class Pipeline():
     Attributes:
         top: Number of top stories to output, after generation and ranking. 
         text_ranking: Number of topgenerated texts to keep during re-ranking.
+        model_optimization: GPT2 models optimization, "none", "int8" or "onnx" (see model_optimization.load_gpt2).
+        speculative_decoding: autocomplete with the draft model of constants.DRAFT_GPT2_PATH (see speculative_decoding).
 
     To output one default style graphical story with your prompt run:
         $ python pipline.py [free_prompts = 'The Wonders of the Sun\n']
     """
 
-    def __init__(self, top: int = constants.NUM_GENREATED_STORIES, text_ranking: int = 10):
-        start_time = time.time()
+    def __init__(self, top: int = constants.NUM_GENREATED_STORIES, text_ranking: int = 10, model_optimization: str = constants.MODEL_OPTIMIZATION,
+                 speculative_decoding: bool = constants.SPECULATIVE_DECODING):
         # Used to return the top number of stories
         self.top = top
         # To control results speed.
@@ -39,37 +45,167 @@ class Pipeline():
             "cuda" if torch.cuda.is_available() else "cpu")
         # Print device info
         print('Using device:', self._device)
-        self._tokenizer = GPT2Tokenizer.from_pretrained(
-            constants.TOKENIZER_PATH)
-        self._tokenizer.pad_token = self._tokenizer.eos_token
-        self._tokenizer.padding_side = "left"
-        # print('Loaded GPT2 Tokenizer')
 
-        self._gpt2 = GPT2LMHeadModel.from_pretrained(
-            constants.FINETUNED_GPT2_PATH)
-        self._gpt2 = self._gpt2.to(self._device)
+        # Models load lazily on first use, e.g. image requests don't wait for the GPT2 models.
+        # warm_up loads them all concurrently.
+        self._components = LazyComponents()
+        self._components.register("tokenizer", self._load_tokenizer)
+        self._components.register("gpt2", lambda: load_gpt2(constants.FINETUNED_GPT2_PATH, self._device,
+                                                            model_optimization, onnx_path=constants.ONNX_FINETUNED_GPT2_PATH))
+        # Preset model for evalutaion, only runs forward passes so it is quantized rather than exported.
+        self._components.register("preset_model", lambda: load_gpt2(constants.PRESET_GPT2_PATH, self._device,
+                                                                    "int8" if model_optimization == "onnx" else model_optimization))
+        # Speculative decoding verifies the draft tokens with the fine-tuned model past_key_values, which ONNX Runtime
+        # models keep in their own format.
+        if speculative_decoding and model_optimization == "onnx":
+            print("Speculative decoding requires a PyTorch fine-tuned model, disabled with onnx")
+            speculative_decoding = False
+        self._speculative_stats = SpeculativeStats() if speculative_decoding else None
+        if speculative_decoding:
+            self._components.register("draft_model", lambda: load_gpt2(
+                constants.DRAFT_GPT2_PATH, self._device, model_optimization))
+        # Image retreival using CLIP embeddings
+        self._components.register(
+            "clip", lambda: load_clip_model(self._device))
+        self._components.register("photo_ids", load_photo_ids)
+        self._components.register(
+            "photo_index", lambda: load_photo_index(self._device))
+        # Coherency ranking feature, embeds the candidates sentences with a cache across calls.
+        self._components.register("sentence_embedder", lambda: load_sentence_embedder(
+            constants.COHERENCY_EMBEDDER, self._clip if constants.COHERENCY_EMBEDDER == "clip" else None, self._device))
+        # Style transfer models, <style>_model.
+        for style, model_path in constants.STYLE_MODELS.items():
+            self._components.register(f"{style}_model", lambda model_path=model_path: load_style_model(
+                model_path, self._device, constants.STYLE_OPTIMIZATION, constants.STYLE_IMAGE_SIZE))
+        self._style_transfer = StyleTransfer(
+            self._model_from_str, self._device, constants.STYLE_IMAGE_SIZE, constants.STYLE_BATCH_SIZE)
+
+        # Successive autocomplete calls on the same story only encode the new tokens.
+        # ONNX Runtime models keep their own past_key_values format, so they skip the cache.
+        self._prefix_cache = None if model_optimization == "onnx" else PrefixCache(
+            constants.PREFIX_CACHE_BYTES)
+        # Repeated image requests for the same extract skip the CLIP text encoder.
+        self._text_features_cache = SizedLRUCache(
+            constants.TEXT_FEATURES_CACHE_BYTES)
+        # Re-ranking features, within constants.RANKING_LATENCY_BUDGET per request.
+        self._ranker = Ranker(constants.RANKING_LATENCY_BUDGET)
 
-        # Preset model for evalutaion
-        self._preset_model = GPT2LMHeadModel.from_pretrained(
-            constants.PRESET_GPT2_PATH)
-        self._preset_model = self._preset_model.to(self._device)
+    def _load_tokenizer(self):
+        tokenizer = GPT2Tokenizer.from_pretrained(constants.TOKENIZER_PATH)
+        tokenizer.pad_token = tokenizer.eos_token
+        tokenizer.padding_side = "left"
+        if constants.STOP_AT_SENTENCE_END:
+            # Decodes the vocabulary once, here rather than in the first request.
+            sentence_end_token_ids(tokenizer, len(tokenizer))
+        return tokenizer
 
-        # Image retreival using CLIP embeddings
-        self._clip, self._photo_ids, self._photo_features = load_clip(
-            self._device)
+    @property
+    def _tokenizer(self):
+        return self._components.get("tokenizer")
+
+    @property
+    def _gpt2(self):
+        return self._components.get("gpt2")
+
+    @property
+    def _preset_model(self):
+        return self._components.get("preset_model")
+
+    @property
+    def _draft_model(self):
+        return self._components.get("draft_model") if self._speculative_stats is not None else None
+
+    @property
+    def _clip(self):
+        return self._components.get("clip")
+
+    @property
+    def _photo_ids(self):
+        return self._components.get("photo_ids")
+
+    @property
+    def _photo_index(self):
+        return self._components.get("photo_index")
 
+    @property
+    def _sentence_embedder(self):
+        return self._components.get("sentence_embedder")
+
+    @property
+    def _sketch_model(self):
+        return self._components.get("sketch_model")
+
+    @property
+    def _anime_model(self):
+        return self._components.get("anime_model")
+
+    @property
+    def _comics_model(self):
+        return self._components.get("comics_model")
+
+    def warm_up(self, components=None):
+        """
+        Loads components (all by default) concurrently, instead of on their first use.
+        """
+        start_time = time.time()
+        self._components.load_all(components)
         print(
             f"Loading models Time : {round((time.time() - start_time), 2)}s \n")
 
+    def status(self):
+        """
+        Returns the loading status of each component, see LazyComponents.status.
+        """
+        return self._components.status()
+
+    def metrics(self):
+        """
+        Caches and ranking counters, without loading any component.
+        """
+        metrics = {"text_features_cache": self._text_features_cache.info(),
+                   "ranking": self._ranker.metrics(),
+                   "style_transfer": self._style_transfer.metrics()}
+        if self._prefix_cache is not None:
+            metrics["prefix_cache"] = self._prefix_cache.info()
+        if self._speculative_stats is not None:
+            metrics["speculative_decoding"] = self._speculative_stats.info()
+        if self._components.is_loaded("sentence_embedder") and self._sentence_embedder is not None:
+            metrics["sentence_embeddings_cache"] = self._sentence_embedder.cache.info()
+        return metrics
+
     def _model_from_str(self, chosen_style):
         """
         Args:
             chosen_style (str): one of none, comics, sketch or anime style.
-        Returns a style model instance or None if no exisiting chosen_style.
+        Returns a style model instance or None if no exisiting chosen_style. Loads only the chosen model.
+        """
+        INT_TO_MODEL = {"none": lambda: None, "comics": lambda: self._comics_model,
+                        "sketch": lambda: self._sketch_model, "anime": lambda: self._anime_model}
+        return INT_TO_MODEL.get(chosen_style, lambda: None)()
+
+    def has_photo(self, photo_id):
+        """
+        Returns True if photo_id is in the photos catalog, only those are downloaded and stylized.
+        """
+        return photo_id in self._photo_ids
+
+    def stylize_images(self, photo_ids, chosen_style):
+        """
+        Args:
+            photo_ids (List<str>): ids of retrieved images.
+            chosen_style (str): one of none, comics, sketch or anime style.
+
+        Returns the path of each image in chosen_style, images are stylized once and then read from disk.
+        Raises KeyError for photo ids that aren't in the catalog.
         """
-        INT_TO_MODEL = {"none": None, "comics": self._comics_model,
-                        "sketch": self._sketch_model, "anime": self._anime_model}
-        return INT_TO_MODEL.get(chosen_style)
+        for photo_id in photo_ids:
+            if not self.has_photo(photo_id):
+                raise KeyError(f"Unknown photo {photo_id}")
+        start_time = time.time()
+        paths = self._style_transfer.stylize(photo_ids, chosen_style)
+        print(
+            f"Style Transfer Time: {round((time.time() - start_time), 4)}s \n")
+        return paths
 
     def retrieve_images(self, extract, num_images, current_images_ids):
         """
@@ -81,47 +217,75 @@ class Pipeline():
         Returns the list of ids of the retrived, non-duplicate images.
         """
         start_time = time.time()
-        best_imgs_ids = search_unsplash(extract, self._photo_features, self._photo_ids,
-                                        self._clip, self._device, num_images, current_images_ids)
+        best_imgs_ids = search_unsplash(extract, self._photo_index, self._photo_ids,
+                                        self._clip, self._device, num_images, current_images_ids, self._text_features_cache)
         print(
             f"CLIP Time: {round((time.time() - start_time), 4)}s \n")
         return best_imgs_ids
 
-    def autocomplete_text(self, extracts, max_length, num_return_sequences, re_ranking=0):
+    def autocomplete_text(self, extracts, max_length, num_return_sequences, re_ranking=0, on_text=None):
         """
         Args:
             extracts (str): given text to continue. 
             max_length (int): generated text/s max length.
             num_return_sequences (int): number of generated texts to return. 
             re_ranking (int): number of texts to generate to be able to re-rank. 
+            on_text (Callable): if given, called as on_text(candidate_idx, new_text) while the candidates are decoded.
+                There are max(re_ranking, num_return_sequences) candidates, before filtering and ranking.
 
         Returns num_return_sequences list of generated texts, each of max_length according to given extracts.
         Might return less than num_return_sequences if some are empty/ include only \s. 
 
+        """
+        return self.autocomplete_texts([extracts], max_length, num_return_sequences, re_ranking, on_texts=[on_text])[0]
+
+    def autocomplete_texts(self, extracts_list, max_length, num_return_sequences, re_ranking=0, on_texts=None):
+        """
+        Batched autocomplete_text, generates for all extracts in one generate call.
+        Args:
+            extracts_list (List<str>): given texts to continue. 
+            max_length (int): generated text/s max length.
+            num_return_sequences (int): number of generated texts to return per extracts. 
+            re_ranking (int): number of texts to generate per extracts to be able to re-rank. 
+            on_texts (List<Callable>): optional autocomplete_text on_text (or None) per extracts.
+
+        Returns a list with the autocomplete_text output per extracts, in the same order as extracts_list.
         """
         start_time = time.time()
+        streamer = None
+        if on_texts is not None and any(on_text is not None for on_text in on_texts):
+            streamer = BatchStreamer([None if on_text is None else CandidatesStreamer(self._tokenizer, extracts[-1].isspace(), on_text)
+                                      for extracts, on_text in zip(extracts_list, on_texts)],
+                                     max(re_ranking, num_return_sequences))
         if re_ranking > num_return_sequences:
-            generated = _sample_demo_sequence(
-                self._gpt2, self._tokenizer, [extracts], max_length, re_ranking, self._device, first_idx=True)
-            # Re-rank generated stories.
-            stories_scores = np.array(list(map(lambda text: score_text(
-                text, self._tokenizer, self._preset_model, self._gpt2), generated)))
-            sorted_idx = sort_scores(stories_scores)
-            # Apply ranking and Keep best <num_return_sequences>.
+            outputs = _sample_demo_sequences(
+                self._gpt2, self._tokenizer, extracts_list, max_length, re_ranking, self._device, first_idx=True, return_scores=True,
+                prefix_cache=self._prefix_cache, streamer=streamer, draft_model=self._draft_model, speculative_stats=self._speculative_stats)
+            ranked = []
+            for generated, generation_scores in outputs:
+                # Re-rank generated stories, reusing the generation scores of the fine-tuned model.
+                sorted_idx = self._ranker.rank(
+                    generated, self._tokenizer, self._preset_model, self._gpt2, generation_scores=generation_scores,
+                    sentence_embedder=self._sentence_embedder)
+                # Apply ranking and Keep best <num_return_sequences>.
+                ranked.append(list(generated[sorted_idx])[
+                              :num_return_sequences])
             # print(
             #     f"Total Genration time with Re-Ranking Time : {round((time.time() - start_time), 2)}s \n")
-            return list(generated[sorted_idx])[:num_return_sequences]
+            return ranked
 
-        generated = list(_sample_demo_sequence(
-            self._gpt2, self._tokenizer, [extracts], max_length, num_return_sequences, self._device, first_idx=True))
+        generated = _sample_demo_sequences(
+            self._gpt2, self._tokenizer, extracts_list, max_length, num_return_sequences, self._device, first_idx=True,
+            prefix_cache=self._prefix_cache, streamer=streamer, draft_model=self._draft_model, speculative_stats=self._speculative_stats)
         # print(
         #     f"Generation Time : {round((time.time() - start_time), 2)}s \n")
-        return generated
+        return [list(texts) for texts in generated]
 
 
 if __name__ == "__main__":
     # ADD ARGS for user to change PROMPT/top
     start_time = time.time()
     storyGenerator = Pipeline()
+    storyGenerator.warm_up()
     print(
         f"Loading models Time : {round((time.time() - start_time), 2)}s \n", flush=True)
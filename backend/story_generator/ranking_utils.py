@@ -1,15 +1,10 @@
 # Sentiment score
 import story_generator.constants as constants
-# Get stem of words
-from nltk.stem import WordNetLemmatizer
-# Find synonyms, nltk.download('wordnet')
-from nltk.corpus import wordnet as wn
-# Get sentiment from SentiWordNet lexicon, nltk.download('sentiwordnet'
-from nltk.corpus import sentiwordnet as swn
-from nltk import pos_tag
+from story_generator.sentiment_lexicon import words_polarities
 
 # Readibility
 from story_generator.helper_functions import split_to_sentences, split_words
+from story_generator.text_features import extract_text_features, readability_batch, simplicity_batch, diversity_batch, coherency_batch
 import re
 
 # Diversity
@@ -18,6 +13,11 @@ from stop_words import get_stop_words
 # Extracts coherency
 from sklearn.metrics.pairwise import cosine_similarity
 
+# Features registry and latency budget
+from collections import OrderedDict, defaultdict, namedtuple
+import threading
+import time
+
 # Image difference
 import numpy as np
 from torchvision import transforms
@@ -105,30 +105,8 @@ def _sentiment_polarity(filtered_words):
     if len(filtered_words) < 2:
         return 0
 
-    POS_TAG_TO_WN = {'J': wn.ADJ, 'N': wn.NOUN, 'R': wn.ADV, 'V': wn.VERB}
-    lemmatizer = WordNetLemmatizer()
-
-    text_sentiment = []
-    tagged_words = pos_tag(filtered_words)
-
-    for word, tag in tagged_words:
-        wn_tag = POS_TAG_TO_WN.get(tag[0], None)
-        if not wn_tag:
-            continue
-
-        lemma = lemmatizer.lemmatize(word, pos=wn_tag)
-        if not lemma:
-            continue
-
-        synsets = wn.synsets(lemma, pos=wn_tag)
-        if not synsets:
-            continue
-
-        # Take the most common of the synthsets
-        synset = synsets[0]
-        pos_sentiment = swn.senti_synset(synset.name()).pos_score(
-        ) - swn.senti_synset(synset.name()).neg_score()
-        text_sentiment.append(pos_sentiment)
+    # Tagger, lemmas and synset polarities are loaded once and memoized, see sentiment_lexicon.
+    text_sentiment = words_polarities(filtered_words)
     return 0 if not text_sentiment else max(int(np.mean(text_sentiment)*100), 0)
 
 
@@ -185,7 +163,340 @@ def KLDIV_error_per_text(tokenizer, preset_model, finetuned_model, text):
     return loss_fct(logSoftmax(logists_preset), softmax(logits_finetuned)).item()
 
 
-def score_text(text, tokenizer, preset_model, finetuned_model):
+def _encode_batch(tokenizer, texts, device):
+    """
+    Tokenizes texts into one left-padded batch.
+    Returns input_ids, attention_mask and position_ids tensors of shape (#texts x max_text_length).
+    Position ids start at the first non-padded token, so padding doesn't shift the model predictions.
+    """
+    encodings_dict = tokenizer(
+        list(texts), padding=True, return_tensors='pt')
+    input_ids = encodings_dict['input_ids'].to(device)
+    attention_mask = encodings_dict['attention_mask'].to(device)
+    position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+    return input_ids, attention_mask, position_ids
+
+
+def _KLDIV_per_sequence(input_logits, target_logits, attention_mask):
+    """
+    Vectorized equivalent of KLDivLoss(reduction='batchmean') applied separately per sequence with batch_size = 1.
+    Args:
+        input_logits (torch.Tensor): logits of shape (#texts x text_length x vocab_size), used as the input distribution.
+        target_logits (torch.Tensor): logits of the same shape, used as the target distribution, may include -inf.
+        attention_mask (torch.Tensor): 1 for tokens, 0 for padding, shape (#texts x text_length).
+    Returns a tensor of shape (#texts) with the summed KL divergence over the non-padded tokens.
+    """
+    log_input = torch.log_softmax(input_logits, dim=-1)
+    target = torch.softmax(target_logits, dim=-1)
+    # xlogy returns 0 where target == 0, sum over vocabulary, shape (#texts x text_length).
+    kl_per_token = (torch.xlogy(target, target) - target * log_input).sum(dim=-1)
+    return (kl_per_token * attention_mask).sum(dim=-1)
+
+
+def KLDIV_error_from_scores(preset_model, prompt_ids, continuation_ids, finetuned_scores, eos_token_id):
+    """
+    KLDIV_error_per_batch that reuses the fine-tuned model scores computed during generation, so only the preset_model runs.
+    The prompt is encoded once and its cache is shared by all continuations.
+
+    Args:
+        preset_model (Pytorch model): preset GPT2 model.
+        prompt_ids (torch.Tensor): the prompt the continuations were generated from, shape (1 x prompt_length).
+        continuation_ids (torch.Tensor): generated tokens, shape (#texts x generated_length).
+        finetuned_scores (torch.Tensor): per step scores of the fine-tuned model, shape (#texts x generated_length x vocab_size).
+        eos_token_id (int): tokens after the first eos are padding.
+    Returns:
+        np.array of shape (#texts).
+    """
+    num_texts, generated_length = continuation_ids.shape
+    if num_texts == 0:
+        return np.zeros(0)
+    # Mask tokens after the first eos, the eos itself is kept.
+    is_eos = (continuation_ids == eos_token_id).long()
+    attention_mask = ((is_eos.cumsum(dim=-1) - is_eos) == 0).long()
+
+    with torch.no_grad():
+        prompt_outputs = preset_model(prompt_ids, use_cache=True)
+        prompt_logits, past_key_values = prompt_outputs[0], prompt_outputs[1]
+        # Share the prompt cache for all continuations, shape (num_texts x num_heads x prompt_length x head_dim).
+        past_key_values = tuple(tuple(tensor.expand(num_texts, -1, -1, -1) for tensor in layer)
+                                for layer in past_key_values)
+        prompt_length = prompt_ids.shape[-1]
+        continuation_logits = preset_model(
+            continuation_ids,
+            past_key_values=past_key_values,
+            attention_mask=torch.cat(
+                [attention_mask.new_ones(num_texts, prompt_length), attention_mask], dim=-1),
+        )[0]
+        # Step i predicts continuation token i: the last prompt position, then all but the last continuation position.
+        logits_preset = torch.cat([prompt_logits[:, -1:].expand(num_texts, -1, -1),
+                                   continuation_logits[:, :-1]], dim=1)
+        return _KLDIV_per_sequence(logits_preset, finetuned_scores, attention_mask).cpu().numpy()
+
+
+def KLDIV_error_per_batch(tokenizer, preset_model, finetuned_model, texts):
+    """
+    Batched version of KLDIV_error_per_text: one padded forward pass per model for all texts.
+
+    Args:
+        tokenizer (Pytroch tokenizer): GPT2 Byte Tokenizer with a pad token.
+        preset_model (Pytorch model): preset GPT2 model of the same/ different size of the finetuned model.
+        finetuned_model (Pytorch model): fine-tuned GPT2 model.
+        texts (list): generated texts to check predictions scores for.
+    Returns:
+        np.array of shape (#texts), same values as KLDIV_error_per_text per text.
+    """
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    texts = [' '.join(text) if isinstance(text, (list, np.ndarray))
+             else text for text in texts]
+    errors = np.zeros(len(texts))
+    # Too short texts keep a 0 score.
+    valid_idx = [i for i, text in enumerate(texts) if len(text) >= 10]
+    if not valid_idx:
+        return errors
+
+    input_ids, attention_mask, position_ids = _encode_batch(
+        tokenizer, [texts[i] for i in valid_idx], device)
+    with torch.no_grad():
+        logits_preset = preset_model(
+            input_ids, attention_mask=attention_mask, position_ids=position_ids)[0]
+        logits_finetuned = finetuned_model(
+            input_ids, attention_mask=attention_mask, position_ids=position_ids)[0]
+        errors[valid_idx] = _KLDIV_per_sequence(
+            logits_preset, logits_finetuned, attention_mask).cpu().numpy()
+    return errors
+
+
+# Ranking features cost classes.
+CPU_LEXICAL = "cpu_lexical"
+MODEL_FORWARD = "model_forward"
+
+# A ranking feature, compute(RankingInputs) returns a np.array of one score per text.
+#   cost: CPU_LEXICAL or MODEL_FORWARD, cheaper features run first.
+#   weight: weight of the feature in sort_scores.
+#   approximate: optional cheaper compute, used instead of compute when the latency budget is short.
+#       May return None when no approximation applies to the inputs.
+RankingFeature = namedtuple(
+    'RankingFeature', ['name', 'cost', 'weight', 'compute', 'approximate'])
+
+# Everything the features of a batch of candidates need. text_features are the shared text_features.TextFeatures.
+RankingInputs = namedtuple('RankingInputs', ['texts', 'text_features', 'tokenizer', 'preset_model', 'finetuned_model',
+                                             'generation_scores', 'sentence_embedder'])
+
+# Feature name -> RankingFeature, in the columns order of the scores matrix (constants.FEATURES).
+FEATURE_REGISTRY = OrderedDict()
+
+
+def register_feature(name, cost, weight=1.0, approximate=None):
+    """
+    Decorator that adds compute(RankingInputs) -> np.array to FEATURE_REGISTRY.
+    """
+    assert cost in (CPU_LEXICAL, MODEL_FORWARD), f"Unknown cost class {cost}"
+
+    def register(compute):
+        FEATURE_REGISTRY[name] = RankingFeature(
+            name, cost, weight, compute, approximate)
+        return compute
+    return register
+
+
+# The CLIP embedder runs a text encoder forward pass per sentence, the LSA one is lexical.
+@register_feature('Coherency', MODEL_FORWARD if constants.COHERENCY_EMBEDDER == "clip" else CPU_LEXICAL)
+def _coherency_feature(inputs):
+    # Left at 0 without a sentence_embedder.
+    if inputs.sentence_embedder is None:
+        return np.zeros(len(inputs.texts))
+    return coherency_batch(inputs.text_features, inputs.sentence_embedder)
+
+
+@register_feature('Readability', CPU_LEXICAL)
+def _readability_feature(inputs):
+    return readability_batch(inputs.text_features)
+
+
+@register_feature('Sentiment', CPU_LEXICAL)
+def _sentiment_feature(inputs):
+    return np.array([_sentiment_polarity(feature.filtered_words) for feature in inputs.text_features], dtype=float)
+
+
+@register_feature('Simplicity', CPU_LEXICAL)
+def _simplicity_feature(inputs):
+    return simplicity_batch(inputs.text_features)
+
+
+@register_feature('Diversity', CPU_LEXICAL)
+def _diversity_feature(inputs):
+    return diversity_batch(inputs.text_features)
+
+
+def _tale_like_prefix(inputs):
+    """
+    Tale_like over the first constants.TALE_LIKE_APPROXIMATE_TOKENS generated tokens only, with the preset model seeing
+    the last constants.TALE_LIKE_APPROXIMATE_CONTEXT prompt tokens only. Requires the generation scores.
+    """
+    generation_scores = inputs.generation_scores
+    if generation_scores is None:
+        return None
+    num_tokens = constants.TALE_LIKE_APPROXIMATE_TOKENS
+    # The prompt forward pass dominates on long stories, the fine-tuned scores keep their full context.
+    prompt_ids = generation_scores.prompt_ids[:, -constants.TALE_LIKE_APPROXIMATE_CONTEXT:]
+    tale_like = KLDIV_error_from_scores(inputs.preset_model, prompt_ids,
+                                        generation_scores.continuation_ids[:, :num_tokens],
+                                        generation_scores.scores[:, :num_tokens], inputs.tokenizer.eos_token_id)
+    tale_like[[len(text) < 10 for text in inputs.texts]] = 0
+    return tale_like
+
+
+@register_feature('Tale_like', MODEL_FORWARD, approximate=_tale_like_prefix)
+def _tale_like_feature(inputs):
+    # The bigger differene, the more tale-like, similar to the fine-tuned model, the text is.
+    if inputs.generation_scores is None:
+        return KLDIV_error_per_batch(inputs.tokenizer, inputs.preset_model, inputs.finetuned_model, inputs.texts)
+    generation_scores = inputs.generation_scores
+    tale_like = KLDIV_error_from_scores(inputs.preset_model, generation_scores.prompt_ids, generation_scores.continuation_ids,
+                                        generation_scores.scores, inputs.tokenizer.eos_token_id)
+    # Too short texts keep a 0 score, as in KLDIV_error_per_text.
+    tale_like[[len(text) < 10 for text in inputs.texts]] = 0
+    return tale_like
+
+
+assert list(FEATURE_REGISTRY) == constants.FEATURES, "Features must be registered in constants.FEATURES order"
+
+
+class LatencyHistogram():
+    """
+    Thread-safe histogram of latencies in seconds, with log spaced buckets from 10us to 100s.
+    """
+    BUCKETS = np.logspace(-5, 2, 57)
+
+    def __init__(self):
+        self.counts = np.zeros(len(self.BUCKETS) + 1, dtype=np.int64)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self.counts[np.searchsorted(self.BUCKETS, seconds)] += 1
+
+    def percentile(self, q):
+        """
+        Upper bound of the q-th percentile, None before the first record.
+        """
+        total = self.counts.sum()
+        if not total:
+            return None
+        bucket = np.searchsorted(np.cumsum(self.counts), q / 100 * total)
+        return float(self.BUCKETS[min(bucket, len(self.BUCKETS) - 1)])
+
+    def summary(self):
+        return {"count": int(self.counts.sum()), "p50": self.percentile(50), "p90": self.percentile(90),
+                "p99": self.percentile(99)}
+
+
+class Ranker():
+    """
+    Scores candidates with the registered ranking features, keeping within a latency budget.
+    Features run cheapest cost class first. Before each feature, its latency is estimated from its histogram of
+    seconds per text (p90) and, if it would overrun the remaining budget, its approximation runs instead, or the
+    feature is skipped. Skipped features score 0 for all texts, which doesn't change the ranking.
+
+    Attributes:
+        latency_budget: seconds to score one batch of candidates, None to always run all features.
+        features: RankingFeature list, defaults to FEATURE_REGISTRY in constants.FEATURES order.
+        histograms: name -> LatencyHistogram of seconds per text, approximations are named "<name>~approximate".
+        decisions: name -> counts of "full", "approximate" and "skipped" runs.
+    """
+
+    def __init__(self, latency_budget=constants.RANKING_LATENCY_BUDGET, features=None):
+        self.latency_budget = latency_budget
+        self.features = list(
+            FEATURE_REGISTRY.values()) if features is None else features
+        self.histograms = defaultdict(LatencyHistogram)
+        self.decisions = {feature.name: {"full": 0, "approximate": 0, "skipped": 0}
+                          for feature in self.features}
+        # Batches are scored concurrently from the inference threads.
+        self._lock = threading.Lock()
+
+    def _estimate(self, name, num_texts):
+        per_text = self.histograms[name].percentile(90) if name in self.histograms else None
+        # Unknown latencies are measured on the first run.
+        return 0 if per_text is None else per_text * num_texts
+
+    def _run(self, name, compute, inputs):
+        start_time = time.perf_counter()
+        scores = compute(inputs)
+        if scores is not None:
+            with self._lock:
+                histogram = self.histograms[name]
+            histogram.record(
+                (time.perf_counter() - start_time) / len(inputs.texts))
+        return scores
+
+    def score(self, texts, tokenizer, preset_model, finetuned_model, generation_scores=None, sentence_embedder=None):
+        """
+        Same arguments as score_texts, returns the scores np.array of shape (#texts x #features).
+        """
+        start_time = time.perf_counter()
+        texts = [' '.join(text) if isinstance(text, list)
+                 else str(text) for text in texts]
+        scores = np.zeros((len(texts), len(self.features)))
+        if not texts:
+            return scores
+        inputs = RankingInputs(texts, [extract_text_features(text) for text in texts], tokenizer, preset_model,
+                               finetuned_model, generation_scores, sentence_embedder)
+
+        order = sorted(range(len(self.features)),
+                       key=lambda i: self.features[i].cost == MODEL_FORWARD)
+        for i in order:
+            feature = self.features[i]
+            remaining = np.inf if self.latency_budget is None else self.latency_budget - \
+                (time.perf_counter() - start_time)
+            feature_scores, decision = None, "skipped"
+            if self._estimate(feature.name, len(texts)) <= remaining:
+                feature_scores, decision = self._run(
+                    feature.name, feature.compute, inputs), "full"
+            elif feature.approximate is not None and self._estimate(f"{feature.name}~approximate", len(texts)) <= remaining:
+                feature_scores = self._run(
+                    f"{feature.name}~approximate", feature.approximate, inputs)
+                decision = "skipped" if feature_scores is None else "approximate"
+            if feature_scores is not None:
+                scores[:, i] = feature_scores
+            with self._lock:
+                self.decisions[feature.name][decision] += 1
+        return scores
+
+    def rank(self, texts, tokenizer, preset_model, finetuned_model, generation_scores=None, sentence_embedder=None):
+        """
+        Returns the indices of texts from best to worst, according to the weighted features.
+        """
+        return sort_scores(self.score(texts, tokenizer, preset_model, finetuned_model, generation_scores, sentence_embedder),
+                           weights=[feature.weight for feature in self.features])
+
+    def metrics(self):
+        with self._lock:
+            decisions = {name: dict(counts) for name, counts in self.decisions.items()}
+            histograms = list(self.histograms.items())
+        return {"latency_budget": self.latency_budget, "decisions": decisions,
+                "latency_per_text": {name: histogram.summary() for name, histogram in histograms}}
+
+
+def score_texts(texts, tokenizer, preset_model, finetuned_model, generation_scores=None, sentence_embedder=None):
+    """ Batched score_text, runs all the registered features, with one forward pass per model for all texts.
+
+    Args:
+        texts (list/ np.array): stories to rank, each a str/ List[str].
+        tokenizer (Pytroch tokenizer): GPT2 Byte Tokenizer.
+        preset_model (Pytorch model): preset GPT2 model of the same/ different size of the finetuned model.
+        finetuned_model (Pytorch model): fine-tuned GPT2 model.
+        generation_scores (GenerationScores): fine-tuned model scores from generating texts. 
+            If given, Tale_like reuses them and only preset_model runs a forward pass.
+        sentence_embedder (sentence_embedder.SentenceEmbedder): embeds sentences for Coherency, which is 0 if not given.
+
+    Returns a scores np.array of shape (#texts x #ranking_features), as expected by sort_scores.
+    """
+    return Ranker(latency_budget=None).score(texts, tokenizer, preset_model, finetuned_model, generation_scores, sentence_embedder)
+
+
+def score_text(text, tokenizer, preset_model, finetuned_model, sentence_embedder=None):
     """ Uses rule-based rankings. Higher is better, but different features have different scales.
 
     Args:
@@ -193,46 +504,24 @@ def score_text(text, tokenizer, preset_model, finetuned_model):
         tokenizer (Pytroch tokenizer): GPT2 Byte Tokenizer. 
         preset_model (Pytorch model): preset GPT2 model of the same/ different size of the finetuned model. 
         finetuned_model (Pytorch model): fine-tuned GPT2 model. 
+        sentence_embedder (sentence_embedder.SentenceEmbedder): embeds sentences for Coherency, which is 0 if not given.
 
     Returns a scores np.array of corresponding to text.
     """
     assert isinstance(
         text, (str, list)), f"score_text accepts type(text) = str/list, but got {type(text)}"
 
-    if isinstance(text, list):
-        text = ' '.join(text)
-
-    # Keep same order as in constants.FEATURES
-    scores = [0 for _ in range(len(constants.FEATURES))]
-    texts_sentences = split_to_sentences(text)
-    # scores[0] = _coherency(texts_sentences, lsa_embedder)
-    scores[1] = _readabilty(text, texts_sentences)
-
-    # Set of text words without punctuation and stop words.
-    filtered_words = list(filter(
-        lambda word: word not in constants.STOP_WORDS, split_words(text.lower().strip())))
-    filtered_words_set = set(filtered_words)
-    # Sentiment.
-    scores[2] = _sentiment_polarity(filtered_words)
-
-    # Set based measures.
-    scores[3], scores[4] = _simplicity(filtered_words_set), _diversity(
-        filtered_words, filtered_words_set)
-
-    # The bigger differene, the more tale-like, similar to the fine-tuned model, the text is.
-    scores[5] = KLDIV_error_per_text(
-        tokenizer, preset_model, finetuned_model, text)
-
     # print(" | ".join(f'{key}: {score:.2f}' for key,
     #                  score in zip(constants.FEATURES, scores)))
 
-    return np.array(scores)
+    return score_texts([text], tokenizer, preset_model, finetuned_model, sentence_embedder=sentence_embedder)[0]
 
 
-def sort_scores(stories_scores):
+def sort_scores(stories_scores, weights=None):
     """
     Args:
         stories_scores (np.array): 2D matrix of shpae (#stories x #ranking_features).
+        weights (list): optional weight per feature, features contribute equally by default.
     Returns the indices of top stories accroding to scores, from highest to lowest (descending).
     """
     # Rescale each feature column across all stories, so that all featues contribute equally.
@@ -245,8 +534,8 @@ def sort_scores(stories_scores):
     stories_scores_normalized = np.divide(
         stories_scores_normalized, min_max_denominator, out=np.zeros_like(stories_scores_normalized), where=min_max_denominator != 0)
 
-    # Sort by mean story score, shape: (num_stories)
-    return np.argsort(np.mean(stories_scores_normalized, axis=1))[::-1]
+    # Sort by (weighted) mean story score, shape: (num_stories)
+    return np.argsort(np.average(stories_scores_normalized, axis=1, weights=weights))[::-1]
 
 
 if __name__ == "__main__":
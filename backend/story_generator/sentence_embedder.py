@@ -0,0 +1,131 @@
+import story_generator.constants as constants
+from story_generator.helper_functions import split_to_sentences
+from story_generator.lru_cache import SizedLRUCache
+
+from abc import ABC, abstractmethod
+import argparse
+import os
+import numpy as np
+import torch
+
+# LSA embedder
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.decomposition import TruncatedSVD
+from sklearn.pipeline import make_pipeline
+import joblib
+
+# CLIP text encoder
+import clip
+
+EMBEDDERS = ["none", "clip", "lsa"]
+
+
+class SentenceEmbedder(ABC):
+    """
+    Maps sentences to unit norm vectors, with the vectors of recently seen sentences cached.
+    Subclasses implement _encode(sentences) -> np.array of shape (#sentences x dim).
+
+    Calling the embedder on a list of sentences returns their np.array of shape (#sentences x dim),
+    only the sentences that are not cached are encoded, in one batch.
+    """
+
+    def __init__(self, cache_bytes=constants.SENTENCE_EMBEDDINGS_CACHE_BYTES):
+        self.cache = SizedLRUCache(cache_bytes)
+
+    @abstractmethod
+    def _encode(self, sentences):
+        """
+        Returns the np.array of shape (#sentences x dim) of the sentences vectors, not necessarily unit norm.
+        """
+
+    def __call__(self, sentences):
+        embeddings = {sentence: self.cache.get(sentence)
+                      for sentence in sentences}
+        missing = [sentence for sentence,
+                   embedding in embeddings.items() if embedding is None]
+        if missing:
+            encoded = np.asarray(self._encode(missing), dtype=np.float32)
+            norms = np.linalg.norm(encoded, axis=1, keepdims=True)
+            # Empty sentences might be encoded to 0, keep them at 0 similarity to everything.
+            encoded = np.divide(encoded, norms, out=np.zeros_like(
+                encoded), where=norms != 0)
+            for sentence, embedding in zip(missing, encoded):
+                embeddings[sentence] = embedding
+                self.cache.put(sentence, embedding)
+        return np.stack([embeddings[sentence] for sentence in sentences]) if sentences else np.zeros((0, 0), dtype=np.float32)
+
+
+class CLIPSentenceEmbedder(SentenceEmbedder):
+    """
+    Uses the text encoder of the CLIP model loaded for image retrieval, sentences are truncated to its 77 tokens context.
+    """
+
+    def __init__(self, clip_model, device, cache_bytes=constants.SENTENCE_EMBEDDINGS_CACHE_BYTES):
+        super().__init__(cache_bytes)
+        self._clip = clip_model
+        self._device = device
+
+    def _encode(self, sentences):
+        with torch.no_grad():
+            return self._clip.encode_text(clip.tokenize(sentences, truncate=True).to(self._device)).float().cpu().numpy()
+
+
+class LSASentenceEmbedder(SentenceEmbedder):
+    """
+    Latent semantic analysis, TF-IDF -> Truncated SVD sklearn pipeline fitted on tales sentences.
+    """
+
+    def __init__(self, lsa, cache_bytes=constants.SENTENCE_EMBEDDINGS_CACHE_BYTES):
+        super().__init__(cache_bytes)
+        self._lsa = lsa
+
+    @classmethod
+    def fit(cls, sentences, n_components=100):
+        lsa = make_pipeline(TfidfVectorizer(stop_words='english', sublinear_tf=True),
+                            TruncatedSVD(n_components=n_components, random_state=0))
+        lsa.fit(sentences)
+        return cls(lsa)
+
+    @classmethod
+    def load(cls, path=constants.LSA_EMBEDDER_PATH):
+        assert os.path.exists(
+            path), f"{path} not found, run `python -m story_generator.sentence_embedder fit-lsa`"
+        return cls(joblib.load(path))
+
+    def save(self, path=constants.LSA_EMBEDDER_PATH):
+        joblib.dump(self._lsa, path)
+
+    def _encode(self, sentences):
+        return self._lsa.transform(sentences)
+
+
+def load_sentence_embedder(embedder=constants.COHERENCY_EMBEDDER, clip_model=None, device="cpu"):
+    """
+    Returns the sentence embedder used for the Coherency ranking feature, one of EMBEDDERS, or None for "none".
+    """
+    assert embedder in EMBEDDERS, f"Unknown embedder {embedder}, expected one of {EMBEDDERS}"
+    if embedder == "clip":
+        assert clip_model is not None, "The clip embedder requires the loaded CLIP model"
+        return CLIPSentenceEmbedder(clip_model, device)
+    if embedder == "lsa":
+        return LSASentenceEmbedder.load()
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    fit_parser = subparsers.add_parser(
+        "fit-lsa", help="Fit the TF-IDF -> Truncated SVD embedder on the sentences of a text corpus.")
+    fit_parser.add_argument("corpus", help="Text file, e.g. the tales fine-tuning dataset.")
+    fit_parser.add_argument("--n_components", type=int, default=100)
+    fit_parser.add_argument("--output", default=constants.LSA_EMBEDDER_PATH)
+    args = parser.parse_args()
+
+    with open(args.corpus, encoding="utf-8") as corpus:
+        sentences = [sentence for line in corpus for sentence in split_to_sentences(line)
+                     if len(sentence) > 2]
+    embedder = LSASentenceEmbedder.fit(sentences, args.n_components)
+    embedder.save(args.output)
+    print(f"Fitted on {len(sentences)} sentences, saved to {args.output}")
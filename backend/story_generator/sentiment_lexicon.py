@@ -0,0 +1,153 @@
+import story_generator.constants as constants
+
+# Find synonyms, nltk.download('wordnet')
+from nltk.corpus import wordnet as wn
+# Get sentiment from SentiWordNet lexicon, nltk.download('sentiwordnet')
+from nltk.corpus import sentiwordnet as swn
+from nltk.stem import WordNetLemmatizer
+from nltk.tag import PerceptronTagger
+
+from functools import lru_cache
+import argparse
+import os
+import threading
+import numpy as np
+
+# wn.ADJ, wn.NOUN, wn.ADV, wn.VERB, spelled out so that importing doesn't load the WordNet corpus.
+POS_TAG_TO_WN = {'J': 'a', 'N': 'n', 'R': 'r', 'V': 'v'}
+
+_lemmatizer = WordNetLemmatizer()
+_tagger = None
+_lexicon = None
+_load_lock = threading.Lock()
+
+
+def pos_tag(words):
+    """
+    Same tags as nltk.pos_tag(words), with the perceptron tagger loaded once instead of per call.
+    """
+    global _tagger
+    if _tagger is None:
+        with _load_lock:
+            if _tagger is None:
+                _tagger = PerceptronTagger()
+    return _tagger.tag(words)
+
+
+@lru_cache(maxsize=2**16)
+def lemmatize(word, wn_tag):
+    return _lemmatizer.lemmatize(word, pos=wn_tag)
+
+
+@lru_cache(maxsize=2**16)
+def synset_polarity(lemma, wn_tag):
+    """
+    Positive minus negative SentiWordNet score of the most common synset of lemma, or None if lemma has no synsets.
+    """
+    synsets = wn.synsets(lemma, pos=wn_tag)
+    if not synsets:
+        return None
+    # Take the most common of the synthsets
+    senti_synset = swn.senti_synset(synsets[0].name())
+    return senti_synset.pos_score() - senti_synset.neg_score()
+
+
+class SentimentLexicon():
+    """
+    Precomputed synset_polarity of every WordNet (lemma, POS), stored as two arrays:
+        keys: sorted "<wn_tag>:<lemma>" UTF-8 bytes, a fixed-width "S" array (1 byte per character instead of 4 for
+            a "<U" array, with keys of up to ~70 characters).
+        polarities: float32 polarity per key, SentiWordNet scores are multiples of 1/8 so float32 is exact.
+    Lookups are a vectorized binary search, lemmas that are missing fall back to synset_polarity.
+    """
+
+    def __init__(self, keys, polarities):
+        if keys.dtype.kind == 'U':
+            # Lexicons saved with str keys, UTF-8 keeps the code point order.
+            keys = np.char.encode(keys, 'utf-8')
+        self.keys = keys
+        self.polarities = polarities
+
+    @classmethod
+    def build(cls):
+        table = {}
+        for wn_tag in POS_TAG_TO_WN.values():
+            # Adjective lookups also return satellite adjectives.
+            lemma_names = set(wn.all_lemma_names(wn_tag))
+            if wn_tag == 'a':
+                lemma_names |= set(wn.all_lemma_names(wn.ADJ_SAT))
+            for lemma in lemma_names:
+                polarity = synset_polarity(lemma, wn_tag)
+                if polarity is not None:
+                    table[f'{wn_tag}:{lemma}'] = polarity
+        keys = sorted(table)
+        return cls(np.array([key.encode('utf-8') for key in keys]),
+                   np.array([table[key] for key in keys], dtype=np.float32))
+
+    @classmethod
+    def load(cls, path):
+        arrays = np.load(path)
+        return cls(arrays['keys'], arrays['polarities'])
+
+    def save(self, path):
+        np.savez_compressed(path, keys=self.keys, polarities=self.polarities)
+
+    def polarities_of(self, lemmas, wn_tags):
+        """
+        Returns the polarity of each (lemma, wn_tag), None for lemmas without synsets.
+        """
+        if not lemmas:
+            return []
+        queries = np.array([f'{wn_tag}:{lemma}'.encode('utf-8') for lemma,
+                            wn_tag in zip(lemmas, wn_tags)])
+        idx = np.minimum(np.searchsorted(self.keys, queries),
+                         len(self.keys) - 1)
+        found = self.keys[idx] == queries
+        return [float(self.polarities[i]) if is_found else synset_polarity(lemma, wn_tag)
+                for i, is_found, lemma, wn_tag in zip(idx, found, lemmas, wn_tags)]
+
+
+def get_lexicon():
+    """
+    Loads the lexicon built offline at constants.SENTIMENT_LEXICON_PATH once, or returns an empty lexicon if not built,
+    in which case every lookup is computed and memoized by synset_polarity.
+    """
+    global _lexicon
+    if _lexicon is None:
+        with _load_lock:
+            if _lexicon is None:
+                if os.path.exists(constants.SENTIMENT_LEXICON_PATH):
+                    _lexicon = SentimentLexicon.load(
+                        constants.SENTIMENT_LEXICON_PATH)
+                else:
+                    _lexicon = SentimentLexicon(
+                        np.array([b'']), np.zeros(1, dtype=np.float32))
+    return _lexicon
+
+
+def words_polarities(filtered_words):
+    """
+    Polarity of each word that has a WordNet POS and synsets, same values as computing synset_polarity per word.
+    """
+    lemmas, wn_tags = [], []
+    for word, tag in pos_tag(filtered_words):
+        wn_tag = POS_TAG_TO_WN.get(tag[0], None)
+        if not wn_tag:
+            continue
+        lemma = lemmatize(word, wn_tag)
+        if not lemma:
+            continue
+        lemmas.append(lemma)
+        wn_tags.append(wn_tag)
+    return [polarity for polarity in get_lexicon().polarities_of(lemmas, wn_tags) if polarity is not None]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--output", default=constants.SENTIMENT_LEXICON_PATH,
+                        help="Where to write the lexicon.")
+    args = parser.parse_args()
+    lexicon = SentimentLexicon.build()
+    lexicon.save(args.output)
+    print(f"Wrote {len(lexicon.keys)} polarities to {args.output}")
@@ -0,0 +1,238 @@
+"""
+Speculative sampling (https://arxiv.org/abs/2211.17192) for the fine-tuned GPT2 model.
+A small draft model (e.g. GPT2 small fine-tuned on the same tales, with the same tokenizer) samples num_draft_tokens
+tokens, and the fine-tuned model scores all of them in one forward pass. Each draft token is accepted with probability
+min(1, p/q), the first rejected one is resampled from max(0, p - q), so every returned token is distributed as if
+sampled from the fine-tuned model alone (same temperature, top-k, top-p and min_length processing as generate).
+Sequences of a batch advance together, by the fewest tokens any unfinished sequence accepted in the round: keeping a
+prefix of a valid sample is itself a valid sample. So the speedup is largest with few sequences per batch.
+To compare the latency with and without the draft model:
+    python -m story_generator.speculative_decoding benchmark --runs 5
+"""
+
+import story_generator.constants as constants
+
+import argparse
+import threading
+import time
+
+import torch
+from transformers import LogitsProcessorList, MinLengthLogitsProcessor, TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+from transformers.generation.utils import SampleDecoderOnlyOutput
+
+
+class SpeculativeStats():
+    """
+    Thread-safe counters across speculative_generate calls, e.g. of the generations of several inference threads.
+    acceptance_rate is the fraction of draft tokens the fine-tuned model accepted, tokens_per_forward the number of
+    tokens each fine-tuned model forward pass generated per sequence (1 without a draft model).
+    """
+
+    def __init__(self):
+        self.rounds, self.drafted, self.accepted, self.tokens = 0, 0, 0, 0
+        self._lock = threading.Lock()
+
+    def record(self, drafted, accepted, tokens):
+        """
+        Counts one round of speculative_generate.
+        """
+        with self._lock:
+            self.rounds += 1
+            self.drafted += drafted
+            self.accepted += accepted
+            self.tokens += tokens
+
+    def info(self):
+        with self._lock:
+            return {"rounds": self.rounds,
+                    "acceptance_rate": round(self.accepted / max(self.drafted, 1), 4),
+                    "tokens_per_forward": round(self.tokens / max(self.rounds, 1), 4)}
+
+
+def _logits_processors(min_length, eos_token_id):
+    # Same processing and order as generate with do_sample=True and the constants sampling parameters.
+    return LogitsProcessorList([MinLengthLogitsProcessor(min_length, eos_token_id),
+                                TemperatureLogitsWarper(constants.TEMPERATURE),
+                                TopKLogitsWarper(constants.TOP_K),
+                                TopPLogitsWarper(constants.TOP_P)])
+
+
+def _forward(model, input_ids, attention_mask, past_key_values):
+    """
+    Runs model on the input_ids missing from past_key_values, returns their logits and the extended past_key_values.
+    Position ids skip the left padding, as in GPT2LMHeadModel.prepare_inputs_for_generation.
+    """
+    past_length = 0 if past_key_values is None else past_key_values[0][0].shape[-2]
+    position_ids = attention_mask.long().cumsum(-1) - 1
+    position_ids.masked_fill_(attention_mask == 0, 1)
+    outputs = model(input_ids[:, past_length:], past_key_values=past_key_values, attention_mask=attention_mask,
+                    position_ids=position_ids[:, past_length:], use_cache=True)
+    return outputs[0], outputs[1]
+
+
+def _crop_past(past_key_values, length):
+    return tuple(tuple(tensor[:, :, :length] for tensor in layer) for layer in past_key_values)
+
+
+def speculative_generate(model, draft_model, input_ids, attention_mask, max_length, min_length, num_return_sequences=1,
+                         pad_token_id=None, num_draft_tokens=constants.NUM_DRAFT_TOKENS, past_key_values=None,
+                         output_scores=False, return_dict_in_generate=False, streamer=None, stopping_criteria=None, stats=None):
+    """
+    Drop-in for model.generate(do_sample=True, ...) as called by _sample_demo_sequences, with a draft model.
+    Args:
+        input_ids, attention_mask (torch.Tensor): left-padded prompts, shape (batch_size x prompt_length).
+        max_length, min_length (int): including the prompt, as for generate.
+        past_key_values (tuple): optional model cache of all prompt tokens but the last, already repeated
+            num_return_sequences times.
+        stopping_criteria (StoppingCriteriaList): optional, checked after every round as the sequences may grow by
+            several tokens.
+        stats (SpeculativeStats): optional counters to update.
+    Returns the generated sequences (batch_size * num_return_sequences x length), or like generate a
+    SampleDecoderOnlyOutput with the per step processed scores if return_dict_in_generate.
+    """
+    eos_token_id = model.config.eos_token_id
+    pad_token_id = eos_token_id if pad_token_id is None else pad_token_id
+    input_ids = input_ids.repeat_interleave(num_return_sequences, dim=0)
+    attention_mask = attention_mask.repeat_interleave(
+        num_return_sequences, dim=0)
+    batch_size = input_ids.shape[0]
+    rows = torch.arange(batch_size, device=input_ids.device)
+    processors = _logits_processors(min_length, eos_token_id)
+    unfinished = torch.ones(batch_size, dtype=torch.bool,
+                            device=input_ids.device)
+    target_past, draft_past = past_key_values, None
+    scores = []
+    if streamer is not None:
+        streamer.put(input_ids.cpu())
+
+    with torch.no_grad():
+        while input_ids.shape[-1] < max_length and unfinished.any():
+            cur_len = input_ids.shape[-1]
+            # Draft tokens, leaving room for the token sampled from the fine-tuned model.
+            num_drafts = min(num_draft_tokens, max_length - cur_len - 1)
+            candidate_ids, candidate_mask, draft_probs = input_ids, attention_mask, []
+            for _ in range(num_drafts):
+                logits, draft_past = _forward(
+                    draft_model, candidate_ids, candidate_mask, draft_past)
+                probs = torch.softmax(processors(
+                    candidate_ids, logits[:, -1].float()), dim=-1)
+                draft_probs.append(probs)
+                candidate_ids = torch.cat(
+                    [candidate_ids, torch.multinomial(probs, 1)], dim=-1)
+                candidate_mask = torch.cat(
+                    [candidate_mask, candidate_mask.new_ones(batch_size, 1)], dim=-1)
+
+            # Scores every draft token, and the token after the last one, in one forward pass.
+            logits, target_past = _forward(
+                model, candidate_ids, candidate_mask, target_past)
+            target_scores = [processors(candidate_ids[:, :cur_len + idx], logits[:, idx - num_drafts - 1].float())
+                             for idx in range(num_drafts + 1)]
+            target_probs = torch.softmax(torch.stack(target_scores, dim=1), dim=-1)
+            draft_probs = torch.stack(
+                draft_probs + [target_probs.new_zeros(batch_size, target_probs.shape[-1])], dim=1)
+
+            drafted = candidate_ids[:, cur_len:]
+            # Accepts draft token i with probability min(1, p/q), up to the first rejection.
+            p = target_probs[:, :num_drafts].gather(-1, drafted.unsqueeze(-1)).squeeze(-1)
+            q = draft_probs[:, :num_drafts].gather(-1, drafted.unsqueeze(-1)).squeeze(-1)
+            accepted = torch.rand_like(p) * q < p
+            num_accepted = accepted.long().cumprod(dim=-1).sum(dim=-1)
+            # Resamples the first rejected token from max(0, p - q), or samples the next one from p if all accepted.
+            residual = (target_probs[rows, num_accepted] -
+                        draft_probs[rows, num_accepted]).clamp(min=0)
+            residual_sum = residual.sum(dim=-1, keepdim=True)
+            residual = torch.where(residual_sum > 0, residual / residual_sum.clamp(min=1e-12),
+                                   target_probs[rows, num_accepted])
+            next_tokens = torch.multinomial(residual, 1).squeeze(-1)
+
+            num_new = int(num_accepted[unfinished].min()) + 1
+            new_tokens = torch.cat([drafted, drafted.new_zeros(batch_size, 1)], dim=-1)
+            new_tokens[rows, num_accepted] = next_tokens
+            new_tokens = new_tokens[:, :num_new]
+            if stats is not None:
+                stats.record(num_drafts * int(unfinished.sum()),
+                             int(num_accepted[unfinished].sum()), num_new)
+            # As generate: finished sequences get padding, and the batch stops once all sequences finished.
+            for idx in range(num_new):
+                new_tokens[:, idx] = torch.where(
+                    unfinished, new_tokens[:, idx], torch.full_like(new_tokens[:, idx], pad_token_id))
+                unfinished = unfinished & (new_tokens[:, idx] != eos_token_id)
+                if not unfinished.any():
+                    num_new = idx + 1
+                    new_tokens = new_tokens[:, :num_new]
+                    break
+
+            scores.extend(target_scores[:num_new])
+            if streamer is not None:
+                for idx in range(num_new):
+                    streamer.put(new_tokens[:, idx].cpu())
+            input_ids = torch.cat([input_ids, new_tokens], dim=-1)
+            attention_mask = torch.cat(
+                [attention_mask, attention_mask.new_ones(batch_size, num_new)], dim=-1)
+            if stopping_criteria is not None and stopping_criteria(input_ids, None):
+                break
+            # The caches keep the accepted tokens only, the last new token is fed in the next round.
+            target_past = _crop_past(target_past, input_ids.shape[-1] - 1)
+            if draft_past is not None:
+                draft_past = _crop_past(draft_past, min(
+                    draft_past[0][0].shape[-2], input_ids.shape[-1] - 1))
+
+    if streamer is not None:
+        streamer.end()
+    if return_dict_in_generate:
+        return SampleDecoderOnlyOutput(sequences=input_ids, scores=tuple(scores) if output_scores else None)
+    return input_ids
+
+
+def benchmark(model_path=constants.FINETUNED_GPT2_PATH, draft_path=constants.DRAFT_GPT2_PATH, runs=5, max_length=25,
+              num_return_sequences=3, num_draft_tokens=constants.NUM_DRAFT_TOKENS, seed=0):
+    """
+    Compares autocomplete generation with and without the draft model on the same prompts.
+    Returns the generated tokens per second of both, and the draft acceptance rate.
+    """
+    from story_generator.generation_utils import _sample_demo_sequences
+    from transformers import GPT2LMHeadModel, GPT2Tokenizer
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    tokenizer = GPT2Tokenizer.from_pretrained(constants.TOKENIZER_PATH)
+    tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+    model = GPT2LMHeadModel.from_pretrained(model_path).eval().to(device)
+    draft_model = GPT2LMHeadModel.from_pretrained(draft_path).eval().to(device)
+    prompts = ["Once upon a time, there lived a little girl in a small village near the forest. ",
+               "The king called his three sons and said: ",
+               "The Wonders of the Sun\n"]
+
+    results = {}
+    for name, draft in [("generate", None), ("speculative", draft_model)]:
+        torch.manual_seed(seed)
+        stats = SpeculativeStats()
+        num_tokens, start_time = 0, time.time()
+        for _ in range(runs):
+            for prompt in prompts:
+                texts = _sample_demo_sequences(model, tokenizer, [prompt], max_length, num_return_sequences, device,
+                                               first_idx=True, draft_model=draft, speculative_stats=stats,
+                                               num_draft_tokens=num_draft_tokens)[0]
+                num_tokens += sum(len(tokenizer(text)['input_ids'])
+                                  for text in texts)
+        results[name] = {"tokens_per_sec": round(num_tokens / (time.time() - start_time), 2)}
+        if draft is not None:
+            results[name].update(stats.info())
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    benchmark_parser = subparsers.add_parser(
+        "benchmark", help="Tokens/sec of generation with and without the draft model, and its acceptance rate.")
+    benchmark_parser.add_argument("--model-path", default=constants.FINETUNED_GPT2_PATH)
+    benchmark_parser.add_argument("--draft-path", default=constants.DRAFT_GPT2_PATH)
+    benchmark_parser.add_argument("--runs", default=5, type=int)
+    benchmark_parser.add_argument("--max-length", default=25, type=int)
+    benchmark_parser.add_argument("--num-return-sequences", default=3, type=int)
+    benchmark_parser.add_argument("--num-draft-tokens", default=constants.NUM_DRAFT_TOKENS, type=int)
+    args = parser.parse_args()
+    print(benchmark(args.model_path, args.draft_path, args.runs, args.max_length, args.num_return_sequences,
+                    args.num_draft_tokens))
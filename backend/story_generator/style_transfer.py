@@ -0,0 +1,318 @@
+"""
+Style transfer of the retrieved photos with the fast-neural-style TransformerNet models of constants.STYLE_MODELS.
+Stylized images are cached on disk, one JPEG per (photo_id, style) in the style folder of constants.STYLE_IMAGES_PATHS,
+so each photo is stylized once per style. Originals are read from the "none" folder, and downloaded there from
+Unsplash when missing.
+To stylize some photos:
+    python -m story_generator.style_transfer stylize --style sketch --photo-ids <id> <id>
+To pre-stylize the catalog before a launch, on a pool of CPU processes:
+    python -m story_generator.style_transfer prestylize --limit 10000 --workers 8
+"""
+
+import story_generator.constants as constants
+from story_generator.transformer_net import TransformerNet
+
+import argparse
+import copy
+import os
+import re
+import threading
+import time
+import urllib.request
+
+import numpy as np
+import torch
+from PIL import Image
+
+STYLES = list(constants.STYLE_IMAGES_PATHS)
+OPTIMIZATIONS = ["none", "int8"]
+# InstanceNorm running stats saved by older torch versions, unused with track_running_stats=False.
+_DEPRECATED_KEYS = re.compile(r'in\d+\.running_(mean|var)$')
+
+
+def _valid_photo_id(photo_id):
+    # Photo ids end up in paths, don't let them leave the images folders.
+    return bool(photo_id) and os.path.basename(photo_id) == photo_id and not photo_id.startswith('.')
+
+
+def style_image_path(photo_id, style, image_size=constants.STYLE_IMAGE_SIZE):
+    """
+    Cache path of the photo in style, other resolutions than constants.STYLE_IMAGE_SIZE are cached apart.
+    """
+    assert style in STYLES, f"Unknown style {style}, expected one of {STYLES}"
+    assert _valid_photo_id(photo_id), f"Invalid photo id {photo_id}"
+    suffix = "" if tuple(image_size) == tuple(constants.STYLE_IMAGE_SIZE) else "_{}x{}".format(*image_size)
+    return os.path.join(constants.STYLE_IMAGES_PATHS[style], f"{photo_id}{suffix}.jpg")
+
+
+def _tmp_path(path):
+    # Unique per process and thread, concurrent writers of the same image never share a temporary file.
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def original_image_path(photo_id, image_size=constants.STYLE_IMAGE_SIZE):
+    """
+    Path of the original photo, downloaded from Unsplash at image_size if not there yet. Any resolution is resized on
+    load, so there is one original per photo.
+    Raises urllib.error.URLError if the photo can't be downloaded.
+    """
+    path = style_image_path(photo_id, "none")
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = _tmp_path(path)
+        try:
+            urllib.request.urlretrieve(
+                "{}{}/{}x{}".format(constants.UNSPLASH_URL, photo_id, *image_size), tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return path
+
+
+def load_images(paths, image_size=constants.STYLE_IMAGE_SIZE):
+    """
+    Returns the images as one (batch, 3, height, width) float batch in [0, 255], the TransformerNet input range.
+    """
+    images = [np.asarray(Image.open(path).convert("RGB").resize(image_size, Image.BILINEAR))
+              for path in paths]
+    return torch.from_numpy(np.stack(images)).permute(0, 3, 1, 2).float()
+
+
+def save_images(batch, paths, quality=constants.IMAGE_QUALITY):
+    """
+    Writes each image of a TransformerNet output batch as a JPEG, atomically so readers never see a partial image.
+    """
+    images = batch.clamp(0, 255).permute(0, 2, 3, 1).to(
+        "cpu", torch.uint8).numpy()
+    for image, path in zip(images, paths):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = _tmp_path(path)
+        Image.fromarray(image).save(tmp_path, format="JPEG", quality=quality)
+        os.replace(tmp_path, path)
+
+
+def quantize_style_model(model, calibration_batch):
+    """
+    Returns an int8 statically quantized copy of model, activation ranges are calibrated on calibration_batch.
+    Only runs on CPU.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    prepared = prepare_fx(copy.deepcopy(model).eval(), get_default_qconfig_mapping(),
+                          (calibration_batch,))
+    with torch.inference_mode():
+        prepared(calibration_batch)
+    return convert_fx(prepared)
+
+
+def _calibration_batch(image_size, max_images=constants.STYLE_BATCH_SIZE):
+    folder = constants.STYLE_IMAGES_PATHS["none"]
+    if not os.path.isdir(folder):
+        return None
+    paths = [os.path.join(folder, name) for name in sorted(os.listdir(folder))
+             if name.endswith(".jpg")][:max_images]
+    return load_images(paths, image_size) if paths else None
+
+
+def load_style_model(model_path, device, optimization=constants.STYLE_OPTIMIZATION,
+                     image_size=constants.STYLE_IMAGE_SIZE):
+    """
+    Loads a TransformerNet style model in eval mode and channels last memory format.
+    Args:
+        model_path (str): TransformerNet state dict.
+        optimization (str): one of OPTIMIZATIONS, "int8" is calibrated on original images and falls back to fp32 without
+            any, or on GPU.
+    """
+    assert optimization in OPTIMIZATIONS, f"Unknown optimization {optimization}, expected one of {OPTIMIZATIONS}"
+    state_dict = torch.load(model_path, map_location="cpu")
+    state_dict = {key: value for key, value in state_dict.items()
+                  if not _DEPRECATED_KEYS.search(key)}
+    model = TransformerNet()
+    model.load_state_dict(state_dict)
+    model.eval()
+    if optimization == "int8":
+        calibration_batch = None if torch.device(
+            device).type != "cpu" else _calibration_batch(image_size)
+        if calibration_batch is not None:
+            model = quantize_style_model(model, calibration_batch)
+        else:
+            print(f"int8 quantization requires CPU and original images to calibrate, loading {model_path} in fp32")
+    return model.to(device, memory_format=torch.channels_last)
+
+
+class StyleTransfer():
+    """
+    Stylizes photos in batches, through the on-disk cache of style_image_path.
+    Args:
+        get_model (Callable): style -> TransformerNet model, e.g. a lazy loader.
+        device (torch.device): where the models run.
+        image_size (Tuple<int, int>): (width, height) of the stylized images.
+        batch_size (int): number of images per forward pass.
+        quality (int): JPEG quality of the stylized images.
+    """
+
+    def __init__(self, get_model, device, image_size=constants.STYLE_IMAGE_SIZE,
+                 batch_size=constants.STYLE_BATCH_SIZE, quality=constants.IMAGE_QUALITY):
+        self.get_model = get_model
+        self.device = torch.device(device)
+        self.image_size = tuple(image_size)
+        self.batch_size = batch_size
+        self.quality = quality
+        self.hits, self.misses, self.stylize_time = 0, 0, 0.
+
+    def stylize(self, photo_ids, style):
+        """
+        Returns the stylized image path of each photo, stylizing only the ones missing from the cache.
+        """
+        if style == "none":
+            return [original_image_path(photo_id, self.image_size) for photo_id in photo_ids]
+        paths = [style_image_path(photo_id, style, self.image_size)
+                 for photo_id in photo_ids]
+        # Each missing photo once, even if repeated.
+        missing = list(dict.fromkeys(photo_id for photo_id, path in zip(photo_ids, paths)
+                                     if not os.path.exists(path)))
+        self.hits += len(photo_ids) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            model = self.get_model(style)
+            start_time = time.time()
+            for start in range(0, len(missing), self.batch_size):
+                batch_ids = missing[start:start + self.batch_size]
+                self._stylize_batch(model, batch_ids, style)
+            self.stylize_time += time.time() - start_time
+        return paths
+
+    def _stylize_batch(self, model, photo_ids, style):
+        batch = load_images([original_image_path(photo_id, self.image_size) for photo_id in photo_ids],
+                            self.image_size)
+        batch = batch.to(self.device, memory_format=torch.channels_last)
+        with torch.inference_mode():
+            output = model(batch)
+        save_images(output, [style_image_path(photo_id, style, self.image_size) for photo_id in photo_ids],
+                    self.quality)
+
+    def metrics(self):
+        stylized = max(self.misses, 1)
+        return {"hits": self.hits, "misses": self.misses,
+                "avg_stylize_time": round(self.stylize_time / stylized, 4)}
+
+
+# Per worker process StyleTransfer of prestylize.
+_worker_style_transfer = None
+
+
+def _init_prestylize_worker(optimization, image_size, batch_size):
+    global _worker_style_transfer
+    # One torch thread per process, the pool provides the parallelism.
+    torch.set_num_threads(1)
+    models = {}
+
+    def get_model(style):
+        if style not in models:
+            models[style] = load_style_model(
+                constants.STYLE_MODELS[style], "cpu", optimization, image_size)
+        return models[style]
+    _worker_style_transfer = StyleTransfer(
+        get_model, "cpu", image_size, batch_size)
+
+
+def _prestylize_chunk(style, photo_ids):
+    # Returns (#stylized, #failed) of the chunk.
+    try:
+        _worker_style_transfer.stylize(photo_ids, style)
+    except Exception as e:
+        print(f"Stylizing {photo_ids} in {style}: {type(e)} Exception occurred")
+        print("Exception Args:", e.args)
+        return 0, len(photo_ids)
+    return len(photo_ids), 0
+
+
+def prestylize(photo_ids, styles=tuple(constants.STYLE_MODELS), workers=None,
+               optimization=constants.STYLE_OPTIMIZATION, image_size=constants.STYLE_IMAGE_SIZE,
+               batch_size=constants.STYLE_BATCH_SIZE):
+    """
+    Fills the style cache with every photo in every style, on a pool of CPU worker processes.
+    Resumable: photos already in the cache are skipped, and images are written atomically, so an interrupted run
+    leaves no partial image behind.
+    Returns the number of stylized, skipped (already cached) and failed images, and the stylized images per second.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    todo = [(style, [photo_id for photo_id in dict.fromkeys(photo_ids)
+                     if not os.path.exists(style_image_path(photo_id, style, image_size))])
+            for style in styles]
+    skipped = len(styles) * len(dict.fromkeys(photo_ids)) - \
+        sum(len(ids) for _, ids in todo)
+    # Chunks of one batch, so the pool balances the work and progress is reported often.
+    chunks = [(style, ids[start:start + batch_size])
+              for style, ids in todo for start in range(0, len(ids), batch_size)]
+    stylized, failed = 0, 0
+    start_time = time.time()
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_init_prestylize_worker,
+                             initargs=(optimization, tuple(image_size), batch_size)) as pool:
+        futures = [pool.submit(_prestylize_chunk, style, ids)
+                   for style, ids in chunks]
+        for done, future in enumerate(as_completed(futures), 1):
+            chunk_stylized, chunk_failed = future.result()
+            stylized += chunk_stylized
+            failed += chunk_failed
+            if done % 10 == 0 or done == len(futures):
+                print(f"{done}/{len(futures)} batches, "
+                      f"{stylized / max(time.time() - start_time, 1e-9):.2f} images/sec", flush=True)
+    elapsed = time.time() - start_time
+    return {"stylized": stylized, "skipped": skipped, "failed": failed,
+            "images_per_sec": round(stylized / max(elapsed, 1e-9), 2)}
+
+
+def _read_photo_ids(path):
+    with open(path) as infile:
+        return [line.strip() for line in infile if line.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    stylize_parser = subparsers.add_parser(
+        "stylize", help="Stylize photos, through the style cache.")
+    stylize_parser.add_argument("--style", default="sketch",
+                                choices=list(constants.STYLE_MODELS))
+    stylize_parser.add_argument("--photo-ids", nargs="+", required=True)
+    prestylize_parser = subparsers.add_parser(
+        "prestylize", help="Fill the style cache for the photo catalog, or a subset of it, on a process pool.")
+    prestylize_parser.add_argument("--styles", nargs="+", default=list(constants.STYLE_MODELS),
+                                   choices=list(constants.STYLE_MODELS))
+    prestylize_parser.add_argument("--photo-ids-file", default=None,
+                                   help="One photo id per line, e.g. the most retrieved ones, instead of the whole catalog.")
+    prestylize_parser.add_argument("--limit", default=None, type=int,
+                                   help="Only the first limit photos.")
+    prestylize_parser.add_argument("--workers", default=os.cpu_count(), type=int,
+                                   help="Number of processes, each with one torch thread.")
+    prestylize_parser.add_argument("--batch-size", default=constants.STYLE_BATCH_SIZE, type=int)
+    for subparser in [stylize_parser, prestylize_parser]:
+        subparser.add_argument("--optimization", default=constants.STYLE_OPTIMIZATION,
+                               choices=OPTIMIZATIONS)
+        subparser.add_argument("--image-size", nargs=2, type=int,
+                               default=constants.STYLE_IMAGE_SIZE, help="Width and height.")
+    args = parser.parse_args()
+
+    if args.command == "stylize":
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        style_transfer = StyleTransfer(lambda style: load_style_model(constants.STYLE_MODELS[style], device,
+                                                                      args.optimization, args.image_size),
+                                       device, args.image_size)
+        print("\n".join(style_transfer.stylize(args.photo_ids, args.style)))
+        print(style_transfer.metrics())
+    else:
+        from story_generator.image_index import load_photo_ids
+
+        if args.photo_ids_file is not None:
+            photo_ids = _read_photo_ids(args.photo_ids_file)
+        else:
+            catalog = load_photo_ids()
+            photo_ids = catalog.take(range(len(catalog) if args.limit is None else min(args.limit, len(catalog))))
+        photo_ids = photo_ids[:args.limit]
+        print(prestylize(photo_ids, args.styles, args.workers,
+                         args.optimization, args.image_size, args.batch_size))
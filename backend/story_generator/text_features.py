@@ -0,0 +1,175 @@
+import story_generator.constants as constants
+from story_generator.helper_functions import split_to_sentences, split_words
+
+from collections import namedtuple
+import argparse
+import re
+import time
+import numpy as np
+
+# Sentence end marks not preceded by a capital letter, used to detect "sparse" texts.
+SPARSE_SENTENCE_END_PATTERN = re.compile(r'(?<![A-Z])[.!?;"]+')
+
+# Tokenization of one text, shared by all the lexical ranking features.
+#   sentences: text split to sentences, as split_to_sentences(text).
+#   words: as split_words(text).
+#   filtered_words: lower case words of the stripped text without stop words.
+#   filtered_words_set: unique filtered words.
+TextFeatures = namedtuple(
+    'TextFeatures', ['text', 'sentences', 'words', 'filtered_words', 'filtered_words_set'])
+
+
+def extract_text_features(text):
+    """
+    Tokenizes text once to sentences and words, same outputs as calling split_to_sentences/ split_words on
+    text and on text.lower().strip().
+    """
+    words = split_words(text)
+    # Words of the stripped text: a leading whitespace only word is dropped and the ends are stripped.
+    stripped_words = list(words)
+    stripped_words[0] = stripped_words[0].lstrip()
+    if not stripped_words[0] and len(stripped_words) > 1:
+        stripped_words.pop(0)
+    stripped_words[-1] = stripped_words[-1].rstrip()
+
+    # Set of text words without punctuation and stop words.
+    filtered_words = [word for word in map(str.lower, stripped_words)
+                      if word not in constants.STOP_WORDS]
+    return TextFeatures(text, split_to_sentences(text), words, filtered_words, set(filtered_words))
+
+
+def readability_batch(features):
+    """
+    Same as ranking_utils._readabilty for a list of TextFeatures, returns a np.array.
+    """
+    num_letters = np.array([sum(map(len, feature.words))
+                            for feature in features], dtype=float)
+    num_words = np.array([len(feature.words)
+                          for feature in features], dtype=float)
+    num_sent = np.array([len(feature.sentences)
+                         for feature in features], dtype=float)
+
+    # check if a "sparse" sentence
+    for i, feature in enumerate(features):
+        if num_sent[i] == 1:
+            new_line_threshold = 0 if num_words[i] == 0 else num_words[i] // 4
+            if feature.sentences[0].count('\n') > new_line_threshold or not SPARSE_SENTENCE_END_PATTERN.search(feature.sentences[0]):
+                num_sent[i] = 0
+
+    letters_per_word = np.divide(num_letters, num_words, out=np.full_like(
+        num_letters, -10), where=num_words != 0)
+    words_per_sentence = np.divide(num_words, num_sent, out=np.full_like(
+        num_words, -10), where=num_sent != 0)
+    # 0.5 to weight words_per_sentence higher
+    return 0.5*letters_per_word + words_per_sentence
+
+
+def simplicity_batch(features):
+    """
+    Same as ranking_utils._simplicity for a list of TextFeatures, returns a np.array.
+    """
+    return np.array([len(feature.filtered_words_set & constants.SEVEN_PREC_MOST_FREQ_WORDS)
+                     for feature in features], dtype=float)
+
+
+def diversity_batch(features):
+    """
+    Same as ranking_utils._diversity for a list of TextFeatures, returns a np.array.
+    """
+    num_unique = np.array([len(feature.filtered_words_set)
+                           for feature in features], dtype=float)
+    num_words = np.array([len(feature.filtered_words)
+                          for feature in features], dtype=float)
+    # If empty sentence or only white space or \n or too repetitive.
+    return np.divide(num_unique, num_words, out=np.zeros_like(num_unique),
+                     where=num_unique >= constants.MIN_WORDS_PER_STORY)
+
+
+def coherency_batch(features, embedder):
+    """
+    Same as ranking_utils._coherency for a list of TextFeatures: per text, the sum of the cosine similarities of
+    its sentences to its first sentence. All sentences are embedded in one embedder call.
+    Args:
+        embedder (sentence_embedder.SentenceEmbedder): returns unit norm sentence vectors.
+    Returns a np.array.
+    """
+    num_sentences = np.array([len(feature.sentences) for feature in features])
+    if not num_sentences.sum():
+        return np.zeros(len(features))
+    embeddings = embedder(
+        [sentence for feature in features for sentence in feature.sentences])
+    first_sentences = np.cumsum(num_sentences) - num_sentences
+    # Similarity of every sentence to the first sentence of its text, without the first sentences themselves.
+    similarities = np.einsum('ij,ij->i', embeddings,
+                             embeddings[np.repeat(first_sentences, num_sentences)])
+    similarities[first_sentences[num_sentences > 0]] = 0
+    return np.bincount(np.repeat(np.arange(len(features)), num_sentences), weights=similarities, minlength=len(features))
+
+
+def _sample_candidates(num_candidates, seed=0):
+    """
+    Random fairy tale like candidates, with the newlines, quotes and leading spaces of generated texts.
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = ['the', 'little', 'frog', 'said', 'and', 'king', 'princess', 'went', 'to', 'forest',
+                  'Mr.', 'Once', 'upon', 'a', 'time', 'she', 'was', 'very', 'happy', 'dark', 'castle']
+    endings = ['.', '!', '?', ';', '."', ',', '', '\n', '\n\n']
+    candidates = []
+    for _ in range(num_candidates):
+        words = rng.choice(vocabulary, size=rng.integers(5, 60))
+        candidates.append(' ' + ''.join(word + rng.choice(endings, p=[0.1, 0.03, 0.03, 0.02, 0.04, 0.08, 0.6, 0.05, 0.05]) + ' '
+                                        for word in words).rstrip(' '))
+    return candidates
+
+
+def benchmark(num_candidates=1000, repeat=5):
+    """
+    Per candidate CPU time of the lexical features computed as before this module, one text at a time with
+    string patterns and a split per feature, and of extract_text_features and the batch features for all candidates.
+    """
+    from story_generator.ranking_utils import _readabilty, _simplicity, _diversity
+
+    candidates = _sample_candidates(num_candidates)
+
+    def previous_split_to_sentences(text):
+        sentences = list(map(str.strip, re.sub(
+            r'(?<!Mr)(?<!Mrs)[.!?;"]+', r'\g<0>[cut]', text.strip()).split('[cut]')))
+        if len(sentences) > 1 and len(sentences[-1]) < 3:
+            sentences.pop()
+        return sentences
+
+    def per_text():
+        scores = []
+        for text in candidates:
+            texts_sentences = previous_split_to_sentences(text)
+            filtered_words = list(filter(
+                lambda word: word not in constants.STOP_WORDS, re.split(r'[ ](?=[\w])', text.lower().strip())))
+            filtered_words_set = set(filtered_words)
+            scores.append([_readabilty(text, texts_sentences), _simplicity(filtered_words_set),
+                           _diversity(filtered_words, filtered_words_set)])
+        return np.array(scores, dtype=float)
+
+    def batched():
+        features = [extract_text_features(text) for text in candidates]
+        return np.stack([readability_batch(features), simplicity_batch(features), diversity_batch(features)], axis=1)
+
+    np.testing.assert_allclose(batched(), per_text())
+    timings = {}
+    for name, fn in [("per_text", per_text), ("batched", batched)]:
+        elapsed = []
+        for _ in range(repeat):
+            start_time = time.process_time()
+            fn()
+            elapsed.append(time.process_time() - start_time)
+        timings[name] = min(elapsed) / num_candidates * 1e6
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--num_candidates", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    for name, microseconds in benchmark(args.num_candidates, args.repeat).items():
+        print(f"{name:>10}: {microseconds:.1f}us CPU per candidate")
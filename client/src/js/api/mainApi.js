@@ -57,6 +57,63 @@ export class API {
         return d3.json(url, payload)
     }
 
+    /**
+     * Streaming version of postAutocompleteText, calls onTexts with the partial candidate texts while they are generated.
+     * In quality mode candidates are re-ranked at the end, so only the final texts are returned.
+     * When the server is overloaded (503), retries with postAutocompleteText after Retry-After seconds.
+     * Rejects if the request or the generation fails.
+     * Returns  Promise<Array<string>>
+     * @param extracts
+     * @param quality
+     * @param onTexts
+     */
+    async streamAutocompleteText(extracts, quality, onTexts) {
+        const toSend = {
+            extracts: extracts,
+            quality: quality,
+        }
+
+        const url = makeUrl(this.baseURL + '/stream-autocomplete-text');
+        const response = await fetch(url, toPayload(toSend));
+        if (!response.ok) {
+            const retryAfter = response.headers.get("Retry-After");
+            if (response.status === 503 && retryAfter !== null) {
+                await new Promise(resolve => setTimeout(resolve, 1000 * Number(retryAfter)));
+                return this.postAutocompleteText(extracts, quality);
+            }
+            throw new Error(response.status + " " + response.statusText);
+        }
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        const partialTexts = [];
+        let buffer = "";
+        for (;;) {
+            const { value, done } = await reader.read();
+            if (done) {
+                throw new Error("Stream ended before the generated texts");
+            }
+            buffer += decoder.decode(value, { stream: true });
+            // Server-sent events are separated by an empty line.
+            const events = buffer.split("\n\n");
+            buffer = events.pop();
+            for (const event of events) {
+                const lines = event.split("\n");
+                const type = lines[0].startsWith("event: ") ? lines[0].slice(7) : "message";
+                const data = JSON.parse(lines[lines.length - 1].slice(6));
+                if (type === "done") {
+                    return data;
+                }
+                if (type === "error") {
+                    throw new Error("Text generation failed");
+                }
+                partialTexts[data.candidate] = (partialTexts[data.candidate] || "") + data.text;
+                if (!quality) {
+                    onTexts(partialTexts.filter(text => text !== undefined));
+                }
+            }
+        }
+    }
+
     // Story Forms. 
 
     /**
@@ -0,0 +1,41 @@
+import pytest
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+
+class CharTokenizer:
+    """Character level stand-in for the GPT2 tokenizer, left-pads like the Pipeline tokenizer."""
+    pad_token_id = eos_token_id = 0
+
+    def _encode(self, text):
+        return [1 + ord(char) % 90 for char in text]
+
+    def __call__(self, texts, padding=False, return_tensors=None):
+        if isinstance(texts, str):
+            return {'input_ids': self._encode(texts)}
+        ids = [self._encode(text) for text in texts]
+        if not padding:
+            return {'input_ids': ids}
+        max_len = max(map(len, ids))
+        input_ids = [[0] * (max_len - len(i)) + i for i in ids]
+        attention_mask = [[0] * (max_len - len(i)) + [1] * len(i) for i in ids]
+        return {'input_ids': torch.tensor(input_ids), 'attention_mask': torch.tensor(attention_mask)}
+
+    def decode(self, ids, skip_special_tokens=True):
+        return ''.join(chr(31 + int(i)) for i in ids if int(i) != self.eos_token_id)
+
+
+@pytest.fixture
+def tokenizer():
+    return CharTokenizer()
+
+
+@pytest.fixture
+def tiny_gpt2():
+    """Returns a factory of randomly initialised GPT2 models small enough to run in tests."""
+    def make(seed=0):
+        torch.manual_seed(seed)
+        config = GPT2Config(n_layer=2, n_embd=32, n_head=2, vocab_size=100,
+                            bos_token_id=0, eos_token_id=0)
+        return GPT2LMHeadModel(config).eval()
+    return make
@@ -1,27 +1,138 @@
-from typing import *
+import json
+
+import pytest
 from fastapi.testclient import TestClient
-from urllib.parse import urlencode
-from server import app
-from server.api import GoodbyePayload
 
-client = TestClient(app)
+import server.main as main
+from server.benchmark import stub_pipeline
+from server.story_store import FileStoryStore
+from server.story_writer import StoryWriter
+from story_generator.lru_cache import SizedLRUCache
+
+FORM = {"coherence": 4.0, "clarity": 5.0, "creativity": 3.0, "freeForm": "nice", "html": "<p>Once upon a time</p>"}
+
+
+@pytest.fixture(scope="module")
+def pipeline():
+    return stub_pipeline(num_photos=100)
+
+
+@pytest.fixture
+def client(pipeline, tmp_path, monkeypatch):
+    """The app with the stub Pipeline and an empty story store."""
+    store = FileStoryStore(str(tmp_path))
+    monkeypatch.setattr(main, "WARM_UP", False)
+    monkeypatch.setattr(main, "getGenerator", lambda: pipeline)
+    monkeypatch.setattr(main, "story_store", store)
+    monkeypatch.setattr(main, "story_cache", SizedLRUCache(main.STORY_CACHE_BYTES))
+    monkeypatch.setattr(main, "story_writer", StoryWriter(store))
+    return TestClient(main.app)
+
+
+def test_ready_once_the_serving_components_are_loaded(client, pipeline, monkeypatch):
+    monkeypatch.setattr(main, "WARM_UP", True)
+    # The style models aren't loaded, they don't hold back readiness.
+    response = client.get("/api/ready")
+    assert response.status_code == 200 and response.json()["ready"]
+    assert response.json()["components"]["sketch_model"]["status"] == "not_loaded"
 
-def make_url(baseurl, to_send:Dict[str, Any]):
-    return baseurl + "?" + urlencode(to_send)
+    status = dict(pipeline.status(), gpt2={"status": "failed", "load_time": None})
+    monkeypatch.setattr(pipeline, "status", lambda: status)
+    assert client.get("/api/ready").status_code == 503
+    monkeypatch.setattr(main, "WARM_UP", False)
+    assert client.get("/api/ready").status_code == 200
 
-def test_hello():
-    response = client.get(make_url("/api/get-a-hi", {"firstname": "bob"}))
+
+def test_autocomplete_text(client):
+    response = client.post("/api/post-autocomplete-text", json={"extracts": "Once upon a time", "quality": False})
     assert response.status_code == 200
-    assert response.json() == "Hello bob"
+    texts = response.json()
+    assert 0 < len(texts) <= 3 and all(isinstance(text, str) for text in texts)
+
 
-def test_goodbye():
-    request = {"firstname": "bob"}
-    response = client.post("/api/post-a-bye", json=request)
+def test_stream_autocomplete_text_ends_with_the_texts(client):
+    response = client.post("/api/stream-autocomplete-text", json={"extracts": "Once upon a time", "quality": False})
     assert response.status_code == 200
-    assert response.json() == "Goodbye bob"
+    events = response.text.strip().split("\n\n")
+    assert events[-1].startswith("event: done\ndata: ")
+    texts = json.loads(events[-1].split("data: ", 1)[1])
+    streamed = {}
+    for event in events[:-1]:
+        data = json.loads(event[len("data: "):])
+        streamed[data["candidate"]] = streamed.get(data["candidate"], "") + data["text"]
+    assert texts == [streamed[idx] for idx in sorted(streamed) if len(streamed[idx].strip()) > 2]
 
-def test_empty_goodbye():
-    request = {"firstname": ""}
-    response = client.post("/api/post-a-bye", json=request)
+
+def test_autocomplete_img_returns_new_catalog_photos(client, pipeline):
+    current = ["photo000000"]
+    response = client.post("/api/post-autocomplete-img", json={"extract": "A frog in a well", "current": current})
     assert response.status_code == 200
-    assert response.json() == "Goodbye "
\ No newline at end of file
+    images_ids = response.json()
+    assert len(images_ids) == 3 and not set(images_ids) & set(current)
+    assert all(pipeline.has_photo(photo_id) for photo_id in images_ids)
+
+
+def test_autocomplete_img_stylizes_after_the_response(client, pipeline, monkeypatch):
+    stylized = []
+    monkeypatch.setattr(pipeline, "stylize_images", lambda photo_ids, style: stylized.append((photo_ids, style)))
+    response = client.post("/api/post-autocomplete-img", json={"extract": "A frog", "current": [], "style": "sketch"})
+    assert response.status_code == 200
+    assert stylized == [(response.json(), "sketch")]
+
+
+def test_stylized_image_of_an_unknown_photo_is_not_found(client):
+    response = client.get("/api/stylized-image", params={"photoid": "not-a-photo", "style": "none"})
+    assert response.status_code == 404
+
+
+def test_submitted_form_is_read_back(client):
+    response = client.post("/api/post-form-submission", json=FORM)
+    assert response.status_code == 200
+    story_id = response.json()
+    assert len(story_id) == 32
+    # The same story and feedback get the same id.
+    assert client.post("/api/post-form-submission", json=FORM).json() == story_id
+    assert client.get("/api/story", params={"storyid": story_id}).json() == FORM["html"]
+
+
+def test_found_story_is_sent_with_its_etag_and_cache_headers(client):
+    main.story_store.put("a" * 32, FORM)
+    response = client.get("/api/story", params={"storyid": "a" * 32})
+    assert response.status_code == 200 and response.json() == FORM["html"]
+    assert response.headers["ETag"] == f'"{"a" * 32}"'
+    assert response.headers["Cache-Control"] == main.STORY_CACHE_CONTROL
+
+
+def test_revalidated_story_is_not_modified(client):
+    main.story_store.put("a" * 32, FORM)
+    for if_none_match in [f'"{"a" * 32}"', f'W/"{"a" * 32}"', f'"{"b" * 32}", W/"{"a" * 32}"', "*"]:
+        response = client.get("/api/story", params={"storyid": "a" * 32}, headers={"If-None-Match": if_none_match})
+        assert response.status_code == 304 and response.headers["ETag"] == f'"{"a" * 32}"' and not response.content
+    response = client.get("/api/story", params={"storyid": "a" * 32}, headers={"If-None-Match": f'"{"b" * 32}"'})
+    assert response.status_code == 200 and response.json() == FORM["html"]
+
+
+def test_missing_story_is_empty_and_never_revalidated(client):
+    for headers in [None, {"If-None-Match": "*"}, {"If-None-Match": f'"{"c" * 32}"'}]:
+        response = client.get("/api/story", params={"storyid": "c" * 32}, headers=headers)
+        assert response.status_code == 200 and response.json() == ""
+        assert response.headers["Cache-Control"] == "no-cache" and "ETag" not in response.headers
+    # Not cached, the story is found once submitted.
+    main.story_store.put("c" * 32, FORM)
+    assert client.get("/api/story", params={"storyid": "c" * 32}).json() == FORM["html"]
+
+
+def test_cached_story_is_read_from_the_store_once(client, monkeypatch):
+    main.story_store.put("a" * 32, FORM)
+    reads = []
+    get_html = main.story_store.get_html
+    monkeypatch.setattr(main.story_store, "get_html", lambda story_id: reads.append(story_id) or get_html(story_id))
+    for _ in range(3):
+        assert client.get("/api/story", params={"storyid": "a" * 32}).json() == FORM["html"]
+    assert reads == ["a" * 32]
+    assert "a" * 32 in main.story_cache
+
+
+def test_invalid_form_is_not_stored(client):
+    assert client.post("/api/post-form-submission", json=dict(FORM, coherence=6.0)).json() == ""
+    assert list(main.story_store.items()) == []
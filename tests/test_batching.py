@@ -0,0 +1,78 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from server.batching import AutocompleteBatcher, MicroBatcher
+
+
+def test_concurrent_requests_share_one_call():
+    calls = []
+
+    def generate(extracts_list, max_length, num_return_sequences, re_ranking, on_texts):
+        calls.append(list(extracts_list))
+        return [[extracts.upper()] * num_return_sequences for extracts in extracts_list]
+
+    async def run():
+        batcher = AutocompleteBatcher(generate, max_batch_size=4, max_wait=0.05)
+        return await asyncio.gather(*(batcher.submit(extracts, 25, 2) for extracts in ["a", "b", "c"]))
+
+    results = asyncio.run(run())
+    assert results == [["A", "A"], ["B", "B"], ["C", "C"]]
+    assert calls == [["a", "b", "c"]]
+
+
+def test_different_arguments_and_errors_are_kept_apart():
+    def generate(extracts_list, max_length, num_return_sequences, re_ranking, on_texts):
+        if re_ranking:
+            raise ValueError("ranking failed")
+        return [[extracts] * num_return_sequences for extracts in extracts_list]
+
+    async def run():
+        batcher = AutocompleteBatcher(generate, max_batch_size=4, max_wait=0.05)
+        return await asyncio.gather(batcher.submit("a", 25, 1), batcher.submit("b", 25, 1, re_ranking=10),
+                                    return_exceptions=True)
+
+    plain, ranked = asyncio.run(run())
+    assert plain == ["a"]
+    assert isinstance(ranked, ValueError)
+
+
+
+def test_streamed_requests_are_batched_with_the_others():
+    calls, streamed = [], []
+
+    def generate(extracts_list, max_length, num_return_sequences, re_ranking, on_texts):
+        calls.append(list(extracts_list))
+        for extracts, on_text in zip(extracts_list, on_texts):
+            if on_text is not None:
+                on_text(0, extracts)
+        return [[extracts] for extracts in extracts_list]
+
+    async def run():
+        batcher = AutocompleteBatcher(generate, max_batch_size=4, max_wait=0.05)
+        return await asyncio.gather(batcher.submit("a", 25, 1),
+                                    batcher.submit("b", 25, 1, on_text=lambda idx, text: streamed.append((idx, text))))
+
+    assert asyncio.run(run()) == [["a"], ["b"]]
+    assert calls == [["a", "b"]] and streamed == [(0, "b")]
+
+def test_requests_fail_instead_of_hanging_if_the_worker_stops():
+    release = threading.Event()
+
+    def run_batch(items, key):
+        release.wait()
+        return items
+
+    async def run():
+        batcher = MicroBatcher(run_batch, max_batch_size=1, max_wait=0, executor=ThreadPoolExecutor(max_workers=1))
+        requests = [asyncio.ensure_future(batcher.submit(item)) for item in range(3)]
+        # The first request runs, the others are queued.
+        await asyncio.sleep(0.05)
+        batcher._worker.cancel()
+        results = await asyncio.gather(*requests, return_exceptions=True)
+        release.set()
+        return results, await batcher.submit(3)
+
+    results, restarted = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert restarted == 3
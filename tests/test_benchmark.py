@@ -0,0 +1,41 @@
+import json
+
+import pytest
+
+from server.benchmark import compare, measure, run
+
+
+def test_measure_times_every_iteration_after_warmup():
+    calls, setups = [], []
+    result = measure(lambda: calls.append(1), iterations=5, warmup=2, setup=lambda: setups.append(1))
+    assert len(calls) == len(setups) == 7
+    assert result["iterations"] == 5
+    assert 0 <= result["p50_ms"] <= result["p95_ms"] <= result["p99_ms"]
+    assert result["throughput"] > 0
+
+
+def test_compare_reports_slower_and_failed_cases():
+    baseline = {"models": "stub", "cases": {"a": {"p50_ms": 10.0}, "b": {"p50_ms": 10.0}, "c": {"p50_ms": 10.0},
+                                            "d": {"error": "LookupError"}}}
+    results = {"models": "stub", "cases": {"a": {"p50_ms": 12.0}, "b": {"p50_ms": 13.0}, "c": {"error": "LookupError"},
+                                           "d": {"p50_ms": 50.0}, "e": {"p50_ms": 50.0}}}
+    assert compare(results, baseline, 0.25) == [{"case": "b", "baseline_p50_ms": 10.0, "p50_ms": 13.0},
+                                                {"case": "c", "baseline_p50_ms": 10.0, "error": "LookupError"}]
+    with pytest.raises(AssertionError):
+        compare({**results, "models": "real"}, baseline, 0.25)
+
+
+def test_compare_reports_missing_cases_among_the_cases_run():
+    baseline = {"models": "stub", "cases": {"a/1": {"p50_ms": 10.0}, "b/1": {"p50_ms": 10.0}}}
+    results = {"models": "stub", "cases": {"a/1": {"p50_ms": 10.0}}}
+    assert compare(results, baseline, 0.25) == [
+        {"case": "b/1", "baseline_p50_ms": 10.0, "error": "missing from the results"}]
+    assert compare(results, baseline, 0.25, cases=["a"]) == []
+
+
+def test_stub_run_covers_the_requested_cases():
+    results = run("stub", iterations=2, warmup=0, cases=["score_text/Readability", "story_read"])
+    assert sorted(results["cases"]) == ["score_text/Readability", "story_read/cached", "story_read/revalidated",
+                                        "story_read/uncached"]
+    assert all("p50_ms" in case for case in results["cases"].values())
+    assert compare(results, json.loads(json.dumps(results)), 0.25) == []
@@ -0,0 +1,53 @@
+import threading
+import time
+
+import pytest
+
+from story_generator.components import LazyComponents
+
+
+def test_components_load_once_and_concurrently():
+    calls = []
+
+    def loader(name):
+        def load():
+            calls.append(name)
+            time.sleep(0.2)
+            return name.upper()
+        return load
+
+    components = LazyComponents()
+    for name in ["gpt2", "clip", "photo_index"]:
+        components.register(name, loader(name))
+    assert components.status()["gpt2"] == {"status": "not_loaded", "load_time": None}
+
+    start_time = time.time()
+    threads = [threading.Thread(target=components.get, args=("gpt2",)) for _ in range(4)]
+    threads.append(threading.Thread(target=components.load_all))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert time.time() - start_time < 0.6
+    assert sorted(calls) == ["clip", "gpt2", "photo_index"]
+    assert components.get("clip") == "CLIP"
+    assert all(component["status"] == "loaded" for component in components.status().values())
+
+
+def test_failed_components_are_reported_and_retried():
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise OSError("checkpoint not found")
+        return "model"
+
+    components = LazyComponents()
+    components.register("preset_model", flaky)
+    components.load_all()
+    assert components.status()["preset_model"]["status"] == "failed"
+    assert components.get("preset_model") == "model"
+    with pytest.raises(KeyError):
+        components.get("unknown")
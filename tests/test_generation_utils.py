@@ -0,0 +1,88 @@
+import torch
+
+from story_generator.generation_utils import BatchStreamer, CandidatesStreamer, _sample_demo_sequences
+from story_generator.lru_cache import PrefixCache
+
+
+def test_prefix_cache_keeps_samples_identical(tokenizer, tiny_gpt2):
+    model, cache = tiny_gpt2(1), PrefixCache(max_bytes=10**8)
+
+    def sample(prompts, prefix_cache):
+        torch.manual_seed(0)
+        outputs = _sample_demo_sequences(model, tokenizer, prompts, 12, 4, "cpu", first_idx=True,
+                                         prefix_cache=prefix_cache)
+        return [list(texts) for texts in outputs]
+
+    for prompts in (["Once upon a time there was "],
+                    ["Once upon a time there was a frog who "],
+                    ["Once upon a time there was a frog who lived", "Hi there, the "]):
+        assert sample(prompts, cache) == sample(prompts, None)
+    assert cache.hits == 2
+
+
+def test_streamed_texts_match_returned_texts(tokenizer, tiny_gpt2):
+    streamed = {}
+    streamer = CandidatesStreamer(tokenizer, False, lambda idx, text: streamed.update({idx: streamed.get(idx, "") + text}))
+    torch.manual_seed(0)
+    generated = _sample_demo_sequences(tiny_gpt2(1), tokenizer, ["Once upon"], 12, 4, "cpu", first_idx=True,
+                                       streamer=streamer)[0]
+    assert list(generated) == [streamed[idx] for idx in sorted(streamed) if len(streamed[idx].strip()) > 2]
+
+
+
+def test_batch_streamer_streams_each_prompt_texts(tokenizer, tiny_gpt2):
+    streamed = [{}, {}]
+
+    def on_text(prompt_idx):
+        return lambda idx, text: streamed[prompt_idx].update({idx: streamed[prompt_idx].get(idx, "") + text})
+    # The second prompt ends with a space, its texts don't get a leading one.
+    prompts = ["Once upon", "Hi there, the "]
+    streamer = BatchStreamer([CandidatesStreamer(tokenizer, prompt[-1].isspace(), on_text(prompt_idx))
+                              for prompt_idx, prompt in enumerate(prompts)] + [None], 4)
+    torch.manual_seed(0)
+    outputs = _sample_demo_sequences(tiny_gpt2(1), tokenizer, prompts + ["Not streamed"], 12, 4, "cpu",
+                                     first_idx=True, streamer=streamer)
+    for generated, prompt_streamed in zip(outputs, streamed):
+        assert list(generated) == [prompt_streamed[idx] for idx in sorted(prompt_streamed)
+                                   if len(prompt_streamed[idx].strip()) > 2]
+
+def test_generation_stops_once_every_text_ended_a_sentence(tokenizer, tiny_gpt2):
+    model = tiny_gpt2(1)
+    dot_id = next(token_id for token_id in range(100) if tokenizer.decode([token_id]) == ".")
+    # Makes "." the most likely next token everywhere.
+    with torch.no_grad():
+        model.transformer.ln_f.weight.zero_()
+        model.transformer.ln_f.bias.normal_()
+        model.transformer.wte.weight[dot_id] = 10 * model.transformer.ln_f.bias
+    forward_calls = []
+    model.register_forward_hook(lambda module, inputs, output: forward_calls.append(1))
+
+    def sample(stop_at_sentence_end):
+        forward_calls.clear()
+        torch.manual_seed(0)
+        texts = _sample_demo_sequences(model, tokenizer, ["Once upon a time"], 12, 4, "cpu", first_idx=True,
+                                       stop_at_sentence_end=stop_at_sentence_end)[0]
+        return list(texts), len(forward_calls)
+
+    assert sample(False) == ([" " + "." * 12] * 4, 12)
+    # Ends at the first "." after half the max length.
+    assert sample(True) == ([" " + "." * 6] * 4, 6)
+
+
+def test_texts_end_at_their_first_sentence_end(tokenizer, tiny_gpt2):
+    streamed = {}
+    streamer = CandidatesStreamer(tokenizer, False, lambda idx, text: streamed.update({idx: streamed.get(idx, "") + text}))
+    model = tiny_gpt2(1)
+    torch.manual_seed(0)
+    texts, scores = _sample_demo_sequences(model, tokenizer, ["Once upon"], 20, 10, "cpu", first_idx=True,
+                                           return_scores=True, streamer=streamer)[0]
+    assert list(texts) == [streamed[idx] for idx in sorted(streamed) if len(streamed[idx].strip()) > 2]
+    assert scores.continuation_ids.shape == scores.scores.shape[:2]
+    num_ended = 0
+    for continuation in scores.continuation_ids.tolist():
+        ends = [idx for idx, token_id in enumerate(continuation)
+                if idx >= 9 and tokenizer.decode([token_id]) in (".", "!", "?")]
+        if ends:
+            num_ended += 1
+            assert set(continuation[ends[0] + 1:]) <= {tokenizer.eos_token_id}
+    assert num_ended > 0
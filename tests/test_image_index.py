@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+import torch
+
+from story_generator.generation_utils import find_best_matches
+from story_generator.image_index import PhotoIndex, PhotoIds, build_photo_ids
+
+
+def test_photo_ids_store_round_trips_the_csv_and_is_aligned(tmp_path):
+    ids = ["HxhSVDapt-I", "h2LMXbpvwCw", "I9EhRx3oQ7Q", "QAgOqt7M8_E"]
+    (tmp_path / "photo_ids.csv").write_text("photo_id\n" + "\n".join(ids) + "\n")
+    features = np.eye(4, 8, dtype=np.float16)
+    np.save(tmp_path / "features.npy", features)
+
+    build_photo_ids(tmp_path / "photo_ids.csv", tmp_path / "photo_ids.npy", tmp_path / "features.npy")
+    photo_ids = PhotoIds.load(tmp_path / "photo_ids.npy")
+    assert isinstance(photo_ids.ids, np.memmap)
+    assert len(photo_ids) == 4 and photo_ids[2] == ids[2]
+    assert photo_ids.take([3, 0]) == [ids[3], ids[0]]
+    assert ids[1] in photo_ids and "HxhSVDapt" not in photo_ids and "../" + ids[0] not in photo_ids and "" not in photo_ids
+    assert all(photo_id in photo_ids for photo_id in ids) and "zzzzzzzzzzz" not in photo_ids and ids[0] + "x" not in photo_ids
+
+    # The best match of the third photo's features, skipping an already used photo.
+    query = torch.from_numpy(features[2:3].astype(np.float32))
+    assert find_best_matches(query, PhotoIndex(features, "cpu"), photo_ids, 1, [ids[2]]) != [ids[2]]
+    assert find_best_matches(query, PhotoIndex(features, "cpu"), photo_ids, 1, []) == [ids[2]]
+
+    np.save(tmp_path / "features.npy", features[:3])
+    with pytest.raises(ValueError):
+        build_photo_ids(tmp_path / "photo_ids.csv", tmp_path / "misaligned.npy", tmp_path / "features.npy")
+    assert not (tmp_path / "misaligned.npy").exists()
@@ -0,0 +1,34 @@
+import asyncio
+import time
+
+import pytest
+
+from server.inference import InferenceExecutor, ServiceOverloaded
+
+
+def test_full_queue_is_shed_with_retry_after():
+    inference = InferenceExecutor({"image": (1, 1)}, max_workers=1, num_threads=1)
+
+    async def run():
+        requests = [inference.run("image", time.sleep, 0.1) for _ in range(3)]
+        return await asyncio.gather(*requests, return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert results[:2] == [None, None]
+    assert isinstance(results[2], ServiceOverloaded)
+    assert results[2].retry_after >= 1
+
+    metrics = inference.metrics()["endpoints"]["image"]
+    assert (metrics["completed"], metrics["rejected"], metrics["queued"]) == (2, 1, 0)
+    assert metrics["wait_time"]["max"] >= 0.1
+
+
+def test_errors_release_the_slot():
+    inference = InferenceExecutor({"text": (1, 0)}, max_workers=1, num_threads=1)
+
+    async def run():
+        with pytest.raises(ZeroDivisionError):
+            await inference.run("text", lambda: 1 / 0)
+        return await inference.run("text", lambda: "ok")
+
+    assert asyncio.run(run()) == "ok"
@@ -0,0 +1,22 @@
+import torch
+
+from story_generator.lru_cache import SizedLRUCache
+
+
+def test_evicts_least_recently_used_by_size():
+    cache = SizedLRUCache(max_bytes=3 * 1024, sizeof=lambda value: 0 if isinstance(value, str) else 1024)
+    for key in "abc":
+        cache.put(key, torch.zeros(256))
+    assert cache.get("a") is not None
+    cache.put("d", torch.zeros(256))
+
+    assert "b" not in cache and all(key in cache for key in "acd")
+    assert cache.get("b") is None
+    assert cache.info() == {"entries": 3, "bytes": 3 * 1024, "max_bytes": 3 * 1024,
+                            "hits": 1, "misses": 1, "evictions": 1}
+
+
+def test_values_larger_than_the_cache_are_skipped():
+    cache = SizedLRUCache(max_bytes=100)
+    cache.put("features", torch.zeros(512))
+    assert len(cache) == 0 and cache.current_bytes == 0
@@ -0,0 +1,35 @@
+import copy
+
+import numpy as np
+import torch
+
+from story_generator.model_optimization import _conv1d_to_linear, quantize_gpt2, spearman_correlation
+
+
+def _logits(model, input_ids):
+    with torch.no_grad():
+        return model(input_ids)[0]
+
+
+def test_conv1d_to_linear_keeps_the_logits(tiny_gpt2):
+    model, input_ids = tiny_gpt2(0), torch.randint(1, 100, (2, 16))
+    linear = _conv1d_to_linear(copy.deepcopy(model))
+    assert isinstance(linear.transformer.h[0].mlp.c_fc, torch.nn.Linear)
+    assert torch.equal(_logits(linear, input_ids), _logits(model, input_ids))
+
+
+def test_quantized_gpt2_stays_close_to_fp32(tiny_gpt2):
+    model, input_ids = tiny_gpt2(0), torch.randint(1, 100, (2, 16))
+    reference, quantized = _logits(model, input_ids), _logits(quantize_gpt2(copy.deepcopy(model)), input_ids)
+    kl = torch.nn.functional.kl_div(torch.log_softmax(quantized, dim=-1), torch.log_softmax(reference, dim=-1),
+                                    reduction='batchmean', log_target=True)
+    assert float(kl) < 1e-3
+    assert (quantized - reference).abs().max() < 0.05 * reference.abs().max()
+
+
+def test_spearman_correlation_compares_rankings():
+    scores = np.array([0.1, 0.5, 0.3, 0.9])
+    assert spearman_correlation(scores, scores * 2 + 1) == 1
+    assert spearman_correlation(scores, -scores) == -1
+    # Swapping the two middle texts keeps most of the ranking.
+    assert 0 < spearman_correlation(scores, np.array([0.1, 0.3, 0.5, 0.9])) < 1
@@ -0,0 +1,74 @@
+import time
+
+import numpy as np
+import torch
+
+import story_generator.constants as constants
+from story_generator.generation_utils import GenerationScores
+from story_generator.ranking_utils import (KLDIV_error_per_batch, KLDIV_error_per_text, CPU_LEXICAL, FEATURE_REGISTRY,
+                                          MODEL_FORWARD, RankingFeature, RankingInputs, Ranker)
+from story_generator.sentence_embedder import SentenceEmbedder
+
+
+def test_batched_kldiv_matches_per_text(tokenizer, tiny_gpt2):
+    preset, finetuned = tiny_gpt2(0), tiny_gpt2(1)
+    texts = ["Once upon a time there was a frog.", "short",
+             "The king had three daughters and a castle by the sea."]
+    expected = [KLDIV_error_per_text(tokenizer, preset, finetuned, text) for text in texts]
+    batched = KLDIV_error_per_batch(tokenizer, preset, finetuned, texts)
+    assert batched.shape == (len(texts),)
+    assert batched[1] == 0
+    np.testing.assert_allclose(batched, expected, rtol=1e-4)
+
+
+def test_ranker_approximates_then_skips_features_over_the_budget():
+    def slow(inputs):
+        time.sleep(0.05)
+        return np.arange(len(inputs.texts), dtype=float)
+
+    features = [FEATURE_REGISTRY['Readability'],
+                RankingFeature('Slow', MODEL_FORWARD, 1.0, slow, lambda inputs: -np.arange(len(inputs.texts), dtype=float))]
+    texts = ["Once upon a time there was a frog.", "The king had three daughters."]
+    ranker = Ranker(latency_budget=0.01, features=features)
+
+    # Without latency history the slow feature runs, then it is approximated.
+    assert ranker.score(texts, None, None, None)[:, 1].tolist() == [0, 1]
+    assert ranker.score(texts, None, None, None)[:, 1].tolist() == [0, -1]
+    assert ranker.decisions['Slow'] == {"full": 1, "approximate": 1, "skipped": 0}
+
+    ranker.histograms['Slow~approximate'].record(1.0)
+    assert ranker.score(texts, None, None, None)[:, 1].tolist() == [0, 0]
+    assert ranker.decisions['Slow']["skipped"] == 1
+    assert ranker.metrics()["latency_per_text"]["Slow"]["count"] == 1
+
+
+def test_model_features_are_in_the_model_forward_class():
+    assert FEATURE_REGISTRY['Tale_like'].cost == MODEL_FORWARD
+    assert all(FEATURE_REGISTRY[name].cost == CPU_LEXICAL for name in ['Readability', 'Sentiment', 'Simplicity', 'Diversity'])
+
+
+def test_coherency_is_scored_with_the_given_sentence_embedder():
+    class FirstWordEmbedder(SentenceEmbedder):
+        # Sentences starting with the same word get the same vector.
+        def _encode(self, sentences):
+            encoded.extend(sentences)
+            return np.array([[1.0, 0.0] if sentence.startswith("The") else [0.0, 1.0] for sentence in sentences])
+
+    encoded = []
+    ranker = Ranker(latency_budget=None, features=[FEATURE_REGISTRY['Coherency']])
+    texts = ["The frog sat by the well. The frog was sad.", "The frog sat by the well. A king rode by."]
+    assert ranker.score(texts, None, None, None)[:, 0].tolist() == [0, 0]
+    scores = ranker.score(texts, None, None, None, sentence_embedder=FirstWordEmbedder())
+    assert encoded and scores[:, 0].tolist() == [1, 0]
+
+
+def test_approximate_tale_like_encodes_the_last_prompt_tokens_only(tokenizer, tiny_gpt2):
+    preset = tiny_gpt2(0)
+    input_lengths = []
+    preset.register_forward_pre_hook(lambda module, args: input_lengths.append(args[0].shape[-1]))
+    scores = GenerationScores(prompt_ids=torch.randint(1, 100, (1, 100)),
+                              continuation_ids=torch.randint(1, 100, (3, 20)), scores=torch.randn(3, 20, 100))
+    inputs = RankingInputs(["Once upon a time there was a frog."] * 3, None, tokenizer, preset, None, scores, None)
+    tale_like = FEATURE_REGISTRY['Tale_like'].approximate(inputs)
+    assert tale_like.shape == (3,)
+    assert input_lengths == [constants.TALE_LIKE_APPROXIMATE_CONTEXT, constants.TALE_LIKE_APPROXIMATE_TOKENS]
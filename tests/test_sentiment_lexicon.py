@@ -0,0 +1,20 @@
+import numpy as np
+
+import story_generator.sentiment_lexicon as sentiment_lexicon
+from story_generator.sentiment_lexicon import SentimentLexicon
+
+
+def test_lookups_match_table_and_fall_back_on_misses(monkeypatch, tmp_path):
+    live = {"a:good": 0.625, "n:cat": 0.0, "v:run": -0.125, "n:frog": 0.25}
+    monkeypatch.setattr(sentiment_lexicon, "synset_polarity",
+                        lambda lemma, wn_tag: live.get(f"{wn_tag}:{lemma}"))
+    keys = np.array(sorted(["a:good", "n:cat", "v:run"]))
+    lexicon = SentimentLexicon(keys, np.array([live[key] for key in keys], dtype=np.float32))
+    lexicon.save(tmp_path / "lexicon.npz")
+    lexicon = SentimentLexicon.load(tmp_path / "lexicon.npz")
+    assert lexicon.keys.dtype == np.dtype("S6")
+
+    lemmas, wn_tags = ["good", "frog", "run", "cat", "zzz"], ["a", "n", "v", "n", "r"]
+    assert lexicon.polarities_of(lemmas, wn_tags) == [live.get(f"{wn_tag}:{lemma}")
+                                                      for lemma, wn_tag in zip(lemmas, wn_tags)]
+    assert lexicon.polarities_of([], []) == []
@@ -0,0 +1,73 @@
+import threading
+
+import torch
+
+from story_generator.generation_utils import CandidatesStreamer, _sample_demo_sequences
+from story_generator.lru_cache import PrefixCache
+from story_generator.speculative_decoding import SpeculativeStats, _logits_processors, speculative_generate
+
+
+def test_speculative_samples_follow_the_model_distribution(tiny_gpt2):
+    model, draft_model = tiny_gpt2(1), tiny_gpt2(2)
+    prompt = torch.tensor([[5, 17, 42]])
+    torch.manual_seed(0)
+    sequences = speculative_generate(model, draft_model, prompt, torch.ones_like(prompt), max_length=5, min_length=0,
+                                     num_return_sequences=20000, num_draft_tokens=2)
+
+    processors = _logits_processors(0, model.config.eos_token_id)
+    with torch.no_grad():
+        first = torch.softmax(processors(prompt, model(prompt)[0][:, -1]), dim=-1)[0]
+        tokens = torch.arange(first.shape[0]).unsqueeze(-1)
+        prompts = torch.cat([prompt.expand(len(tokens), -1), tokens], dim=-1)
+        second = first @ torch.softmax(processors(prompts, model(prompts)[0][:, -1]), dim=-1)
+        draft_first = torch.softmax(processors(prompt, draft_model(prompt)[0][:, -1]), dim=-1)[0]
+
+    def total_variation(samples, probs):
+        return 0.5 * (torch.bincount(samples, minlength=len(probs)) / len(samples) - probs).abs().sum()
+    assert total_variation(sequences[:, 3], first) < 0.045
+    assert total_variation(sequences[:, 4], second) < 0.045
+    # Not the draft model distribution.
+    assert total_variation(sequences[:, 3], draft_first) > 2 * total_variation(sequences[:, 3], first)
+
+
+def test_draft_tokens_of_the_same_model_are_all_accepted(tokenizer, tiny_gpt2):
+    stats = SpeculativeStats()
+    _sample_demo_sequences(tiny_gpt2(1), tokenizer, ["Once upon a time"], 11, 1, "cpu", first_idx=True,
+                           draft_model=tiny_gpt2(1), speculative_stats=stats, num_draft_tokens=4)
+    assert stats.info()["acceptance_rate"] > 0.99
+    assert stats.rounds < 11
+
+
+def test_stats_count_every_round_of_concurrent_generations():
+    stats = SpeculativeStats()
+
+    def record():
+        for _ in range(1000):
+            stats.record(4, 3, 2)
+    threads = [threading.Thread(target=record) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert (stats.rounds, stats.drafted, stats.accepted, stats.tokens) == (8000, 32000, 24000, 16000)
+    assert stats.info() == {"rounds": 8000, "acceptance_rate": 0.75, "tokens_per_forward": 2.0}
+
+
+def test_speculative_outputs_match_generate_outputs(tokenizer, tiny_gpt2):
+    model, draft_model, cache = tiny_gpt2(1), tiny_gpt2(2), PrefixCache(max_bytes=10**8)
+    prompts = ["Once upon a time there was ", "Hi there, the "]
+    generated = _sample_demo_sequences(model, tokenizer, prompts, 12, 4, "cpu", first_idx=True, return_scores=True)
+    for prefix_cache in [None, cache, cache]:
+        speculative = _sample_demo_sequences(model, tokenizer, prompts, 12, 4, "cpu", first_idx=True, return_scores=True,
+                                             prefix_cache=prefix_cache, draft_model=draft_model)
+        for (texts, scores), (expected_texts, expected_scores) in zip(speculative, generated):
+            assert len(texts) == len(scores.continuation_ids) == len(scores.scores)
+            assert scores.continuation_ids.shape[-1] == scores.scores.shape[1] <= 12
+            assert scores.scores.shape[-1] == expected_scores.scores.shape[-1]
+    assert cache.hits == 2
+
+    streamed = {}
+    streamer = CandidatesStreamer(tokenizer, False, lambda idx, text: streamed.update({idx: streamed.get(idx, "") + text}))
+    texts = _sample_demo_sequences(model, tokenizer, ["Once upon"], 12, 4, "cpu", first_idx=True, streamer=streamer,
+                                   draft_model=draft_model)[0]
+    assert list(texts) == [streamed[idx] for idx in sorted(streamed) if len(streamed[idx].strip()) > 2]
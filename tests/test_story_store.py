@@ -0,0 +1,76 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+from server.story_store import FileStoryStore, SQLiteStoryStore, StoryStore, migrate
+from server.story_writer import StoryWriter
+
+PAYLOAD = {"coherence": 4.0, "clarity": 5.0, "creativity": 3.0, "freeForm": "nice", "html": "<p>Once upon a time</p>"}
+
+
+@pytest.fixture(params=["files", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "files":
+        return FileStoryStore(str(tmp_path))
+    return SQLiteStoryStore(str(tmp_path / "stories.sqlite3"))
+
+
+def test_put_and_get_html(store):
+    assert store.get_html("0" * 32) is None
+    assert store.put("a" * 32, PAYLOAD)
+    assert not store.put("a" * 32, dict(PAYLOAD, html="<p>changed</p>"))
+    assert store.get_html("a" * 32) == PAYLOAD["html"]
+    assert "a" * 32 in store and "../" + "a" * 32 not in store
+    assert dict(store.items()) == {"a" * 32: PAYLOAD}
+
+
+def test_backends_implement_the_whole_interface():
+    class PartialStore(StoryStore):
+        def get_html(self, story_id):
+            return None
+    with pytest.raises(TypeError):
+        PartialStore()
+
+
+def test_files_read_indented_stories_and_migrate_to_sqlite(tmp_path):
+    files = FileStoryStore(str(tmp_path))
+    (tmp_path / f"{'b' * 32}.txt").write_text(json.dumps(PAYLOAD, sort_keys=True, indent=4))
+    files.put("c" * 32, PAYLOAD)
+    assert (tmp_path / f"{'c' * 32}.txt").read_text() == json.dumps(PAYLOAD, sort_keys=True, separators=(',', ':'))
+    assert files.get_html("b" * 32) == PAYLOAD["html"]
+
+    sqlite = SQLiteStoryStore(str(tmp_path / "stories.sqlite3"))
+    assert migrate(files, sqlite) == (2, 0)
+    assert migrate(files, sqlite) == (0, 2)
+    assert sqlite.get_html("b" * 32) == PAYLOAD["html"]
+
+
+@pytest.mark.parametrize("durability", ["none", "batch", "record"])
+def test_writer_batches_submissions_and_skips_duplicates(store, durability):
+    calls = []
+    put_many = store.put_many
+    store.put_many = lambda stories, durability: calls.append(len(stories)) or put_many(stories, durability)
+
+    async def run():
+        writer = StoryWriter(store, max_batch_size=8, max_wait=0.05, durability=durability)
+        results = await asyncio.gather(*(writer.submit(story_id, PAYLOAD) for story_id in ["a" * 32, "b" * 32, "a" * 32]))
+        return results, await writer.submit("b" * 32, PAYLOAD), writer.metrics()
+
+    results, is_new, metrics = asyncio.run(run())
+    assert results == [True, True, False] and not is_new
+    assert calls == [3, 1]
+    assert metrics["written"] == 2 and metrics["duplicates"] == 2 and metrics["batches"] == 2
+
+
+def test_batch_durability_syncs_every_story_before_renaming_any(tmp_path, monkeypatch):
+    store = FileStoryStore(str(tmp_path))
+    calls = []
+    fsync, replace = os.fsync, os.replace
+    monkeypatch.setattr(os, "fsync", lambda fd: calls.append("fsync") or fsync(fd))
+    monkeypatch.setattr(os, "replace", lambda src, dst: calls.append("replace") or replace(src, dst))
+    assert store.put_many([("a" * 32, PAYLOAD), ("b" * 32, PAYLOAD), ("a" * 32, PAYLOAD)], "batch") == [True, True, False]
+    # Two stories, then the directory once.
+    assert calls == ["fsync", "fsync", "replace", "replace", "fsync"]
+    assert sorted(os.listdir(tmp_path)) == [f"{'a' * 32}.txt", f"{'b' * 32}.txt"]
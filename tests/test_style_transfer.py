@@ -0,0 +1,83 @@
+import os
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+import story_generator.constants as constants
+from story_generator.style_transfer import (StyleTransfer, load_style_model, original_image_path, prestylize,
+                                            style_image_path)
+from story_generator.transformer_net import TransformerNet
+
+
+@pytest.fixture
+def style_folders(tmp_path, monkeypatch):
+    folders = {style: str(tmp_path / style) for style in constants.STYLE_IMAGES_PATHS}
+    monkeypatch.setattr(constants, "STYLE_IMAGES_PATHS", folders)
+    (tmp_path / "none").mkdir()
+    rng = np.random.default_rng(0)
+    for photo_id in ["a", "b", "c"]:
+        Image.fromarray(rng.integers(0, 256, (40, 48, 3), dtype=np.uint8)).save(tmp_path / "none" / f"{photo_id}.jpg")
+    torch.manual_seed(0)
+    torch.save(TransformerNet().state_dict(), tmp_path / "style.model")
+    monkeypatch.setattr(constants, "STYLE_MODELS", {style: str(tmp_path / "style.model")
+                                                    for style in constants.STYLE_MODELS})
+    return tmp_path
+
+
+def test_photos_are_stylized_in_batches_once_per_style(style_folders):
+    image_size = (32, 24)
+    model = load_style_model(style_folders / "style.model", "cpu", image_size=image_size)
+    forward_sizes = []
+    model.register_forward_hook(lambda module, inputs, output: forward_sizes.append(len(inputs[0])))
+    style_transfer = StyleTransfer(lambda style: model, "cpu", image_size, batch_size=2)
+
+    paths = style_transfer.stylize(["a", "b", "a", "c"], "sketch")
+    assert paths == [style_image_path(photo_id, "sketch", image_size) for photo_id in ["a", "b", "a", "c"]]
+    assert forward_sizes == [2, 1]
+    assert Image.open(paths[0]).size == image_size
+
+    # Cached on disk, a new instance doesn't stylize again.
+    assert StyleTransfer(lambda style: model, "cpu", image_size).stylize(["c", "b"], "sketch") == [paths[3], paths[1]]
+    assert forward_sizes == [2, 1]
+    assert style_transfer.metrics()["misses"] == 3
+
+    with pytest.raises(AssertionError):
+        style_transfer.stylize(["../a"], "sketch")
+
+
+def test_int8_style_model_is_close_to_fp32(style_folders):
+    image_size = (32, 24)
+    fp32 = load_style_model(style_folders / "style.model", "cpu", "none", image_size)
+    int8 = load_style_model(style_folders / "style.model", "cpu", "int8", image_size)
+    batch = torch.rand(2, 3, 24, 32) * 255
+    with torch.inference_mode():
+        expected, output = fp32(batch), int8(batch)
+    assert output.shape == expected.shape
+    assert torch.corrcoef(torch.stack([output.flatten(), expected.flatten()]))[0, 1] > 0.9
+
+
+def test_prestylize_is_resumable(style_folders):
+    image_size = (32, 24)
+    stats = prestylize(["a", "b", "c", "a"], ["sketch", "anime"], workers=2, image_size=image_size, batch_size=1)
+    assert (stats["stylized"], stats["skipped"], stats["failed"]) == (6, 0, 0)
+    assert all(Image.open(style_image_path(photo_id, style, image_size)).size == image_size
+               for photo_id in ["a", "b", "c"] for style in ["sketch", "anime"])
+
+    stats = prestylize(["a", "b", "c"], ["sketch", "anime", "comics"], workers=2, image_size=image_size)
+    assert (stats["stylized"], stats["skipped"], stats["failed"]) == (3, 6, 0)
+
+
+def test_failed_downloads_leave_no_file(style_folders, monkeypatch):
+    def urlretrieve(url, path):
+        with open(path, "wb") as outfile:
+            outfile.write(b"partial")
+        raise urllib.error.HTTPError(url, 404, "Not Found", None, None)
+
+    monkeypatch.setattr(urllib.request, "urlretrieve", urlretrieve)
+    with pytest.raises(urllib.error.URLError):
+        original_image_path("missing")
+    assert sorted(os.listdir(style_folders / "none")) == ["a.jpg", "b.jpg", "c.jpg"]
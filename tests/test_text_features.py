@@ -0,0 +1,48 @@
+import numpy as np
+
+import story_generator.constants as constants
+from story_generator.helper_functions import split_to_sentences, split_words
+from story_generator.ranking_utils import _readabilty, _simplicity, _diversity, _coherency
+from story_generator.sentence_embedder import SentenceEmbedder
+from story_generator.text_features import (extract_text_features, readability_batch, simplicity_batch,
+                                           diversity_batch, coherency_batch, _sample_candidates)
+
+
+def test_batch_features_match_per_text_features():
+    texts = _sample_candidates(200) + ["", " ", "  Hello world", "\n Hi there.\n", "Mr. Fox ran.  "]
+    features = [extract_text_features(text) for text in texts]
+
+    expected = []
+    for text in texts:
+        filtered_words = [word for word in split_words(text.lower().strip())
+                          if word not in constants.STOP_WORDS]
+        expected.append([_readabilty(text, split_to_sentences(text)), _simplicity(set(filtered_words)),
+                         _diversity(filtered_words, set(filtered_words))])
+        assert extract_text_features(text).filtered_words == filtered_words
+
+    np.testing.assert_allclose(np.stack([readability_batch(features), simplicity_batch(features),
+                                         diversity_batch(features)], axis=1), expected)
+
+
+class CountingEmbedder(SentenceEmbedder):
+    """Bag of letters vectors, counts the encoded sentences."""
+
+    def __init__(self):
+        super().__init__(cache_bytes=2**20)
+        self.encoded = 0
+
+    def _encode(self, sentences):
+        self.encoded += len(sentences)
+        return np.array([[sentence.lower().count(letter) for letter in "abcdefghijklmnopqrstuvwxyz"]
+                         for sentence in sentences], dtype=float)
+
+
+def test_batch_coherency_matches_per_text_coherency_and_caches_sentences():
+    texts = _sample_candidates(50) + ["", "One sentence only", "Mr. Fox ran. He hid!"]
+    features = [extract_text_features(text) for text in texts]
+    embedder = CountingEmbedder()
+
+    expected = [_coherency(feature.sentences, embedder) for feature in features]
+    encoded = embedder.encoded
+    np.testing.assert_allclose(coherency_batch(features, embedder), expected, atol=1e-6)
+    assert embedder.encoded == encoded